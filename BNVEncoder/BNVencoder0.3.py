@@ -2,6 +2,14 @@
 
 import re  #import the regex library
 import os  #import the OS calling library
+import io  #import the library for treating a block of text as a file
+import zlib  #import the compression library for reading gzipped VCFs
+import struct  #import the library for unpacking the binary BGZF block headers
+import sys  #import the library for telling which platform we are on
+import time  #import the library for timing our progress updates
+import operator  #import the library with fast helpers for slicing every column
+import itertools  #import the library for taking a batch of lines at a time
+import importlib.util  #import the library for loading the helper modules shared between the programs
 
 class CheckArgs(object):
     def __init__(self):
@@ -11,17 +19,116 @@ class CheckArgs(object):
         parser.add_argument ("-f", "--VCFinput", help = "VCF file for collecting data")
         parser.add_argument ("-9", "--clobber", help = "Ignore potential file overwrites (use with caution).", action = "store_true")
         parser.add_argument ("-u", "--useUnidentifiableGroup", help = "Allows the program to use a VCF even if some group IDs can't be identified.  They will be grouped into the group 'Unidentifiable' in the output.", action = "store_true")
+        parser.add_argument ("-b", "--batchSize", help = "Number of VCF records to count together in one vectorized batch (requires NumPy).", type = int, default = 10000)
+        parser.add_argument ("-s", "--scalar", help = "Count genotypes one record at a time without NumPy, even if it is available.", action = "store_true")
+        parser.add_argument ("-w", "--workers", help = "Number of processes to use for parsing and counting the VCF (requires NumPy).", type = int, default = 1)
+        parser.add_argument ("-c", "--chunkSize", help = "Size in megabytes of the pieces of the VCF handed to each worker process.", type = int, default = 64)
+        parser.add_argument ("-t", "--decompressionThreads", help = "Number of threads to use for decompressing a bgzipped VCF.", type = int, default = 4)
+        parser.add_argument ("-r", "--region", help = "Only encode records whose position falls in this region, given as contig, contig:start or contig:start-end (1-based, inclusive).  Can be given more than once.", action = "append", default = [])
+        parser.add_argument ("-o", "--outputFormat", help = "Format for the counts matrix: text (tab-delimited .counts and .loci files) or npy (a .counts.npy matrix that can be memory mapped, with the groups and loci in a .counts.json sidecar; requires NumPy).", choices = ["text", "npy"], default = "text")
+        parser.add_argument ("-B", "--bufferSize", help = "Size in megabytes of the buffer output is collected in before being written to disk.", type = int, default = 8)
+        parser.add_argument ("-W", "--writerThread", help = "Write the outputs from a background thread so that counting does not wait on the disk.", action = "store_true")
+        parser.add_argument ("-p", "--progressInterval", help = "Seconds between progress updates.", type = float, default = 1.0)
+        parser.add_argument ("-m", "--splitMultiallelic", help = "Instead of skipping loci with more than one ALT allele, report a ref/alt pair of lines for each ALT allele.  Other ALT alleles count toward ref in each pair.", action = "store_true")
+        parser.add_argument ("-g", "--groups", help = "Tab-delimited sample sheet with a sample name and its group on each line.  Used instead of taking the group from the start of each sample name.  Samples not in the sheet go into the 'Unidentifiable' group if -u is set.")
+        parser.add_argument ("-I", "--incremental", help = "Keep the counts for each chunk of the VCF in a .bnvstate directory next to it, and on later runs only count the chunks that changed (requires NumPy).", action = "store_true")
+        parser.add_argument ("-R", "--regionsBed", help = "BED file of regions to encode (only records whose position falls in one of the regions are used).")
+        parser.add_argument ("-F", "--passOnly", help = "Only encode records whose FILTER column is PASS.", action = "store_true")
+        parser.add_argument ("-q", "--minQual", help = "Only encode records with a QUAL of at least this much (records without a QUAL are dropped).", type = float)
+        parser.add_argument ("-d", "--minDP", help = "Treat genotypes with a depth (FORMAT DP) below this as not called.  Genotypes without a DP value are treated as not called too.", type = int)
+        parser.add_argument ("-G", "--minGQ", help = "Treat genotypes with a genotype quality (FORMAT GQ) below this as not called.  Genotypes without a GQ value are treated as not called too.", type = int)
+        parser.add_argument ("-x", "--maxMissingRate", help = "Drop records where more than this fraction of the samples in any group are not called (after --minDP and --minGQ).", type = float)
+        parser.add_argument ("-S", "--groupStats", help = "Also write the allele frequency (.freq), call rate (.callrate) and observed heterozygosity (.het) of each group at each locus, worked out from the same pass.  These are tab-delimited text files with the same rows as the .counts matrix, whatever the output format.", action = "store_true")
+        parser.add_argument ("-L", "--pipeline", help = "Read, count and write in a pipeline: a reader thread hands blocks of lines through bounded queues to the counting workers (see --workers), and a writer thread writes their counts out in order, so reading, counting and writing overlap while memory stays flat.  Works with gzipped VCFs and regions too (requires NumPy).", action = "store_true")
+        parser.add_argument ("-l", "--blockLines", help = "Number of lines in each block the pipeline's reader hands on.", type = int, default = 5000)
+        parser.add_argument ("-D", "--queueDepth", help = "Number of blocks that can wait in each of the pipeline's queues before the stage in front of it has to wait.", type = int, default = 4)
+        parser.add_argument ("-M", "--metricsOutput", help = "JSON file to write the wall clock time, CPU time, records per second and peak memory of each stage of the run (read, parse, filter, count, render, write) to.")
+        parser.add_argument ("-T", "--traceMemory", help = "Also track the peak Python memory of each stage with tracemalloc (slows the run down; requires --metricsOutput).", action = "store_true")
+        parser.add_argument ("-P", "--profile", help = "Run under cProfile and save the statistics to this file (read them with python -m pstats).  Only covers the main process when using workers.")
         args = parser.parse_args()  #puts the arguments into the args object
         self.VCF = args.VCFinput
         self.useUnidentifiableGroup = args.useUnidentifiableGroup
+        self.batchSize = args.batchSize
+        self.scalar = args.scalar
+        self.workers = args.workers
+        self.chunkSize = args.chunkSize * 1024 * 1024
+        self.decompressionThreads = args.decompressionThreads
+        self.regionsBed = args.regionsBed
+        self.splitMultiallelic = args.splitMultiallelic
+        self.outputFormat = args.outputFormat
+        self.bufferSize = args.bufferSize * 1024 * 1024
+        self.writerThread = args.writerThread
+        self.progressInterval = args.progressInterval
+        self.incremental = args.incremental
+        self.groupStats = args.groupStats
+        self.pipeline = args.pipeline
+        self.blockLines = args.blockLines
+        self.queueDepth = args.queueDepth
+        self.metricsOutput = args.metricsOutput
+        self.traceMemory = args.traceMemory
+        self.profile = args.profile
         self.delimiter = "\t"  #Putting this here for now in case we ever need to use a different delimiter
         if not self.VCF:
             quit('No input VCF specified.')
         if not os.path.isfile(self.VCF):
             quit('Unable to find input VCF: ' + self.VCF)
-        self.outputMatrix = self.VCF + ".counts"
-        self.outputLoci = self.VCF + ".loci"
-        if os.path.isfile(self.outputMatrix) or os.path.isfile(self.outputLoci):  #checks to see if the user set to clobber existing files automatically
+        if self.batchSize < 1:
+            quit('Batch size must be at least 1.')
+        if self.workers < 1:
+            quit('Number of workers must be at least 1.')
+        if self.chunkSize < 1:
+            quit('Chunk size must be at least 1 megabyte.')
+        if self.decompressionThreads < 1:
+            quit('Number of decompression threads must be at least 1.')
+        if self.bufferSize < 0:
+            quit('Buffer size cannot be negative.')
+        if self.regionsBed and not os.path.isfile(self.regionsBed):
+            quit('Unable to find regions BED file: ' + self.regionsBed)
+        if self.blockLines < 1:
+            quit('Block size must be at least 1 line.')
+        if self.queueDepth < 1:
+            quit('Queue depth must be at least 1.')
+        if self.pipeline:
+            if self.scalar:
+                quit('The pipeline counts with NumPy, so cannot be used with scalar counting.')
+            if self.incremental:
+                quit('Stored counts (--incremental) are kept for chunks, so cannot be used with the pipeline.')
+            self.writerThread = True  #writing is the last stage of the pipeline
+        if self.traceMemory and not self.metricsOutput:
+            quit('Memory tracing needs a metrics output file (--metricsOutput).')
+        if args.maxMissingRate is not None and not 0 <= args.maxMissingRate <= 1:
+            quit('Maximum missing rate must be between 0 and 1.')
+        self.recordFilter = RecordFilter(args.passOnly, args.minQual, args.minDP, args.minGQ, args.maxMissingRate)
+        self.sampleGroups = None
+        if args.groups and not os.path.isfile(args.groups):
+            quit('Unable to find sample sheet: ' + args.groups)
+        self.regions = []
+        try:
+            if args.groups:
+                self.sampleGroups = readSampleSheet(args.groups)
+            for region in args.region:
+                self.regions.append(parseRegion(region))
+            if self.regionsBed:
+                self.regions += readRegionsBed(self.regionsBed)
+        except ValueError as error:
+            quit(str(error))
+        if self.outputFormat == "npy":
+            if self.scalar:
+                quit('The npy output format cannot be used with scalar counting.')
+            try:
+                import numpy
+            except ImportError:
+                quit('The npy output format requires NumPy.')
+            self.outputMatrix = self.VCF + ".counts.npy"
+            self.outputLoci = self.VCF + ".counts.json"  #the loci go in the sidecar along with the groups
+            self.outputSidecar = self.outputLoci
+        else:
+            self.outputMatrix = self.VCF + ".counts"
+            self.outputLoci = self.VCF + ".loci"
+        self.outputStats = []
+        if self.groupStats:
+            self.outputStats = [self.VCF + extension for extension in [".freq", ".callrate", ".het"]]
+        if os.path.isfile(self.outputMatrix) or os.path.isfile(self.outputLoci) or any([os.path.isfile(statsFile) for statsFile in self.outputStats]):  #checks to see if the user set to clobber existing files automatically
             if args.clobber:  #if so, let them know we are overwriting existing files by their command
                 print('Outputs already exist.  Set to overwrite in command line arguments.')
             else:  #if not, check if they want to proceed anyway
@@ -77,32 +184,83 @@ class VCFLine(object):
         self.variantColumns = self.line[0:9] #Takes the first set of columns and turns it into a property
         self.sampleColumns = self.line[9:len(self.line)] #does the same for the second set of columns with sample data
 
+groupPrefix = re.compile(r'^(\D+)')  #compiled once so that files with tens of thousands of samples do not keep rebuilding it
+
+def readSampleSheet(sampleSheetFileName):  #reads a tab-delimited file of sample name and group, one sample per line, into a dictionary.  Blank lines and lines starting with # are skipped
+    sampleGroups = {}
+    sampleSheet = open(sampleSheetFileName, 'r')
+    lineNumber = 0
+    for line in sampleSheet:
+        lineNumber += 1
+        if not line.strip() or line.startswith("#"):
+            continue
+        columns = line.rstrip("\r\n").split("\t")
+        if len(columns) < 2 or not columns[0] or not columns[1]:
+            sampleSheet.close()
+            raise ValueError('Line ' + str(lineNumber) + ' of ' + sampleSheetFileName + ' does not have a sample and a group.')
+        if sampleGroups.get(columns[0], columns[1]) != columns[1]:
+            sampleSheet.close()
+            raise ValueError('Sample ' + columns[0] + ' is assigned to more than one group in ' + sampleSheetFileName + '.')
+        sampleGroups[columns[0]] = columns[1]
+    sampleSheet.close()
+    return sampleGroups
+
+genotypeSeparator = re.compile(r'[/|]')  #alleles in a GT value are separated by / when unphased and | when phased
+genotypeCache = {}  #there are only a handful of distinct GT values in most files, so each one only gets parsed once
+
+def parseGenotype(genotype):  #turns a GT value such as 0/1, 1|0, 0, 0/0/1 or 12/3 into a tuple of allele numbers.  Returns None if any allele is missing (.), since the whole call then counts as not called
+    try:
+        return genotypeCache[genotype]
+    except KeyError:
+        pass
+    if not genotype or "." in genotype:
+        alleles = None
+    else:
+        try:
+            alleles = tuple([int(allele) for allele in genotypeSeparator.split(genotype)])
+        except ValueError:
+            raise ValueError('Unable to read genotype: ' + genotype)
+    genotypeCache[genotype] = alleles
+    return alleles
+
 class Header(VCFLine):  #defines Header as an extension class of VCFLine
     
-    def generateLists(self, useUnidentifiable):  
+    def generateLists(self, useUnidentifiable, sampleGroups = None):  #sampleGroups is an optional dictionary of sample name to group from a sample sheet.  Without it, groups come from the letters at the start of each sample name
         self.columnGroupIDs = []  
         for item in self.sampleColumns:
             population = ""
-            regex = re.search(r'^(\D+)',item)
+            if sampleGroups is not None:
+                population = sampleGroups.get(item.strip(), "")  #the last column still has the newline on it
+                regex = population
+            else:
+                regex = groupPrefix.search(item)
             if not regex:
                 if useUnidentifiable:
                     population = "Unidentifiable"
                 else:
-                    raise RuntimeError('Unable to extract population from ' + item + '.  Not set to use unidentifiable populations.')
-            if not population == "Unidentifiable":
+                    raise RuntimeError('Unable to extract population from ' + item.strip() + '.  Not set to use unidentifiable populations.')
+            if not population:
                 population = regex.group(0)
             self.columnGroupIDs.append(population)  #add the population to an ordered list of which population the column belongs to
         mapreduce = MapReduce(self.columnGroupIDs)  #call the MapReduce class
         self.groupCountTable = mapreduce.reduced  #initialize an attribute with the number of samples per group
         self.outputGroupColumns = mapreduce.map  #make an attribute with an ordered list of groups (one entry per group)
         self.groupHash = {} #initialize an empty dictionary
+        self.groupCounts = []  #the same counters as the groupHash, in output column order, so they can be reached by index
+        groupIndex = {}
         for item in self.outputGroupColumns:  #iterate over our list of groups
             self.groupHash[item] = [0,0]  #for each group as a key in a dictionary, initialize an empty list of 0,0.  Conveniently enough, 0 is the genotype number for the ref allele being called and the index in our list for the reference allele count.  Alt alleles are indicated by 1, which is also the index of their counter in the list.
+            groupIndex[item] = len(self.groupCounts)
+            self.groupCounts.append(self.groupHash[item])
+        self.columnGroupIndex = [groupIndex[population] for population in self.columnGroupIDs]  #compiles the group of each sample column down to its output column number, so counting never has to look up a group name
         return True
     
 class Data(VCFLine):
+
+    genotypeMask = None  #set by a RecordFilter to a list of whether each sample's genotype passed the DP and GQ checks.  None means they all count
     
     def integrityCheck(self, headerColumns):  #simple function to make sure that we have at least as many columns of data as we have headers
+        self.locus = ":".join(self.variantColumns[0:2])  #captures the locus here too, since we need it to report a failed check and isBiallelic will not have run yet
         if len(self.sampleColumns) == len(headerColumns):
             return True
         else:
@@ -115,85 +273,1783 @@ class Data(VCFLine):
         else:
             return True
         
-    def createOutputs(self, columnGroupIDs, groupHash, headerColumns, delimiter = "\t"):  #supervisor function that tells the object to create its outputs
-        self.createAlleleCountOutputs(columnGroupIDs, groupHash, headerColumns, delimiter)
-        self.createLocusInfoOutputs(delimiter)
+    def genotypeIndex(self):  #returns which field of each sample column holds the GT value, according to the FORMAT column, or None if there is no GT
+        if len(self.variantColumns) < 9:
+            return None
+        formatFields = self.variantColumns[8].split(":")
+        if "GT" not in formatFields:
+            return None
+        return formatFields.index("GT")
+
+    def genotypes(self):  #returns the GT value from each sample column, using the FORMAT column to find where GT is.  Samples without a GT value get "."
+        gtIndex = self.genotypeIndex()
+        if gtIndex is None:
+            return ["."] * len(self.sampleColumns)
+        if gtIndex == 0:  #GT is supposed to come first, so this is the quick and common case
+            genotypes = [item.split(":", 1)[0] for item in self.sampleColumns]
+        else:
+            genotypes = []
+            for item in self.sampleColumns:
+                fields = item.split(":")
+                if len(fields) > gtIndex:
+                    genotypes.append(fields[gtIndex])
+                else:  #trailing fields may be dropped, so a short column has no GT value
+                    genotypes.append(".")
+        if genotypes:
+            genotypes[-1] = genotypes[-1].rstrip("\r\n")  #the last column still has the newline on it
+        return genotypes
+
+    def altAlleleNumbers(self, splitMultiallelic = False):  #returns the ALT allele numbers we make a ref/alt pair of outputs for.  Just 1 for a biallelic locus, or one for each ALT allele when splitting multiallelic loci
+        if splitMultiallelic:
+            return list(range(1, self.variantColumns[4].count(",") + 2))
+        return [1]
+
+    def createOutputs(self, columnGroupIndex, groupCounts, delimiter = "\t", splitMultiallelic = False):  #supervisor function that tells the object to create its outputs
+        self.createAlleleCountOutputs(columnGroupIndex, groupCounts, delimiter, splitMultiallelic)
+        self.createLocusInfoOutputs(delimiter, splitMultiallelic)
         
-    def createAlleleCountOutputs(self, columnGroupIDs, groupHash, headerColumns, delimiter):  #function that creates the output lines for the ref and alt alleles
-        position = 0  #initializes an integer to 0 to mark our position within the data columns
-        for item in self.sampleColumns:  #iterates over the columns containing sample data
-            genotypes = [item[0], item[2]]  #captures the first and third character from the column.  These should always correspond to the first and second genotype called for the locus
-            if "." in genotypes:  #if the genotype contains a period, indicating that it was not called
-                position += 1  #jump to the next column
-                continue  #and then restart the loop
-            currentGroup = columnGroupIDs[position] #if we reach this point, we have a called genotype.  Using our position tracker, we will look for the corresponding group ID to know which group to add the current data to
-            for genotype in genotypes: #we iterate over the genotypes for this sample
-                groupHash[currentGroup][int(genotype)] += 1  #and increment the appropriate genotype (0 for ref, 1 for alt) in our collection of genotypes
-            position += 1  #and then increment our position counter
-        self.refCountsOutput = ""  #initializing empty strings for ref and alt count output lines
-        self.altCountsOutput = ""
-        for column in headerColumns: #iterate over our header columns (headers for the output file, that is)
-            self.refCountsOutput += str(groupHash[column][0]) + delimiter #and we build our output line by adding on the appropriate count from our hash of values plus a delimiter
-            self.altCountsOutput += str(groupHash[column][1]) + delimiter #do the same for alternate reads (all that has to change is looking at position 1 instead of position 0) 
+    def calledGenotypes(self):  #returns the allele numbers called for each sample, or None where it was not called (or did not pass the genotype checks)
+        calls = [parseGenotype(genotype) for genotype in self.genotypes()]
+        if self.genotypeMask is not None:
+            calls = [call if passed else None for call, passed in zip(calls, self.genotypeMask)]
+        return calls
+
+    def countAlleles(self, columnGroupIndex, groupCounts, splitMultiallelic = False, calls = None):  #adds the calls on this line onto the [ref, alt] counters for each output column in groupCounts (columnGroupIndex gives the output column for each sample column).  Returns a copy of the counters after each ALT allele we report
+        if calls is None:
+            calls = self.calledGenotypes()  #the allele numbers called for each sample, or None if it was not called
+        altNumbers = self.altAlleleNumbers(splitMultiallelic)
+        highestAllele = altNumbers[-1]
+        self.alleleCounts = []  #one list of [ref, alt] counts for each ALT allele we report
+        for altNumber in altNumbers:
+            position = 0  #initializes an integer to 0 to mark our position within the data columns
+            for call in calls:  #iterates over the calls from each sample column
+                if call is None:  #if the genotype contains a period, indicating that it was not called
+                    position += 1  #jump to the next column
+                    continue  #and then restart the loop
+                currentGroup = groupCounts[columnGroupIndex[position]] #if we reach this point, we have a called genotype.  Using our position tracker, we will look up the counters for the group this column belongs to
+                for allele in call: #we iterate over the alleles for this sample (however many there are)
+                    if allele > highestAllele:
+                        raise ValueError("Unexpected allele found in a genotype call for locus " + self.locus + ".")
+                    if allele == altNumber:  #and increment the appropriate counter (position 1 for the alt allele we are reporting, position 0 for the ref allele or, when splitting a multiallelic locus, any other ALT allele)
+                        currentGroup[1] += 1
+                    else:
+                        currentGroup[0] += 1
+                position += 1  #and then increment our position counter
+            self.alleleCounts.append([[counts[0], counts[1]] for counts in groupCounts])  #the counters keep going up on later lines, so we keep a copy of where they are now
+        return self.alleleCounts
+
+    def lineStats(self, columnGroupIndex, groupCount, splitMultiallelic = False, calls = None):  #returns the [ref, alt, called samples, heterozygous samples] counts for each group, for each ALT allele we report.  Unlike countAlleles, these only count this line
+        if calls is None:
+            calls = self.calledGenotypes()
+        sampleCounts = [[0, 0] for group in range(groupCount)]  #called and heterozygous samples in each group
+        for position, call in enumerate(calls):
+            if call is None:
+                continue
+            counts = sampleCounts[columnGroupIndex[position]]
+            counts[0] += 1
+            if len(set(call)) > 1:  #any call with two different alleles is heterozygous
+                counts[1] += 1
+        stats = []
+        for altNumber in self.altAlleleNumbers(splitMultiallelic):
+            alleleCounts = [[0, 0] for group in range(groupCount)]
+            for position, call in enumerate(calls):
+                if call is None:
+                    continue
+                altCopies = call.count(altNumber)
+                counts = alleleCounts[columnGroupIndex[position]]
+                counts[0] += len(call) - altCopies  #other ALT alleles count toward ref, the same as in countAlleles
+                counts[1] += altCopies
+            stats.append([alleleCounts[group] + sampleCounts[group] for group in range(groupCount)])
+        return stats
+
+    def createAlleleCountOutputs(self, columnGroupIndex, groupCounts, delimiter, splitMultiallelic = False):  #function that creates the output lines for the ref and alt alleles.  columnGroupIndex gives the output column for each sample column, and groupCounts holds the [ref, alt] counters for each output column
+        self.alleleCountOutputs = []  #one (ref, alt) pair of output lines for each ALT allele we report
+        for pairCounts in self.countAlleles(columnGroupIndex, groupCounts, splitMultiallelic):
+            refCountsOutput = "".join([str(counts[0]) + delimiter for counts in pairCounts])  #build our output line from the ref count for each output column, each followed by a delimiter
+            altCountsOutput = "".join([str(counts[1]) + delimiter for counts in pairCounts])  #do the same for alternate reads (all that has to change is looking at position 1 instead of position 0)
+            self.alleleCountOutputs.append((refCountsOutput, altCountsOutput))
+        self.refCountsOutput, self.altCountsOutput = self.alleleCountOutputs[0]
         return True
     
-    def createLocusInfoOutputs(self, delimiter):  #creates outputs for our file containing the locus information.  This just defines several attributes based off of their column position in the VCF
+    def createLocusInfoOutputs(self, delimiter, splitMultiallelic = False):  #creates outputs for our file containing the locus information.  This just defines several attributes based off of their column position in the VCF
         self.contig = self.variantColumns[0]  
         self.position = self.variantColumns[1]
         self.refAllele = self.variantColumns[3]
         self.altAllele = self.variantColumns[4]
-        self.locusInfoRef = self.contig + delimiter + self.position + delimiter + self.refAllele  #this line and the next combine all the pertinent information about the ref and alt allele loci and have it ready to output to a file
-        self.locusInfoAlt = self.contig + delimiter + self.position + delimiter + self.altAllele
+        altAlleles = self.altAllele.split(",")
+        self.lociFields = [(self.contig, self.position, self.refAllele, altAlleles[altNumber - 1]) for altNumber in self.altAlleleNumbers(splitMultiallelic)]  #one (contig, position, ref, alt) entry per pair of output lines
+        self.locusInfoOutputs = [(self.contig + delimiter + self.position + delimiter + self.refAllele, self.contig + delimiter + self.position + delimiter + altAllele) for contig, position, refAllele, altAllele in self.lociFields]
+        self.locusInfoRef, self.locusInfoAlt = self.locusInfoOutputs[0]  #this line combines all the pertinent information about the ref and alt allele loci and has it ready to output to a file
         return True  #mostly useless return, but can be useful if we need some indication that this has actually been run and also provides a clear marker for the end of this function
-            
 
+class GenotypeCodes(dict):  #hands out a small integer code for each distinct GT value, parsing new ones as they turn up
+
+    def __init__(self):
+        dict.__init__(self)
+        self.calls = []  #the parsed alleles for each code
+
+    def __missing__(self, genotype):
+        code = len(self.calls)
+        self.calls.append(parseGenotype(genotype))
+        self[genotype] = code
+        return code
+
+class AlleleCountEngine(object):  #counts genotypes for a whole batch of data lines at once using NumPy instead of walking each sample column in Python
+
+    def __init__(self, columnGroupIndex, groupCount, delimiter = "\t"):  #takes the output column number for each sample column (from the header) and the number of output groups
+        import numpy  #loaded here so that the rest of the program can still run on systems without NumPy
+        self.numpy = numpy
+        self.delimiter = delimiter
+        self.sampleCount = len(columnGroupIndex)
+        self.groupCount = groupCount
+        self.sampleGroups = numpy.array(columnGroupIndex, dtype = numpy.int64)
+        self.runningCounts = numpy.zeros((self.groupCount, 2), dtype = numpy.int64)  #counts carry over from one line to the next exactly as the groupHash does in the scalar path
+        self.genotypeCodes = GenotypeCodes()
+        self.prefixCodes = {}  #genotype codes keyed on the first four characters of a sample column (read as a 32 bit number), for the ones where that is enough to know the whole GT value
+        self.prefixKeys = numpy.zeros(0, dtype = "<u4")  #the same thing as sorted arrays, so a whole batch can be looked up at once
+        self.prefixKeyCodes = numpy.zeros(0, dtype = numpy.int32)
+        self.firstFour = operator.itemgetter(slice(0, 4))
+        self.genotypeEnd = re.compile(r'[:\r\n]')  #the GT value runs up to the first of these
+        self.tableSize = 0
+
+    def updateTables(self, highestAltNumber):  #builds lookup tables giving, for each genotype code, how many copies of each allele it has, how many alleles were called and the highest allele number
+        numpy = self.numpy
+        calls = self.genotypeCodes.calls
+        width = max([highestAltNumber] + [max(call) for call in calls if call]) + 1
+        if len(calls) == self.tableSize and width <= self.alleleTable.shape[1]:  #nothing new since the last batch
+            return True
+        self.alleleTable = numpy.zeros((len(calls), width), dtype = numpy.int32)
+        self.calledTable = numpy.zeros(len(calls), dtype = numpy.int32)
+        self.highestTable = numpy.full(len(calls), -1, dtype = numpy.int32)
+        self.heterozygousTable = numpy.zeros(len(calls), dtype = numpy.int32)
+        for code, call in enumerate(calls):
+            if call is None:  #not called, so it adds nothing to any count
+                continue
+            for allele in call:
+                self.alleleTable[code, allele] += 1
+            self.calledTable[code] = len(call)
+            self.highestTable[code] = max(call)
+            self.heterozygousTable[code] = len(set(call)) > 1
+        self.tableSize = len(calls)
+        return True
+
+    def batchGenotypeCodes(self, batch):  #returns a (records x samples) array with the genotype code of every sample column in the batch
+        numpy = self.numpy
+        codes = numpy.empty((len(batch), self.sampleCount), dtype = numpy.int32)
+        quickLines = []
+        prefixText = []
+        for line, data in enumerate(batch):
+            if data.genotypeIndex() == 0:  #GT comes first, so calls like 0/1: can be recognized from the first four characters of the column without splitting it
+                prefixes = "".join(map(self.firstFour, data.sampleColumns))
+                if len(prefixes) == self.sampleCount * 4 and prefixes.isascii():
+                    quickLines.append(line)
+                    prefixText.append(prefixes)
+                    continue
+            codes[line] = list(map(self.genotypeCodes.__getitem__, data.genotypes()))
+        if not quickLines:
+            return self.maskGenotypes(batch, codes)
+        keys = numpy.frombuffer("".join(prefixText).encode("ascii"), dtype = "<u4").reshape(len(quickLines), self.sampleCount)  #each four character prefix read as one 32 bit number
+        quickCodes = self.lookUpPrefixes(keys)
+        unknown = quickCodes < 0
+        if numpy.any(unknown):  #prefixes we have not seen yet.  Learn each new one once, then look them all up again
+            unknownPositions = numpy.argwhere(unknown)
+            newKeys, firstIndexes = numpy.unique(keys[unknown], return_index = True)
+            for key, index in zip(newKeys.tolist(), firstIndexes.tolist()):
+                lineIndex, sample = unknownPositions[index]
+                prefix = batch[quickLines[lineIndex]].sampleColumns[sample][:4]
+                end = self.genotypeEnd.search(prefix)
+                if end:  #the whole GT value is in the prefix (a haploid call like 0:5: ends early), so the prefix is enough to look it up
+                    self.prefixCodes[key] = self.genotypeCodes[prefix[:end.start()]]
+            prefixKeys = sorted(self.prefixCodes)
+            self.prefixKeys = numpy.array(prefixKeys, dtype = "<u4")
+            self.prefixKeyCodes = numpy.array([self.prefixCodes[key] for key in prefixKeys], dtype = numpy.int32)
+            quickCodes = self.lookUpPrefixes(keys)
+            lineGenotypes = {}
+            for lineIndex, sample in numpy.argwhere(quickCodes < 0).tolist():  #what is left has GT values too long to fit in the prefix (like 10/12), so these get split out the long way
+                if lineIndex not in lineGenotypes:
+                    lineGenotypes[lineIndex] = batch[quickLines[lineIndex]].genotypes()
+                quickCodes[lineIndex, sample] = self.genotypeCodes[lineGenotypes[lineIndex][sample]]
+        codes[quickLines] = quickCodes
+        return self.maskGenotypes(batch, codes)
+
+    def maskGenotypes(self, batch, codes):  #swaps in the code for an uncalled genotype wherever a genotype failed the DP or GQ checks
+        maskedLines = [line for line, data in enumerate(batch) if data.genotypeMask is not None]
+        if not maskedLines:
+            return codes
+        numpy = self.numpy
+        passed = numpy.array([batch[line].genotypeMask for line in maskedLines], dtype = bool)
+        codes[maskedLines] = numpy.where(passed, codes[maskedLines], self.genotypeCodes["."])
+        return codes
+
+    def missingCounts(self, codes):  #returns a (records x groups) array of the number of samples in each group that were not called
+        numpy = self.numpy
+        self.updateTables(1)
+        missing = self.calledTable[codes] == 0
+        lineCount = len(codes)
+        bins = ((numpy.arange(lineCount, dtype = numpy.int64)[:, None] * self.groupCount) + self.sampleGroups[None, :]).ravel()
+        return numpy.bincount(bins, weights = missing.ravel(), minlength = lineCount * self.groupCount).reshape(lineCount, self.groupCount)
+
+    def lookUpPrefixes(self, keys):  #returns the genotype code for each prefix key, or -1 for the ones we do not know
+        numpy = self.numpy
+        codes = numpy.full(keys.shape, -1, dtype = numpy.int32)
+        if len(self.prefixKeys):
+            positions = numpy.minimum(numpy.searchsorted(self.prefixKeys, keys), len(self.prefixKeys) - 1)
+            found = self.prefixKeys[positions] == keys
+            codes[found] = self.prefixKeyCodes[positions[found]]
+        return codes
+
+    def lineCounts(self, batch, splitMultiallelic = False, codes = None):  #counts every genotype in the batch with one grouped reduction and returns a (pairs x groups x 2) array of ref/alt counts, with one pair for each ALT allele reported on each line.  Takes the genotype codes for the batch if we already have them
+        numpy = self.numpy
+        if codes is None:
+            codes = self.batchGenotypeCodes(batch)
+        sourceLines = []
+        altNumbers = []
+        highestAlleles = []
+        for line, data in enumerate(batch):
+            lineAltNumbers = data.altAlleleNumbers(splitMultiallelic)
+            sourceLines += [line] * len(lineAltNumbers)
+            altNumbers += lineAltNumbers
+            highestAlleles.append(lineAltNumbers[-1])
+        self.updateTables(max(highestAlleles))
+        highestAlleles = numpy.array(highestAlleles)
+        invalid = numpy.any(self.highestTable[codes] > highestAlleles[:, None], axis = 1)  #a call using an allele number beyond the ALT alleles on the line is an error, just as in the scalar path
+        if numpy.any(invalid):
+            raise ValueError("Unexpected allele found in a genotype call for locus " + batch[int(numpy.argmax(invalid))].locus + ".")
+        pairCodes = codes[numpy.array(sourceLines, dtype = numpy.int64)]
+        altCounts = self.alleleTable[pairCodes, numpy.array(altNumbers, dtype = numpy.int64)[:, None]]  #copies of the ALT allele we are reporting in each sample
+        refCounts = self.calledTable[pairCodes] - altCounts  #everything else that was called counts toward ref, including the other ALT alleles when splitting
+        pairCount = len(altNumbers)
+        bins = ((numpy.arange(pairCount, dtype = numpy.int64)[:, None] * self.groupCount) + self.sampleGroups[None, :]).ravel()  #one bin per pair and group
+        counts = numpy.empty((pairCount * self.groupCount, 2), dtype = numpy.int64)
+        counts[:, 0] = numpy.bincount(bins, weights = refCounts.ravel(), minlength = pairCount * self.groupCount)
+        counts[:, 1] = numpy.bincount(bins, weights = altCounts.ravel(), minlength = pairCount * self.groupCount)
+        return counts.reshape(pairCount, self.groupCount, 2)
+
+    def lineStats(self, batch, lineCounts, codes, splitMultiallelic = False):  #returns a (pairs x groups x 4) array of the ref and alt counts (from lineCounts, before they are accumulated), called samples and heterozygous samples of each group on each line, with the sample counts repeated for every pair from the same line
+        numpy = self.numpy
+        lineCount = len(codes)
+        bins = ((numpy.arange(lineCount, dtype = numpy.int64)[:, None] * self.groupCount) + self.sampleGroups[None, :]).ravel()
+        sampleCounts = numpy.empty((lineCount * self.groupCount, 2), dtype = numpy.int64)
+        sampleCounts[:, 0] = numpy.bincount(bins, weights = (self.calledTable[codes] > 0).ravel(), minlength = lineCount * self.groupCount)
+        sampleCounts[:, 1] = numpy.bincount(bins, weights = self.heterozygousTable[codes].ravel(), minlength = lineCount * self.groupCount)
+        sourceLines = numpy.array([line for line, data in enumerate(batch) for altNumber in data.altAlleleNumbers(splitMultiallelic)], dtype = numpy.int64)
+        return numpy.concatenate([lineCounts, sampleCounts.reshape(lineCount, self.groupCount, 2)[sourceLines]], axis = 2)
+
+    def accumulate(self, lineCounts):  #adds the per-line counts onto everything counted on earlier lines, since counts carry over from line to line just like in the groupHash
+        if not len(lineCounts):
+            return lineCounts
+        counts = self.numpy.cumsum(lineCounts, axis = 0) + self.runningCounts
+        self.runningCounts = counts[-1].copy()
+        return counts
+
+class ProgressReporter(object):  #prints the "Processed N lines." counter at most once per interval instead of on every line
+
+    def __init__(self, interval = 1.0, checkEvery = 1024):
+        self.interval = interval
+        self.checkEvery = checkEvery  #only look at the clock every so many lines, so keeping track of progress costs next to nothing
+        self.nextCheck = 0
+        self.lastReport = time.monotonic()
+
+    def update(self, counter):
+        if counter < self.nextCheck:
+            return False
+        self.nextCheck = counter + self.checkEvery
+        now = time.monotonic()
+        if now - self.lastReport < self.interval:
+            return False
+        self.lastReport = now
+        print("Processed " + str(counter) + " lines.", end="\r")  #does not allow the print to start a new line (so the next update will overwrite the current counter)
+        return True
+
+    def finish(self, counter):
+        print("Processed " + str(counter) + " lines.")
+        return True
+
+encoderStages = ["read", "parse", "filter", "count", "render", "write"]
+stageBlockSize = 1024  #lines taken through reading, parsing and filtering together.  Small enough that the lines are still in the CPU cache when the next stage gets to them
+
+def loadCommonModule(moduleName):  #loads one of the helper modules kept in the common directory beside this program's directory.  Each is only loaded once per process, so when both programs are imported together they share it
+    if moduleName in sys.modules:
+        return sys.modules[moduleName]
+    moduleFile = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common", moduleName + ".py")
+    spec = importlib.util.spec_from_file_location(moduleName, moduleFile)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[moduleName] = module  #registered under its own name, so anything pickled from it can be found again (by worker processes, for instance)
+    spec.loader.exec_module(module)
+    return module
+
+runTools = loadCommonModule("runTools")  #the per-stage run metrics, profiling hooks and block pipeline, shared with fpkmatrixDEG
+peakMemory = runTools.peakMemory
+StageTimer = runTools.StageTimer
+startProfiler = runTools.startProfiler
+stopProfiler = runTools.stopProfiler
+BlockPipeline = runTools.BlockPipeline
+
+class BufferedFile(object):  #collects what is written to it and hands it to the file in large writes, optionally from a background thread
+
+    def __init__(self, file, bufferSize = 8388608, threaded = False):
+        self.file = file
+        self.bufferSize = bufferSize
+        self.pieces = []
+        self.size = 0
+        self.queue = None
+        self.error = None
+        if threaded:
+            import threading
+            import queue
+            self.queue = queue.Queue(maxsize = 4)  #only a few buffers can be waiting at once, so a slow disk holds up counting instead of filling memory
+            self.thread = threading.Thread(target = self.writeLoop, daemon = True)
+            self.thread.start()
+
+    def writeLoop(self):  #runs in the background thread, writing out each buffer in the order it was queued
+        while True:
+            data = self.queue.get()
+            try:
+                if data is not None and not self.error:
+                    self.file.write(data)
+            except Exception as error:  #hold on to the error so that the main thread can raise it
+                self.error = error
+            self.queue.task_done()
+            if data is None:
+                return
+
+    def checkError(self):
+        if self.error:
+            raise self.error
+
+    def write(self, data):
+        self.pieces.append(data)
+        self.size += len(data)
+        if self.size >= self.bufferSize:
+            self.flush()
+        return True
+
+    def flush(self):  #sends the buffer off to be written
+        if not self.pieces:
+            return True
+        data = self.pieces[0][:0].join(self.pieces)  #joining with an empty piece of the same type works for both text and bytes
+        self.pieces = []
+        self.size = 0
+        if self.queue:
+            self.checkError()
+            self.queue.put(data)
+        else:
+            self.file.write(data)
+        return True
+
+    def sync(self):  #flushes the buffer and waits for the background thread to finish writing, so the file itself can be used directly
+        self.flush()
+        if self.queue:
+            self.queue.join()
+            self.checkError()
+        self.file.flush()
+        return True
+
+    def close(self):
+        self.flush()
+        if self.queue:
+            self.queue.put(None)
+            self.thread.join()
+        self.file.close()
+        self.checkError()
+
+class TextOutput(object):  #writes the tab-delimited .counts matrix and .loci list
+
+    def __init__(self, matrixFileName, lociFileName, delimiter = "\t", bufferSize = 8388608, threaded = False, timer = None):
+        self.delimiter = delimiter
+        self.timer = timer or StageTimer(encoderStages, False)
+        self.frequencyMatrix = BufferedFile(open(matrixFileName, 'w'), bufferSize, threaded)
+        self.locusList = BufferedFile(open(lociFileName, 'w'), bufferSize, threaded)
+
+    def writeHeader(self, groups):
+        delimiter = self.delimiter
+        self.locusList.write("contig" + delimiter + "position" + delimiter + "allele" + delimiter + delimiter.join(groups) + "\n") #writes the column names (including group IDs) to the locus file
+        return True
+
+    def renderRecords(self, loci, counts):  #turns a list of (contig, position, ref allele, alt allele) loci and their (records x groups x 2) array of accumulated counts (or the same as nested lists, from counting without NumPy) into the text for the .counts and .loci files
+        delimiter = self.delimiter
+        countLines = []
+        locusLines = []
+        if not isinstance(counts, list):
+            counts = counts.tolist()
+        for locus, groupCounts in zip(loci, counts):
+            countLines.append(delimiter.join([str(alleleCounts[0]) for alleleCounts in groupCounts]) + delimiter + "\n")  #the scalar path ends each line with a delimiter, so we do the same
+            countLines.append(delimiter.join([str(alleleCounts[1]) for alleleCounts in groupCounts]) + delimiter + "\n")
+            locusLines.append(locus[0] + delimiter + locus[1] + delimiter + locus[2] + "\n" + locus[0] + delimiter + locus[1] + delimiter + locus[3] + "\n")
+        return ("".join(countLines), "".join(locusLines))
+
+    def writeRecords(self, loci, counts):  #writes a list of loci along with their array of accumulated counts
+        started = self.timer.start()
+        countText, locusText = self.renderRecords(loci, counts)
+        started = self.timer.stop("render", started, len(loci))
+        self.frequencyMatrix.write(countText)
+        self.locusList.write(locusText)
+        self.timer.stop("write", started, len(loci))
+        return True
+
+    def close(self):
+        started = self.timer.start()
+        self.frequencyMatrix.close()
+        self.locusList.close()
+        self.timer.stop("write", started)
+
+class BinaryOutput(object):  #writes the counts as a .npy matrix (one row per allele, ref and alt rows alternating like the text matrix, one column per group) that can be memory mapped, with the groups and loci in a JSON sidecar
+
+    headerSize = 128  #space saved at the start of the .npy file for its header, which we can only fill in once we know how many rows there are
+
+    def __init__(self, matrixFileName, sidecarFileName, vcfFileName, bufferSize = 8388608, threaded = False, timer = None):
+        import numpy
+        import json
+        self.timer = timer or StageTimer(encoderStages, False)
+        self.numpy = numpy
+        self.json = json
+        self.matrixFileName = matrixFileName
+        self.matrix = BufferedFile(open(matrixFileName, 'w+b'), bufferSize, threaded)
+        self.matrix.write(b" " * self.headerSize)
+        self.dtype = numpy.dtype("<u4")  #32 bits is plenty for most runs.  If the counts outgrow it we switch the file over to 64 bits
+        self.rows = 0
+        self.groupCount = 0
+        self.sidecar = BufferedFile(open(sidecarFileName, 'w'), bufferSize, threaded)
+        self.sidecar.write('{"source": ' + json.dumps(vcfFileName) + ', "matrix": ' + json.dumps(os.path.basename(matrixFileName)) + ', "rows": "ref and alt allele rows alternate, two rows per locus"')
+        self.firstLocus = True
+
+    def writeHeader(self, groups):
+        self.groupCount = len(groups)
+        self.sidecar.write(', "groups": ' + self.json.dumps(groups) + ', "loci": [')  #loci are written as [contig, position, ref, alt], one per pair of rows
+        return True
+
+    def widen(self):  #rewrites everything written so far as 64 bit counts
+        numpy = self.numpy
+        self.matrix.sync()
+        oldCounts = numpy.fromfile(self.matrixFileName, dtype = self.dtype, offset = self.headerSize)
+        self.dtype = numpy.dtype("<u8")
+        self.matrix.file.seek(self.headerSize)
+        oldCounts.astype(self.dtype).tofile(self.matrix.file)
+        return True
+
+    def writeRecords(self, loci, counts):  #writes a list of (contig, position, ref allele, alt allele) loci along with their (records x groups x 2) array of accumulated counts
+        if not len(loci):
+            return True
+        started = self.timer.start()
+        if self.dtype.itemsize == 4 and counts[-1].max() > 0xffffffff:  #counts only ever go up, so the last line has the largest values
+            self.widen()
+        rows = counts.transpose(0, 2, 1).reshape(-1, self.groupCount)  #puts each locus's ref counts on one row and its alt counts on the next
+        matrixBytes = self.numpy.ascontiguousarray(rows, dtype = self.dtype).tobytes()
+        lociText = ", ".join([self.json.dumps([contig, int(position), refAllele, altAllele]) for contig, position, refAllele, altAllele in loci])
+        if self.firstLocus:
+            self.firstLocus = False
+        else:
+            lociText = ", " + lociText
+        started = self.timer.stop("render", started, len(loci))
+        self.matrix.write(matrixBytes)
+        self.rows += len(rows)
+        self.sidecar.write(lociText)
+        self.timer.stop("write", started, len(loci))
+        return True
+
+    def close(self):  #fills in the .npy header now that we know the shape of the matrix
+        started = self.timer.start()
+        header = "{'descr': '" + self.dtype.str + "', 'fortran_order': False, 'shape': (" + str(self.rows) + ", " + str(self.groupCount) + "), }"
+        header = b"\x93NUMPY\x01\x00" + (self.headerSize - 10).to_bytes(2, "little") + header.ljust(self.headerSize - 11).encode("latin1") + b"\n"
+        self.matrix.sync()
+        self.matrix.file.seek(0)
+        self.matrix.file.write(header)
+        self.matrix.close()
+        self.sidecar.write('], "shape": [' + str(self.rows) + ', ' + str(self.groupCount) + '], "dtype": "' + self.dtype.name + '"}\n')
+        self.sidecar.close()
+        self.timer.stop("write", started)
+
+def formatRate(numerator, denominator):  #a fraction for the stats files, or NA when there was nothing to take it out of
+    if not denominator:
+        return "NA"
+    return "%.6g" % (numerator / denominator)
+
+class StatsOutput(object):  #writes the per-group allele frequencies, call rates and observed heterozygosity of each line to .freq, .callrate and .het files.  They are laid out like the .counts matrix (a ref row and an alt row for each pair, one column per group), so every row lines up with the same row of the .loci file
+
+    def __init__(self, filePrefix, columnGroupIndex, groupCount, delimiter = "\t", bufferSize = 8388608, threaded = False, timer = None):
+        self.delimiter = delimiter
+        self.timer = timer or StageTimer(encoderStages, False)
+        self.groupSizes = [0] * groupCount  #samples in each group, for the call rates
+        for group in columnGroupIndex:
+            self.groupSizes[group] += 1
+        self.frequencies = BufferedFile(open(filePrefix + ".freq", 'w'), bufferSize, threaded)
+        self.callRates = BufferedFile(open(filePrefix + ".callrate", 'w'), bufferSize, threaded)
+        self.heterozygosity = BufferedFile(open(filePrefix + ".het", 'w'), bufferSize, threaded)
+
+    def renderRecords(self, stats):  #turns the (pairs x groups x 4) [ref, alt, called samples, heterozygous samples] counts into the text for each file.  Call rate and heterozygosity belong to the whole line, so both rows of a pair get the same values
+        delimiter = self.delimiter
+        frequencyLines = []
+        callRateLines = []
+        heterozygosityLines = []
+        if not isinstance(stats, list):
+            stats = stats.tolist()
+        for groupStats in stats:
+            frequencyLines.append(delimiter.join([formatRate(ref, ref + alt) for ref, alt, called, heterozygous in groupStats]) + delimiter + "\n")
+            frequencyLines.append(delimiter.join([formatRate(alt, ref + alt) for ref, alt, called, heterozygous in groupStats]) + delimiter + "\n")
+            callRateLine = delimiter.join([formatRate(counts[2], groupSize) for counts, groupSize in zip(groupStats, self.groupSizes)]) + delimiter + "\n"
+            callRateLines.append(callRateLine + callRateLine)
+            heterozygosityLine = delimiter.join([formatRate(heterozygous, called) for ref, alt, called, heterozygous in groupStats]) + delimiter + "\n"
+            heterozygosityLines.append(heterozygosityLine + heterozygosityLine)
+        return ("".join(frequencyLines), "".join(callRateLines), "".join(heterozygosityLines))
+
+    def writeRecords(self, stats):
+        started = self.timer.start()
+        frequencyText, callRateText, heterozygosityText = self.renderRecords(stats)
+        started = self.timer.stop("render", started, len(stats))
+        self.frequencies.write(frequencyText)
+        self.callRates.write(callRateText)
+        self.heterozygosity.write(heterozygosityText)
+        self.timer.stop("write", started, len(stats))
+        return True
+
+    def close(self):
+        started = self.timer.start()
+        self.frequencies.close()
+        self.callRates.close()
+        self.heterozygosity.close()
+        self.timer.stop("write", started)
+
+def createOutput(args, timer = None):  #opens the outputs in the format the user asked for
+    if args.outputFormat == "npy":
+        return BinaryOutput(args.outputMatrix, args.outputSidecar, args.VCF, args.bufferSize, args.writerThread, timer)
+    return TextOutput(args.outputMatrix, args.outputLoci, args.delimiter, args.bufferSize, args.writerThread, timer)
+
+def createStatsOutput(args, header, timer = None):  #opens the per-group statistics files if we were asked for them
+    if not args.groupStats:
+        return None
+    return StatsOutput(args.VCF, header.columnGroupIndex, len(header.outputGroupColumns), args.delimiter, args.bufferSize, args.writerThread, timer)
+
+def checkDataLine(data, header, splitMultiallelic = False):  #runs the checks that decide if a data line gets counted.  Returns None if the line passed or the warning to give the user if it did not
+    if not data.integrityCheck(header.columnGroupIDs):  #if the line fails integrity check (wrong number of columns, probably due to a corruption of the file)
+        return "Warning: Incorrect number of columns found for locus " + data.locus + ".  Skipping this locus."
+    if not splitMultiallelic and not data.isBiallelic():  #if the line is not for a biallelic locus
+        return "Warning: Multiple alternative alleles found for locus " + data.locus + ".  Skipping this locus."
+    return None
+
+filterReasons = ["FILTER", "QUAL", "missing rate"]  #the reasons a RecordFilter drops a record, in the order we report them
+
+class RecordFilter(object):  #the optional site and genotype quality checks.  Site checks look only at the QUAL and FILTER columns of the raw line, so a record that fails them never has its sample columns split, and the genotype checks only split each sample column as far as the DP and GQ values
+
+    def __init__(self, passOnly = False, minQual = None, minDP = None, minGQ = None, maxMissingRate = None):
+        self.passOnly = passOnly
+        self.minQual = minQual
+        self.minDP = minDP
+        self.minGQ = minGQ
+        self.maxMissingRate = maxMissingRate
+        self.genotypeThresholds = [(field, threshold) for field, threshold in [("DP", minDP), ("GQ", minGQ)] if threshold is not None]
+        self.siteChecks = passOnly or minQual is not None
+        self.genotypeChecks = bool(self.genotypeThresholds)
+        self.active = self.siteChecks or self.genotypeChecks or maxMissingRate is not None
+        self.groupLimits = None
+
+    def settings(self):
+        return {"passOnly" : self.passOnly, "minQual" : self.minQual, "minDP" : self.minDP, "minGQ" : self.minGQ, "maxMissingRate" : self.maxMissingRate}
+
+    def prepare(self, columnGroupIndex, groupCount):  #works out how many samples can be missing from each group before a record is dropped
+        if self.maxMissingRate is None:
+            return False
+        groupSizes = [0] * groupCount
+        for group in columnGroupIndex:
+            groupSizes[group] += 1
+        self.groupLimits = [self.maxMissingRate * size for size in groupSizes]
+        return True
+
+    def checkSite(self, line):  #returns the reason a raw data line fails the site checks, or None if it passes
+        fields = line.split("\t", 7)  #only the columns up to FILTER get split off
+        if len(fields) < 8:  #too short to check, so leave it to the integrity check
+            return None
+        if self.passOnly and fields[6] != "PASS":
+            return "FILTER"
+        if self.minQual is not None:
+            try:
+                if float(fields[5]) < self.minQual:
+                    return "QUAL"
+            except ValueError:  #a missing (.) QUAL
+                return "QUAL"
+        return None
+
+    def genotypeMask(self, data):  #returns whether each sample's genotype passes the DP and GQ checks, or None if they all do
+        formatFields = data.variantColumns[8].split(":") if len(data.variantColumns) > 8 else []
+        checks = []
+        for field, threshold in self.genotypeThresholds:
+            if field not in formatFields:  #nobody on this line has the value, so nobody passes
+                return [False] * len(data.sampleColumns)
+            checks.append((formatFields.index(field), threshold))
+        splitCount = max([index for index, threshold in checks]) + 1  #no need to split off the fields after the last one we check
+        mask = []
+        for item in data.sampleColumns:
+            fields = item.split(":", splitCount)
+            passed = True
+            for index, threshold in checks:
+                try:
+                    if float(fields[index]) < threshold:  #float ignores the newline still on the last column
+                        passed = False
+                        break
+                except (IndexError, ValueError):  #a dropped trailing field or a missing (.) value
+                    passed = False
+                    break
+            mask.append(passed)
+        if all(mask):
+            return None
+        return mask
+
+    def passesMissingRate(self, calls, columnGroupIndex):  #checks the called genotypes (None where not called) for one record against the missing rate for each group
+        missing = [0] * len(self.groupLimits)
+        for call, group in zip(calls, columnGroupIndex):
+            if call is None:
+                missing[group] += 1
+        for missingCount, limit in zip(missing, self.groupLimits):
+            if missingCount > limit:
+                return False
+        return True
+
+    def missingRateMask(self, missingCounts, numpy):  #the same check for a (records x groups) array of missing counts.  Returns an array of whether each record passes
+        return numpy.all(missingCounts <= numpy.array(self.groupLimits), axis = 1)
+
+def vcfCompression(vcfFileName):  #looks at the first bytes of the file to tell if it is plain text, BGZF (bgzip) or plain gzip.  Returns None, "bgzf" or "gzip"
+    vcf = open(vcfFileName, 'rb')
+    start = vcf.read(18)
+    vcf.close()
+    if not start.startswith(b"\x1f\x8b"):  #every gzip file starts with these two bytes
+        return None
+    if bgzfBlockSize(start, 0):  #bgzip writes gzip members with a BC extra field holding the size of each block
+        return "bgzf"
+    return "gzip"
+
+def bgzfBlockSize(data, offset):  #returns the total size of the BGZF block whose header starts at offset in data, or 0 if there is no valid BGZF header there
+    if data[offset:offset + 4] != b"\x1f\x8b\x08\x04" or len(data) < offset + 12:  #gzip magic number, deflate compression and the extra field flag
+        return 0
+    extraLength = struct.unpack("<H", data[offset + 10:offset + 12])[0]
+    extraStart = offset + 12
+    extraEnd = extraStart + extraLength
+    if len(data) < extraEnd:
+        return 0
+    position = extraStart
+    while position + 4 <= extraEnd:  #walk through the subfields of the extra field looking for BC
+        subfieldLength = struct.unpack("<H", data[position + 2:position + 4])[0]
+        if data[position:position + 2] == b"BC" and subfieldLength == 2:
+            return struct.unpack("<H", data[position + 4:position + 6])[0] + 1
+        position += 4 + subfieldLength
+    return 0
+
+def inflateBgzfBlock(block):  #decompresses a single BGZF block and returns its bytes
+    extraLength = struct.unpack("<H", block[10:12])[0]
+    inflated = zlib.decompress(block[12 + extraLength:-8], -15)  #negative window bits because the block is raw deflate data wrapped in our own gzip header
+    if len(inflated) != struct.unpack("<I", block[-4:])[0]:  #the last four bytes of each block hold the uncompressed size
+        raise IOError('Corrupted BGZF block found.')
+    return inflated
+
+def inflateBgzfBlocks(blocks):  #decompresses a list of BGZF blocks and joins them.  zlib lets go of the GIL while it works, so several of these can run at once in threads
+    return b"".join([inflateBgzfBlock(block) for block in blocks])
+
+def readBgzfBlock(file):  #reads the next whole BGZF block from an open file, or returns an empty bytes object at the end of the file
+    start = file.read(18)
+    if not start:
+        return b""
+    blockSize = bgzfBlockSize(start, 0)
+    if not blockSize:
+        raise IOError('Invalid BGZF block found at byte ' + str(file.tell() - len(start)) + '.')
+    return start + file.read(blockSize - len(start))
+
+class BgzfReader(object):  #reads a bgzipped VCF line by line like a regular file, decompressing batches of blocks in background threads so they are ready before we need them
+
+    def __init__(self, fileName, threads = 4, blocksPerBatch = 16):
+        self.file = open(fileName, 'rb')
+        self.blocksPerBatch = blocksPerBatch
+        self.pool = None
+        self.pending = []  #batches of blocks that are being decompressed, oldest first
+        self.maxPending = 1
+        if threads > 1:
+            import concurrent.futures
+            self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+            self.maxPending = threads * 2  #keep every thread busy with one batch waiting behind it
+        self.leftover = b""  #the start of a line that was split across two batches
+        self.text = io.StringIO("")
+        self.finished = False
+        self.fillQueue()
+
+    def fillQueue(self):  #reads compressed blocks off the disk and hands them out for decompression until the queue is full
+        while not self.finished and len(self.pending) < self.maxPending:
+            blocks = []
+            while len(blocks) < self.blocksPerBatch:
+                block = readBgzfBlock(self.file)
+                if not block:
+                    self.finished = True
+                    break
+                blocks.append(block)
+            if not blocks:
+                break
+            if self.pool:
+                self.pending.append(self.pool.submit(inflateBgzfBlocks, blocks))
+            else:
+                self.pending.append(inflateBgzfBlocks(blocks))
+        return True
+
+    def nextText(self):  #takes the next decompressed batch and turns the whole lines in it into text for readline.  Returns False once there is nothing left
+        if not self.pending:
+            if not self.leftover:
+                return False
+            data = self.leftover  #the last line of the file had no newline at the end
+            self.leftover = b""
+        else:
+            data = self.pending.pop(0)
+            if self.pool:
+                data = data.result()
+            self.fillQueue()
+            data = self.leftover + data
+            lastNewline = data.rfind(b"\n")
+            self.leftover = data[lastNewline + 1:]  #hold on to anything after the last newline until the rest of that line comes in
+            data = data[:lastNewline + 1]
+        self.text = io.StringIO(data.decode(), newline = None)  #newline = None gives the same newline handling as opening a plain file for reading
+        return True
+
+    def readline(self):
+        line = self.text.readline()
+        while not line:
+            if not self.nextText():
+                return ""
+            line = self.text.readline()
+        return line
+
+    def seek(self, virtualOffset):  #jumps to a BGZF virtual offset (the block's position in the file shifted up 16 bits, plus the position within the decompressed block)
+        if self.pool:
+            for pending in self.pending:
+                pending.cancel()
+        self.pending = []
+        self.file.seek(virtualOffset >> 16)
+        block = readBgzfBlock(self.file)
+        self.finished = not block
+        self.leftover = b""
+        if block:
+            self.leftover = inflateBgzfBlock(block)[virtualOffset & 0xffff:]  #this gets put in front of the next batch, so it is split into lines along with it
+        self.text = io.StringIO("")
+        self.fillQueue()
+        return True
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown(wait = False, cancel_futures = True)
+        self.file.close()
+
+def openVCF(vcfFileName, threads = 4):  #opens a VCF for reading line by line, whether it is plain text, bgzipped or gzipped
+    compression = vcfCompression(vcfFileName)
+    if compression == "bgzf":
+        return BgzfReader(vcfFileName, threads)
+    if compression == "gzip":  #a regular gzip file is one long stream, so it has to be decompressed in order on one thread
+        import gzip
+        return gzip.open(vcfFileName, 'rt')
+    return open(vcfFileName, 'r')
+
+def parseRegion(region):  #turns contig, contig:start or contig:start-end (1-based, inclusive, commas allowed in the numbers) into a (contig, start, end) tuple
+    match = re.search(r'^(.+?)(?::([\d,]+)(?:-([\d,]+))?)?$', region.strip())
+    if not match:
+        raise ValueError('Unable to understand region: ' + region)
+    contig = match.group(1)
+    start = 1
+    end = None  #no end means the region runs to the end of the contig
+    if match.group(2):
+        start = int(match.group(2).replace(",", ""))
+    if match.group(3):
+        end = int(match.group(3).replace(",", ""))
+    if end is not None and end < start:
+        raise ValueError('Region ends before it starts: ' + region)
+    return (contig, start, end)
+
+def readRegionsBed(bedFileName):  #reads the regions from a BED file.  BED starts are 0-based and ends are exclusive, so we shift the start up by one to get 1-based, inclusive regions
+    regions = []
+    bed = open(bedFileName, 'r')
+    lineNumber = 0
+    for line in bed:
+        lineNumber += 1
+        if not line.strip() or line.startswith(("#", "track", "browser")):  #skip blank lines, comments and UCSC header lines
+            continue
+        columns = line.rstrip("\r\n").split("\t")
+        if len(columns) < 3:
+            bed.close()
+            raise ValueError('Line ' + str(lineNumber) + ' of ' + bedFileName + ' has less than 3 columns.')
+        regions.append((columns[0], int(columns[1]) + 1, int(columns[2])))
+    bed.close()
+    return regions
+
+def mergeRegions(regions):  #sorts the regions for each contig and merges any that overlap, so that no record gets read twice.  Returns a dictionary of contig to a list of (start, end)
+    merged = {}
+    for contig, start, end in regions:
+        if end is None:
+            end = float("inf")
+        merged.setdefault(contig, []).append([start, end])
+    for contig in merged:
+        intervals = sorted(merged[contig])
+        combined = [intervals[0]]
+        for start, end in intervals[1:]:
+            if start <= combined[-1][1] + 1:
+                combined[-1][1] = max(combined[-1][1], end)
+            else:
+                combined.append([start, end])
+        merged[contig] = [(start, end) for start, end in combined]
+    return merged
+
+def regionToBins(start, end, minShift, depth):  #lists every bin of a tabix/CSI binning scheme that could hold a record overlapping the 0-based, half-open region
+    bins = []
+    end -= 1
+    shift = minShift + depth * 3
+    offset = 0
+    for level in range(depth + 1):
+        bins.extend(range(offset + (start >> shift), offset + (end >> shift) + 1))
+        shift -= 3
+        offset += 1 << (level * 3)
+    return bins
+
+class TabixIndex(object):  #reads a .tbi or .csi index so we can find where in a bgzipped VCF each region starts
+
+    def __init__(self, indexFileName):
+        self.indexFileName = indexFileName
+        self.generate()
+
+    def generate(self):
+        import gzip  #index files are themselves bgzipped, which the gzip library can read from start to finish
+        indexFile = gzip.open(self.indexFileName, 'rb')
+        data = indexFile.read()
+        indexFile.close()
+        self.references = {}  #contig name to (bins, linear index).  bins maps a bin number to its list of (start, end) virtual offset chunks
+        if data[:4] == b"TBI\x01":
+            referenceCount = struct.unpack_from("<i", data, 4)[0]
+            namesLength = struct.unpack_from("<i", data, 32)[0]
+            names = data[36:36 + namesLength]
+            position = 36 + namesLength
+            self.minShift = 14  #tabix always uses 16kb bins at the lowest level and 5 levels above that
+            self.depth = 5
+            csi = False
+        elif data[:4] == b"CSI\x01":
+            self.minShift, self.depth, auxLength = struct.unpack_from("<3i", data, 4)
+            aux = data[16:16 + auxLength]  #for a VCF this holds the same header as a tabix index, starting with the column settings
+            namesLength = struct.unpack_from("<i", aux, 24)[0]
+            names = aux[28:28 + namesLength]
+            position = 16 + auxLength
+            referenceCount = struct.unpack_from("<i", data, position)[0]
+            position += 4
+            csi = True
+        else:
+            raise IOError('Unrecognized index file format: ' + self.indexFileName)
+        self.contigs = [name.decode() for name in names.split(b"\x00")[:referenceCount]]
+        pseudoBin = ((1 << ((self.depth + 1) * 3)) - 1) // 7 + 1  #holds index metadata instead of records
+        for contig in self.contigs:
+            binCount = struct.unpack_from("<i", data, position)[0]
+            position += 4
+            bins = {}
+            for binIndex in range(binCount):
+                if csi:
+                    binNumber, minimumOffset, chunkCount = struct.unpack_from("<IQi", data, position)
+                    position += 16
+                else:
+                    binNumber, chunkCount = struct.unpack_from("<Ii", data, position)
+                    position += 8
+                offsets = struct.unpack_from("<" + str(chunkCount * 2) + "Q", data, position)
+                position += chunkCount * 16
+                if binNumber != pseudoBin:
+                    bins[binNumber] = list(zip(offsets[0::2], offsets[1::2]))
+            linear = []
+            if not csi:  #tabix also has a linear index giving the first record at or after each 16kb window
+                intervalCount = struct.unpack_from("<i", data, position)[0]
+                position += 4
+                linear = struct.unpack_from("<" + str(intervalCount) + "Q", data, position)
+                position += intervalCount * 8
+            self.references[contig] = (bins, linear)
+        return True
+
+    def seekOffset(self, contig, start, end):  #returns the virtual offset to start reading from for records in contig between start and end (1-based, inclusive), or None if there are none
+        if contig not in self.references:
+            return None
+        bins, linear = self.references[contig]
+        if end == float("inf"):
+            end = 1 << (self.minShift + self.depth * 3)  #the largest position this binning scheme can hold
+        minimumOffset = 0
+        if linear:
+            minimumOffset = linear[min((start - 1) >> self.minShift, len(linear) - 1)]
+        starts = []
+        for binNumber in regionToBins(start - 1, end, self.minShift, self.depth):
+            for chunkStart, chunkEnd in bins.get(binNumber, []):
+                if chunkEnd > minimumOffset:  #anything ending before the linear index offset is all records that finish before our region
+                    starts.append(chunkStart)
+        if not starts:
+            return None
+        return min(starts)
+
+def scanLineOffsets(vcfFileName, compression):  #yields (offset, line) for every line in a plain or bgzipped VCF, with byte offsets for plain files and virtual offsets for bgzipped ones
+    vcf = open(vcfFileName, 'rb')
+    if compression != "bgzf":
+        offset = 0
+        for line in vcf:
+            yield (offset, line)
+            offset += len(line)
+        vcf.close()
+        return
+    pending = b""  #a line that started in an earlier block
+    pendingOffset = None
+    blockStart = vcf.tell()
+    block = readBgzfBlock(vcf)
+    while block:
+        data = inflateBgzfBlock(block)
+        position = 0
+        while position < len(data):
+            if pendingOffset is None:
+                pendingOffset = (blockStart << 16) | position
+            newline = data.find(b"\n", position)
+            if newline == -1:
+                pending += data[position:]
+                break
+            yield (pendingOffset, pending + data[position:newline + 1])
+            pending = b""
+            pendingOffset = None
+            position = newline + 1
+        blockStart = vcf.tell()
+        block = readBgzfBlock(vcf)
+    if pending:
+        yield (pendingOffset, pending)
+    vcf.close()
+
+class LocusIndex(object):  #our own lightweight index for files without a tabix index.  Stores the offset of the first record of each contig and of every few thousandth record after that, and is saved next to the VCF as .bnvidx
+
+    def __init__(self, vcfFileName, compression, spacing = 4096, verbose = True):
+        self.vcfFileName = vcfFileName
+        self.compression = compression
+        self.spacing = spacing
+        self.verbose = verbose
+        self.indexFileName = vcfFileName + ".bnvidx"
+        stats = os.stat(vcfFileName)
+        self.fingerprint = str(stats.st_size) + "\t" + str(stats.st_mtime_ns)  #if the VCF changes size or modification time, the index is rebuilt.  Nanoseconds, so a file rewritten within the same second is still caught
+        if not self.load():
+            self.generate()
+            self.save()
+
+    def generate(self):  #reads through the whole VCF once, noting where the sampled records are
+        if self.verbose:
+            print("Building locus index for " + self.vcfFileName + ".")
+        self.contigs = []
+        self.samples = {}  #contig to a list of (position, offset) pairs in file order
+        sinceLastSample = 0
+        lastContig = None
+        for offset, line in scanLineOffsets(self.vcfFileName, self.compression):
+            if line.startswith(b"#"):
+                continue
+            columns = line.split(b"\t", 2)
+            if len(columns) < 3:
+                continue
+            contig = columns[0].decode()
+            if contig != lastContig or sinceLastSample >= self.spacing:
+                if contig != lastContig:
+                    self.contigs.append(contig)
+                    self.samples[contig] = []
+                self.samples[contig].append((int(columns[1]), offset))
+                lastContig = contig
+                sinceLastSample = 0
+            sinceLastSample += 1
+        return True
+
+    def load(self):  #reads a saved index.  Returns False if there is none or it was built for a different version of the file
+        if not os.path.isfile(self.indexFileName):
+            return False
+        indexFile = open(self.indexFileName, 'r')
+        if indexFile.readline().rstrip("\n") != "#" + self.fingerprint:
+            indexFile.close()
+            return False
+        self.contigs = []
+        self.samples = {}
+        for line in indexFile:
+            contig, position, offset = line.rstrip("\n").split("\t")
+            if contig not in self.samples:
+                self.contigs.append(contig)
+                self.samples[contig] = []
+            self.samples[contig].append((int(position), int(offset)))
+        indexFile.close()
+        return True
+
+    def save(self):
+        try:
+            indexFile = open(self.indexFileName, 'w')
+        except IOError:  #not being able to save the index just means we have to build it again next time
+            print("Unable to save locus index to " + self.indexFileName + ".")
+            return False
+        indexFile.write("#" + self.fingerprint + "\n")
+        for contig in self.contigs:
+            for position, offset in self.samples[contig]:
+                indexFile.write(contig + "\t" + str(position) + "\t" + str(offset) + "\n")
+        indexFile.close()
+        return True
+
+    def seekOffset(self, contig, start, end):  #returns the offset of the last sampled record before start on the contig (or the contig's first record), or None if the contig is not in the file
+        if contig not in self.samples:
+            return None
+        samples = self.samples[contig]
+        offset = samples[0][1]
+        for position, sampleOffset in samples:
+            if position >= start:  #stop before any sample at our start position, since records just before it could share that position
+                break
+            offset = sampleOffset
+        return offset
+
+def findIndex(vcfFileName, compression, verbose = True):  #returns an index for the VCF: an existing tabix or CSI index if there is one, otherwise our own (built now if needed).  Returns None for plain gzip files, which cannot be read from the middle.  With verbose set, tells the user when the index is being built or cannot be used
+    if compression == "bgzf":
+        for extension in (".tbi", ".csi"):
+            if os.path.isfile(vcfFileName + extension):
+                return TabixIndex(vcfFileName + extension)
+    if compression == "gzip":
+        if verbose:
+            print("Plain gzip files cannot be indexed (use bgzip instead).  Reading the whole file to find the regions.")
+        return None
+    return LocusIndex(vcfFileName, compression, verbose = verbose)
+
+class RegionReader(object):  #reads only the header lines and the records inside a set of regions, using an index to jump straight to each region.  Works like a file opened for reading, so the main loop does not need to know it is there
+
+    def __init__(self, vcfFileName, regions, threads = 4, verbose = True):  #with verbose set, prints the index messages and warnings the way the program does
+        self.vcfFileName = vcfFileName
+        self.regions = mergeRegions(regions)
+        self.verbose = verbose
+        self.compression = vcfCompression(vcfFileName)
+        self.index = findIndex(vcfFileName, self.compression, verbose)
+        self.vcf = openVCF(vcfFileName, threads)
+        self.lines = self.generate()
+
+    def inRegion(self, line):  #returns the contig of the record and True if its position is in one of our regions on that contig
+        columns = line.split("\t", 2)
+        if len(columns) < 2 or columns[0] not in self.regions:
+            return (columns[0], False)
+        position = int(columns[1])
+        for start, end in self.regions[columns[0]]:
+            if start <= position <= end:
+                return (columns[0], True)
+        return (columns[0], False)
+
+    def generate(self):  #yields the header lines, then the records in each region in the order their contigs appear in the file
+        line = self.vcf.readline()
+        while line and line.startswith("#"):
+            yield line
+            line = self.vcf.readline()
+        if not self.index:  #without an index all we can do is filter every line
+            while line:
+                if self.inRegion(line)[1]:
+                    yield line
+                line = self.vcf.readline()
+            return
+        for contig in self.index.contigs:
+            if contig not in self.regions:
+                continue
+            for start, end in self.regions[contig]:
+                offset = self.index.seekOffset(contig, start, end)
+                if offset is None:
+                    continue
+                self.seek(offset)
+                line = self.vcf.readline()
+                while line:
+                    lineContig, keep = self.inRegion(line)
+                    if lineContig != contig or int(line.split("\t", 2)[1]) > end:  #records are sorted, so we are past the end of the region
+                        break
+                    if keep:
+                        yield line
+                    line = self.vcf.readline()
+        for contig in self.regions:
+            if contig not in self.index.contigs and self.verbose:
+                print("Warning: Contig " + contig + " was not found in the index for " + self.vcfFileName + ".")
+
+    def seek(self, offset):
+        if self.compression == "bgzf":
+            self.vcf.seek(offset)
+        else:
+            self.vcf.close()
+            raw = open(self.vcfFileName, 'rb')
+            raw.seek(offset)
+            self.vcf = io.TextIOWrapper(raw)  #wrap the binary file so the byte offset from the index is where reading starts
+        return True
+
+    def readline(self):
+        return next(self.lines, "")
+
+    def close(self):
+        self.vcf.close()
+
+class VCFEncoder(object):  #counts the genotypes in a VCF by group and hands the counts back batch by batch, for using the encoder from other Python code without going through files.  The header is read when the encoder is made, so the groups are known right away
+    
+    def __init__(self, vcfFileName, useUnidentifiableGroup = False, sampleGroups = None, splitMultiallelic = False, regions = None, batchSize = 10000, scalar = False, decompressionThreads = 4, verbose = False, progressInterval = 1.0, timer = None, recordFilter = None, groupStats = False):  #regions is a list of (contig, start, end) tuples like parseRegion gives.  With verbose set, prints the progress and warnings the way the program does.  timer is a StageTimer to time the stages of the run with, and recordFilter a RecordFilter with the quality checks to apply.  With groupStats set, each batch also comes with the counts for the per-group statistics of every pair
+        self.groupStats = groupStats
+        self.timer = timer or StageTimer(encoderStages, False)
+        self.recordFilter = recordFilter or RecordFilter()
+        self.rejected = dict.fromkeys(filterReasons, 0)  #records dropped by the record filter, by reason
+        self.splitMultiallelic = splitMultiallelic
+        self.batchSize = batchSize
+        self.verbose = verbose
+        self.skippedLines = 0  #data lines that failed a check and were not counted
+        self.counter = 0  #lines read so far
+        self.progress = None
+        if verbose:
+            self.progress = ProgressReporter(progressInterval)
+        if regions:
+            self.vcf = RegionReader(vcfFileName, regions, decompressionThreads, verbose)  #only hands back the header lines and the records in our regions
+        else:
+            self.vcf = openVCF(vcfFileName, decompressionThreads)  #open the VCF for reading (decompressing it on the fly if it was gzipped)
+        self.header, self.line, self.counter = readOpenHeader(self.vcf, useUnidentifiableGroup, sampleGroups)  #self.line is the first data line, where batches picks up
+        if self.progress:
+            self.progress.update(self.counter)
+        if not self.header:
+            self.vcf.close()
+            raise RuntimeError('Unable to find a header line in ' + vcfFileName + '.')
+        self.groups = self.header.outputGroupColumns
+        self.recordFilter.prepare(self.header.columnGroupIndex, len(self.groups))
+        self.engine = createEngine(self.header, scalar, "\t", verbose)
+        self.closed = False
+
+    def countLine(self):
+        self.counter += 1
+        if self.progress:
+            self.progress.update(self.counter)
+
+    def batches(self):  #yields (loci, counts) for each batch of data lines: the (contig, position, ref allele, alt allele) of each ref/alt pair and the counts so far for each group, as a (pairs x groups x 2) NumPy array, or as nested lists when counting without NumPy.  Counts carry over from line to line, just like in the .counts file.  With groupStats set, a third item holds the [ref, alt, called samples, heterozygous samples] counts of each group for just that line, laid out the same way
+        timer = self.timer
+        recordFilter = self.recordFilter
+        line = self.line
+        while line:
+            batch = []
+            while line and len(batch) < self.batchSize:
+                started = timer.start()
+                lines = []
+                blockSize = min(stageBlockSize, self.batchSize - len(batch))
+                while line and len(lines) < blockSize:  #read a block of lines, then take them through parsing and filtering together
+                    self.countLine()
+                    if line[0] != "#":  #skips any stray header lines in the body
+                        lines.append(line)
+                    line = self.vcf.readline()
+                started = timer.stop("read", started, len(lines))
+                if recordFilter.siteChecks:  #before any of the sample columns get split
+                    checked = len(lines)
+                    lines = self.checkSites(lines)
+                    started = timer.stop("filter", started, checked - len(lines))  #the ones that pass get counted with the rest of the checks
+                lines = [Data(text) for text in lines]  #initialize an object to handle each data line
+                started = timer.stop("parse", started, len(lines))
+                for data in lines:
+                    warning = checkDataLine(data, self.header, self.splitMultiallelic)
+                    if warning:  #if the line failed one of our checks, it does not get counted
+                        self.skippedLines += 1
+                        if self.verbose:
+                            print(warning)
+                    else:
+                        if recordFilter.genotypeChecks:
+                            data.genotypeMask = recordFilter.genotypeMask(data)
+                        batch.append(data)  #hold on to the line until we have a full batch to count
+                timer.stop("filter", started, len(lines))
+            if batch:
+                started = timer.start()
+                result = self.countBatch(batch)
+                timer.stop("count", started, len(batch))
+                if result[0]:  #everything in the batch may have been over the missing rate
+                    yield result
+        self.line = line
+        self.close()
+
+    def checkSites(self, lines):  #returns the raw data lines that pass the site checks, counting up the ones that do not
+        passed = []
+        checkSite = self.recordFilter.checkSite
+        for line in lines:
+            reason = checkSite(line)
+            if reason:
+                self.rejected[reason] += 1
+            else:
+                passed.append(line)
+        return passed
+
+    def countBatch(self, batch):  #counts a batch of data lines (vectorized if we have an engine, one at a time if not) and returns its loci and counts in their original order
+        loci = []
+        recordFilter = self.recordFilter
+        if self.engine:
+            engine = self.engine
+            codes = engine.batchGenotypeCodes(batch)
+            if recordFilter.maxMissingRate is not None:
+                passed = recordFilter.missingRateMask(engine.missingCounts(codes), engine.numpy)
+                if not passed.all():
+                    self.rejected["missing rate"] += len(batch) - int(passed.sum())
+                    batch = [data for data, keep in zip(batch, passed.tolist()) if keep]
+                    codes = codes[passed]
+            for data in batch:
+                data.createLocusInfoOutputs("\t", self.splitMultiallelic)
+                loci += data.lociFields
+            if not batch:
+                return (loci, engine.numpy.zeros((0, len(self.groups), 2), dtype = engine.numpy.int64))
+            lineCounts = engine.lineCounts(batch, self.splitMultiallelic, codes)
+            if self.groupStats:
+                return (loci, engine.accumulate(lineCounts), engine.lineStats(batch, lineCounts, codes, self.splitMultiallelic))
+            return (loci, engine.accumulate(lineCounts))
+        counts = []
+        stats = []
+        for data in batch:
+            calls = data.calledGenotypes()
+            if recordFilter.maxMissingRate is not None and not recordFilter.passesMissingRate(calls, self.header.columnGroupIndex):
+                self.rejected["missing rate"] += 1
+                continue
+            counts += data.countAlleles(self.header.columnGroupIndex, self.header.groupCounts, self.splitMultiallelic, calls)
+            if self.groupStats:
+                stats += data.lineStats(self.header.columnGroupIndex, len(self.groups), self.splitMultiallelic, calls)
+            data.createLocusInfoOutputs("\t", self.splitMultiallelic)
+            loci += data.lociFields
+        if self.groupStats:
+            return (loci, counts, stats)
+        return (loci, counts)
+
+    def records(self):  #yields (contig, position, ref allele, alt allele, counts) for each ref/alt pair, with the counts as a list of [ref, alt] counts for each group.  With groupStats set, the list of [ref, alt, called samples, heterozygous samples] counts for each group comes after the counts
+        for result in self.batches():
+            parts = [part if isinstance(part, list) else part.tolist() for part in result[1:]]  #the counts, and the stats if we have them
+            for locus, groupCounts in zip(result[0], zip(*parts)):
+                yield locus + groupCounts
+
+    def arrays(self):  #counts the whole VCF and returns (loci, counts), with the counts for every pair in one (pairs x groups x 2) NumPy array (or nested lists when counting without NumPy).  With groupStats set, returns (loci, counts, stats), with the stats in a (pairs x groups x 4) array
+        loci = []
+        blocks = []
+        statBlocks = []
+        for result in self.batches():
+            loci += result[0]
+            blocks.append(result[1])
+            if self.groupStats:
+                statBlocks.append(result[2])
+        if not self.engine:
+            parts = [blocks] + [statBlocks] * self.groupStats
+            return (loci,) + tuple([[pairCounts for counts in part for pairCounts in counts] for part in parts])
+        numpy = self.engine.numpy
+        parts = [(blocks, 2)] + [(statBlocks, 4)] * self.groupStats
+        return (loci,) + tuple([numpy.concatenate(part) if part else numpy.zeros((0, len(self.groups), width), dtype = numpy.int64) for part, width in parts])
+
+    def close(self):
+        if self.closed:
+            return False
+        self.closed = True
+        self.vcf.close()
+        if self.progress:
+            self.progress.finish(self.counter)
+        if self.verbose:
+            reportRejected(self.rejected)
+        return True
+
+def reportRejected(rejected):  #tells the user how many records the record filter dropped, if any
+    if not sum(rejected.values()):
+        return False
+    print("Filtered out " + str(sum(rejected.values())) + " records (" + ", ".join([str(rejected[reason]) + " on " + reason for reason in filterReasons if rejected[reason]]) + ").")
+    return True
+
+def encodeRecords(vcfFileName, **options):  #yields the (contig, position, ref allele, alt allele, counts) records for a VCF.  Takes the same options as VCFEncoder
+    return VCFEncoder(vcfFileName, **options).records()
+
+def encodeArrays(vcfFileName, **options):  #counts a whole VCF and returns (groups, loci, counts), or (groups, loci, counts, stats) with groupStats set.  Takes the same options as VCFEncoder
+    encoder = VCFEncoder(vcfFileName, **options)
+    return (encoder.groups,) + encoder.arrays()
+
+def createEngine(header, scalar = False, delimiter = "\t", verbose = True):  #returns a vectorized counting engine, or None if we should (or have to) count one line at a time
+    if scalar:
+        return None
+    try:
+        return AlleleCountEngine(header.columnGroupIndex, len(header.outputGroupColumns), delimiter)
+    except ImportError:
+        if verbose:
+            print("NumPy is not available.  Counting genotypes one line at a time.")
+        return None
+
+def readOpenHeader(vcf, useUnidentifiable, sampleGroups = None):  #reads through the ## lines and the header line of a VCF we already have open.  Returns the header object (None if there was no header line), the first data line and the number of lines read
+    header = None
+    lineCount = 0
+    line = vcf.readline()
+    while line and line[0] == "#":
+        lineCount += 1
+        if line[1] != "#":  #the header line starts with a single #
+            header = Header(line)
+            header.generateLists(useUnidentifiable, sampleGroups)
+            line = vcf.readline()
+            break
+        line = vcf.readline()
+    return (header, line, lineCount)
+
+def readHeader(vcfFileName, useUnidentifiable, compressed = False, sampleGroups = None):  #reads through the ## lines and the header line of the VCF.  Returns the header object, the byte offset where the data lines start (None if compressed) and the number of lines read
+    if compressed:
+        vcf = openVCF(vcfFileName, 1)
+    else:
+        vcf = open(vcfFileName, 'rb')  #binary mode so that tell() gives us a real byte offset
+    lineCount = 0
+    header = None
+    line = vcf.readline()
+    while line:
+        lineCount += 1
+        if not compressed:
+            line = line.decode()
+        if line.startswith("#") and not line.startswith("##"):  #the header line starts with a single #
+            header = Header(line)
+            header.generateLists(useUnidentifiable, sampleGroups)
+            break
+        line = vcf.readline()
+    bodyStart = None
+    if not compressed:
+        bodyStart = vcf.tell()
+    vcf.close()
+    if not header:
+        raise RuntimeError('Unable to find a header line in ' + vcfFileName + '.')
+    return (header, bodyStart, lineCount)
+
+def findChunks(vcfFileName, bodyStart, chunkSize):  #splits the data lines of the VCF into (start, end) byte ranges of about chunkSize bytes that always begin at the start of a line
+    fileSize = os.path.getsize(vcfFileName)
+    boundaries = [bodyStart]
+    vcf = open(vcfFileName, 'rb')
+    position = bodyStart + chunkSize
+    while position < fileSize:
+        vcf.seek(position - 1)  #backing up one byte means that if we land right at the start of a line, readline only eats the newline before it
+        vcf.readline()  #skip forward to the start of the next line
+        position = vcf.tell()
+        if position >= fileSize:
+            break
+        boundaries.append(position)
+        position += chunkSize
+    vcf.close()
+    boundaries.append(fileSize)
+    return [(boundaries[i], boundaries[i + 1]) for i in range(len(boundaries) - 1) if boundaries[i] < boundaries[i + 1]]
+
+def findBgzfBlock(file, position, fileSize):  #finds the first BGZF block that starts at or after position.  Returns its offset or None.  A candidate only counts if another block (or the end of the file) follows right after it
+    while position < fileSize:
+        file.seek(position)
+        data = file.read(131072)
+        if not data:
+            return None
+        candidate = data.find(b"\x1f\x8b\x08\x04")
+        while candidate != -1:
+            file.seek(position + candidate)
+            header = file.read(18)
+            blockSize = bgzfBlockSize(header, 0)
+            if blockSize:
+                nextBlock = position + candidate + blockSize
+                file.seek(nextBlock)
+                if nextBlock == fileSize or bgzfBlockSize(file.read(18), 0):
+                    return position + candidate
+            candidate = data.find(b"\x1f\x8b\x08\x04", candidate + 1)
+        position += len(data) - 3  #overlap a little in case the magic number was cut off at the end of what we read
+    return None
+
+def findBgzfChunks(vcfFileName, chunkSize):  #splits a bgzipped VCF into (start, end, previous block) ranges of whole blocks about chunkSize compressed bytes long
+    fileSize = os.path.getsize(vcfFileName)
+    vcf = open(vcfFileName, 'rb')
+    boundaries = [(0, None)]
+    position = chunkSize
+    while position < fileSize:
+        previousBlock = findBgzfBlock(vcf, position, fileSize)
+        if previousBlock is None:
+            break
+        vcf.seek(previousBlock)
+        boundary = previousBlock + bgzfBlockSize(vcf.read(18), 0)  #the chunk starts at the block after the one we found, so we know which block came right before it
+        if boundary >= fileSize:
+            break
+        boundaries.append((boundary, previousBlock))
+        position = boundary + chunkSize
+    vcf.close()
+    boundaries.append((fileSize, None))
+    return [(boundaries[i][0], boundaries[i + 1][0], boundaries[i][1]) for i in range(len(boundaries) - 1)]
+
+def readBgzfChunk(vcfFileName, chunk):  #decompresses one (start, end, previous block) chunk and returns the bytes of every line that starts inside it, reading on into the next chunk to finish the last line
+    start, end, previousBlock = chunk
+    vcf = open(vcfFileName, 'rb')
+    startsLine = True
+    if previousBlock is not None:  #our first byte only starts a line if the last block of the previous chunk ended with a newline
+        vcf.seek(previousBlock)
+        startsLine = inflateBgzfBlock(readBgzfBlock(vcf)).endswith(b"\n")
+    vcf.seek(start)
+    blocks = []
+    while vcf.tell() < end:
+        blocks.append(readBgzfBlock(vcf))
+    data = inflateBgzfBlocks(blocks)
+    if not data.endswith(b"\n"):  #the last line carries on into the next chunk, so keep reading until it ends
+        tail = []
+        block = readBgzfBlock(vcf)
+        while block:
+            inflated = inflateBgzfBlock(block)
+            newline = inflated.find(b"\n")
+            if newline != -1:
+                tail.append(inflated[:newline + 1])
+                break
+            tail.append(inflated)
+            block = readBgzfBlock(vcf)
+        data += b"".join(tail)
+    vcf.close()
+    if not startsLine:  #the start of our data belongs to a line from the previous chunk, which that worker will handle
+        data = data[data.find(b"\n") + 1:] if b"\n" in data else b""
+    return data
+
+workerState = {}  #holds the header and counting engine for each worker process so they only need to be sent over once
+
+def startWorker(vcfFileName, compressed, header, batchSize, delimiter, splitMultiallelic, stateDirectory = None, measure = False, traceMemory = False, recordFilter = None, groupStats = False):  #runs once in each worker process when the pool starts (or in our own process when there is only one worker)
+    workerState["groupStats"] = groupStats
+    workerState["recordFilter"] = recordFilter or RecordFilter()
+    workerState["recordFilter"].prepare(header.columnGroupIndex, len(header.outputGroupColumns))
+    workerState["measure"] = measure
+    workerState["traceMemory"] = traceMemory
+    workerState["splitMultiallelic"] = splitMultiallelic
+    workerState["vcfFileName"] = vcfFileName
+    workerState["compressed"] = compressed
+    workerState["header"] = header
+    workerState["batchSize"] = batchSize
+    workerState["delimiter"] = delimiter
+    workerState["stateDirectory"] = stateDirectory
+    workerState["engine"] = AlleleCountEngine(header.columnGroupIndex, len(header.outputGroupColumns), delimiter)
+
+def chunkChecksum(data):  #fingerprint for the exact bytes a chunk's counts were made from
+    import hashlib
+    return hashlib.blake2b(data, digest_size = 16).hexdigest()
+
+def saveChunkCounts(stateDirectory, checksum, result, numpy):  #stores the (lines read, warnings, loci, per-line counts, records filtered out, per-line stats or None) for a chunk under its checksum
+    lineCount, warnings, loci, lineCounts, rejected, stats = result
+    chunkFile = os.path.join(stateDirectory, checksum + ".npz")
+    temporaryFile = chunkFile + "." + str(os.getpid()) + ".tmp.npz"  #written under another name first so that an interrupted run never leaves half a chunk behind
+    arrays = {"lineCount" : numpy.array(lineCount), "warnings" : numpy.array(warnings, dtype = str), "loci" : numpy.array(loci, dtype = str).reshape(-1, 4), "lineCounts" : lineCounts, "rejected" : numpy.array(rejected, dtype = numpy.int64)}
+    if stats is not None:
+        arrays["stats"] = stats
+    numpy.savez(temporaryFile, **arrays)
+    os.replace(temporaryFile, chunkFile)
+    return True
+
+def loadChunkCounts(stateDirectory, checksum, numpy, groupStats = False):  #returns the stored result for a chunk, or None if we do not have one (or it was stored without the stats we need)
+    chunkFile = os.path.join(stateDirectory, checksum + ".npz")
+    if not os.path.isfile(chunkFile):
+        return None
+    try:
+        stored = numpy.load(chunkFile, allow_pickle = False)
+        if groupStats and "stats" not in stored.files:  #counted on a run without --groupStats, so it has to be counted again
+            stored.close()
+            return None
+        rejected = [0] * len(filterReasons)
+        if "rejected" in stored.files:  #chunks stored before there was a record filter
+            rejected = stored["rejected"].tolist()
+        stats = None
+        if groupStats:
+            stats = stored["stats"]
+        result = (int(stored["lineCount"]), stored["warnings"].tolist(), stored["loci"].tolist(), stored["lineCounts"], rejected, stats)
+        stored.close()
+    except (OSError, ValueError, KeyError):  #a damaged chunk file just gets counted again
+        return None
+    return result
+
+def countChunk(task):  #runs in a worker process.  Takes a (chunk, checksum from the last run) pair, and returns (checksum, whether stored counts were used, lines read, warnings, loci, per-line counts, records filtered out, per-line stats or None, stage timings or None) for the parent to merge
+    chunk, checksum = task
+    engine = workerState["engine"]
+    stateDirectory = workerState["stateDirectory"]
+    timer = StageTimer(encoderStages, workerState["measure"], workerState["traceMemory"])  #a fresh one for each chunk, so the parent can just add them up
+    stages = timer.stages if timer.enabled else None
+    started = timer.start()
+    if checksum:  #the file has not changed since the last run, so we can use the stored counts without even reading the chunk
+        result = loadChunkCounts(stateDirectory, checksum, engine.numpy, workerState["groupStats"])
+        if result:
+            timer.stop("read", started, result[0])
+            return (checksum, True) + result + (stages,)
+    if workerState["compressed"]:
+        data = readBgzfChunk(workerState["vcfFileName"], chunk)
+    else:
+        vcf = open(workerState["vcfFileName"], 'rb')
+        vcf.seek(chunk[0])
+        data = vcf.read(chunk[1] - chunk[0])
+        vcf.close()
+    if stateDirectory:
+        checksum = chunkChecksum(data)
+        result = loadChunkCounts(stateDirectory, checksum, engine.numpy, workerState["groupStats"])  #the file changed, but maybe not in this chunk
+        if result:
+            timer.stop("read", started, result[0])
+            return (checksum, True) + result + (stages,)
+    timer.stop("read", started)
+    result = countChunkLines(data.decode(), timer)
+    if stateDirectory:
+        started = timer.start()
+        saveChunkCounts(stateDirectory, checksum, result, engine.numpy)
+        timer.stop("write", started)
+    return (checksum, False) + result + (stages,)
+
+def countChunkLines(text, timer = None):  #parses and counts the lines in one chunk of the VCF and returns (lines read, warnings, loci, per-line counts, records filtered out for each of the filterReasons, per-line stats or None)
+    header = workerState["header"]
+    engine = workerState["engine"]
+    delimiter = workerState["delimiter"]
+    splitMultiallelic = workerState["splitMultiallelic"]
+    timer = timer or StageTimer(encoderStages, False)
+    recordFilter = workerState["recordFilter"]
+    rejected = dict.fromkeys(filterReasons, 0)
+    batchSize = workerState["batchSize"]
+    lineCount = 0
+    warnings = []
+    loci = []
+    lineCounts = []
+    stats = []
+    lineReader = io.StringIO(text, newline = None)  #reading the text like a file gives us the same lines (and newline handling) as the serial readline loop
+    finished = False
+    while not finished:
+        batch = []
+        while len(batch) < batchSize:
+            started = timer.start()
+            lines = list(itertools.islice(lineReader, min(stageBlockSize, batchSize - len(batch))))
+            if not lines:
+                finished = True
+                break
+            lineCount += len(lines)
+            lines = [line for line in lines if line[0] != '#']
+            started = timer.stop("read", started, len(lines))
+            if recordFilter.siteChecks:
+                checked = len(lines)
+                passed = []
+                for line in lines:
+                    reason = recordFilter.checkSite(line)
+                    if reason:
+                        rejected[reason] += 1
+                    else:
+                        passed.append(line)
+                lines = passed
+                started = timer.stop("filter", started, checked - len(lines))
+            lines = [Data(line) for line in lines]
+            started = timer.stop("parse", started, len(lines))
+            for data in lines:
+                warning = checkDataLine(data, header, splitMultiallelic)
+                if warning:
+                    warnings.append(warning)  #hold on to the warning so the parent can report it in order
+                    continue
+                if recordFilter.genotypeChecks:
+                    data.genotypeMask = recordFilter.genotypeMask(data)
+                batch.append(data)
+            timer.stop("filter", started, len(lines))
+        if batch:
+            started = timer.start()
+            codes = engine.batchGenotypeCodes(batch)
+            if recordFilter.maxMissingRate is not None:
+                passed = recordFilter.missingRateMask(engine.missingCounts(codes), engine.numpy)
+                if not passed.all():
+                    rejected["missing rate"] += len(batch) - int(passed.sum())
+                    batch = [data for data, keep in zip(batch, passed.tolist()) if keep]
+                    codes = codes[passed]
+            if not batch:
+                timer.stop("count", started)
+                continue
+            for data in batch:
+                data.createLocusInfoOutputs(delimiter, splitMultiallelic)
+                loci += data.lociFields
+            lineCounts.append(engine.lineCounts(batch, splitMultiallelic, codes))
+            if workerState["groupStats"]:
+                stats.append(engine.lineStats(batch, lineCounts[-1], codes, splitMultiallelic))
+            timer.stop("count", started, len(batch))
+    numpy = engine.numpy
+    if lineCounts:
+        lineCounts = numpy.concatenate(lineCounts)
+    else:
+        lineCounts = numpy.zeros((0, engine.groupCount, 2), dtype = numpy.int64)
+    if not workerState["groupStats"]:
+        stats = None
+    elif stats:
+        stats = numpy.concatenate(stats)
+    else:
+        stats = numpy.zeros((0, engine.groupCount, 4), dtype = numpy.int64)
+    return (lineCount, warnings, loci, lineCounts, [rejected[reason] for reason in filterReasons], stats)
+
+class EncodingState(object):  #keeps the per-chunk counts from earlier runs in a directory next to the VCF, so that a rerun on a grown file only has to count the chunks that changed
+    
+    def __init__(self, directory, settings, fileFingerprint):
+        import json
+        self.json = json
+        self.directory = directory
+        self.settings = settings  #everything besides the data lines that goes into the counts: samples, groups and options
+        self.fileFingerprint = fileFingerprint
+        self.knownChecksums = {}  #chunk to checksum from the last run, only used if the file looks untouched since then
+        stateFile = os.path.join(directory, "state.json")
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+            return
+        try:
+            with open(stateFile) as stateInput:
+                state = json.load(stateInput)
+        except (OSError, ValueError):
+            state = {}
+        if state.get("settings") != settings:  #new samples, new groups or different options change the counts of every record, so none of the stored chunks can be used
+            self.removeChunks(set())
+        elif state.get("file") == fileFingerprint:
+            for chunk, checksum in state["chunks"]:
+                self.knownChecksums[tuple(chunk)] = checksum
+
+    def removeChunks(self, keep):  #deletes stored chunks that are not in the keep set
+        for item in os.listdir(self.directory):
+            if item.endswith(".npz") and item[:-4] not in keep:
+                os.remove(os.path.join(self.directory, item))
+        return True
+
+    def save(self, chunkChecksums):  #records the chunks of this run and clears out the ones that are no longer part of the file
+        stateFile = os.path.join(self.directory, "state.json")
+        state = {"settings" : self.settings, "file" : self.fileFingerprint, "chunks" : chunkChecksums}
+        stateOutput = open(stateFile + ".tmp", 'w')
+        self.json.dump(state, stateOutput)
+        stateOutput.close()
+        os.replace(stateFile + ".tmp", stateFile)
+        self.removeChunks(set([checksum for chunk, checksum in chunkChecksums]))
+        return True
+
+def encodingSettings(args, header, compression):  #the parts of a run that must match for stored counts to be reused
+    settings = {"samples" : [sample.strip() for sample in header.sampleColumns], "groups" : header.outputGroupColumns, "columnGroupIndex" : header.columnGroupIndex, "splitMultiallelic" : args.splitMultiallelic, "compression" : compression}
+    if args.recordFilter.active:  #left out otherwise, so stored counts from before there were filters still match
+        settings["filters"] = args.recordFilter.settings()
+    return settings
+
+def writeCounted(result, engine, output, statsOutput, rejected, timer):  #takes what a worker counted for one piece of the VCF (lines read, warnings, loci, per-line counts, records filtered out, per-line stats or None, stage timings or None), prints its warnings, adds up what it filtered out and writes its counts out on top of everything before it.  Returns the number of lines read
+    lineCount, warnings, loci, lineCounts, pieceRejected, stats, stages = result
+    for warning in warnings:
+        print(warning)
+    for reason, count in zip(filterReasons, pieceRejected):
+        rejected[reason] += count
+    if stages:
+        timer.merge(stages)
+    started = timer.start()
+    counts = engine.accumulate(lineCounts)
+    timer.stop("count", started)  #adding the piece onto the running counts.  The workers already counted its records
+    output.writeRecords(loci, counts)
+    if statsOutput:
+        statsOutput.writeRecords(stats)
+    return lineCount
+
+def encodeInChunks(args, timer):  #splits the VCF into chunks that a pool of processes parse and count (reusing stored counts for unchanged chunks in incremental mode), then merges the results back in their original order.  Returns the number of lines read, or False if this cannot be done so the caller can fall back to the serial loop
+    import multiprocessing
+    compression = vcfCompression(args.VCF)
+    if compression == "gzip":
+        print("Plain gzip files cannot be split into chunks (use bgzip instead).  Running with a single process.")
+        return False
+    header, bodyStart, counter = readHeader(args.VCF, args.useUnidentifiableGroup, compression == "bgzf", args.sampleGroups)
+    delimiter = args.delimiter
+    try:
+        engine = AlleleCountEngine(header.columnGroupIndex, len(header.outputGroupColumns), delimiter)  #the parent only uses this to add up the counts coming back from the workers
+    except ImportError:
+        print("NumPy is not available.  Running with a single process.")
+        return False
+    if compression == "bgzf":
+        chunks = findBgzfChunks(args.VCF, args.chunkSize)
+        counter = 0  #the first chunk starts at the top of the file, so the workers count the header lines for us
+    else:
+        chunks = findChunks(args.VCF, bodyStart, args.chunkSize)
+    state = None
+    stateDirectory = None
+    tasks = [(chunk, None) for chunk in chunks]
+    if args.incremental:
+        fileStatus = os.stat(args.VCF)
+        stateDirectory = args.VCF + ".bnvstate"
+        state = EncodingState(stateDirectory, encodingSettings(args, header, compression), {"size" : fileStatus.st_size, "mtime" : fileStatus.st_mtime_ns})
+        tasks = [(chunk, state.knownChecksums.get(tuple(chunk))) for chunk in chunks]
+    output = createOutput(args, timer)
+    output.writeHeader(header.outputGroupColumns)
+    statsOutput = createStatsOutput(args, header, timer)
+    progress = ProgressReporter(args.progressInterval, 1)  #each update covers a whole chunk, so look at the clock every time
+    workerArgs = (args.VCF, compression == "bgzf", header, args.batchSize, delimiter, args.splitMultiallelic, stateDirectory, timer.enabled, args.traceMemory, args.recordFilter, args.groupStats)
+    pool = None
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, initializer = startWorker, initargs = workerArgs)
+        results = pool.imap(countChunk, tasks)  #imap hands back the results in the same order as the chunks, no matter which worker finishes first
+    else:
+        startWorker(*workerArgs)
+        results = map(countChunk, tasks)
+    chunkChecksums = []
+    reused = 0
+    rejected = dict.fromkeys(filterReasons, 0)
+    for chunk, result in zip(chunks, results):
+        checksum, storedCounts = result[:2]
+        counter += writeCounted(result[2:], engine, output, statsOutput, rejected, timer)
+        chunkChecksums.append((chunk, checksum))
+        reused += storedCounts
+        progress.update(counter)
+    if pool:
+        pool.close()
+        pool.join()
+    progress.finish(counter)
+    reportRejected(rejected)
+    output.close()
+    if statsOutput:
+        statsOutput.close()
+    if state:
+        state.save(chunkChecksums)
+        print("Used stored counts for " + str(reused) + " of " + str(len(chunks)) + " chunks.")
+    return counter
+
+def readBlocks(vcf, firstLine, blockLines, timer = None):  #yields the lines of an open VCF as blocks of text blockLines lines long, starting with firstLine (the first data line, already read along with the header).  Runs in the pipeline's reader thread, so it gets a timer of its own
+    timer = timer or StageTimer(encoderStages, False)
+    started = timer.start()
+    lines = iter(vcf.readline, "")
+    block = [firstLine] if firstLine else []
+    block += itertools.islice(lines, blockLines - len(block))
+    try:
+        while block:
+            text = "".join(block)
+            timer.stop("read", started)  #the workers count the lines as they split the block back up
+            yield text
+            started = timer.start()
+            block = list(itertools.islice(lines, blockLines))
+    finally:
+        vcf.close()
+
+def countBlock(text):  #runs in a worker process (or our own process, with one worker).  Counts a block of lines from the pipeline's reader and returns the same as countChunkLines, followed by the stage timings or None
+    timer = StageTimer(encoderStages, workerState["measure"], workerState["traceMemory"])
+    return countChunkLines(text, timer) + (timer.stages if timer.enabled else None,)
+
+def encodeInPipeline(args, timer):  #reads the VCF in a background thread and passes blocks of lines through bounded queues to the workers that parse and count them, then writes the counts out in order from the writer thread, so reading, counting and writing all overlap.  Returns the number of lines read, or False if this cannot be done so the caller can fall back to the serial loop
+    try:
+        import numpy
+    except ImportError:
+        print("NumPy is not available.  Running without the pipeline.")
+        return False
+    if args.regions:
+        vcf = RegionReader(args.VCF, args.regions, args.decompressionThreads)
+    else:
+        vcf = openVCF(args.VCF, args.decompressionThreads)
+    header, line, counter = readOpenHeader(vcf, args.useUnidentifiableGroup, args.sampleGroups)
+    if not header:
+        vcf.close()
+        raise RuntimeError('Unable to find a header line in ' + args.VCF + '.')
+    engine = AlleleCountEngine(header.columnGroupIndex, len(header.outputGroupColumns), args.delimiter)  #only used to add up the counts coming back from the workers
+    output = createOutput(args, timer)
+    output.writeHeader(header.outputGroupColumns)
+    statsOutput = createStatsOutput(args, header, timer)
+    progress = ProgressReporter(args.progressInterval, 1)
+    readTimer = StageTimer(encoderStages, timer.enabled)  #the reader thread keeps its own, since stages are added up without any locking
+    workerArgs = (args.VCF, False, header, args.batchSize, args.delimiter, args.splitMultiallelic, None, timer.enabled, args.traceMemory, args.recordFilter, args.groupStats)
+    pipeline = BlockPipeline(readBlocks(vcf, line, args.blockLines, readTimer), countBlock, args.workers, args.queueDepth, startWorker, workerArgs)
+    rejected = dict.fromkeys(filterReasons, 0)
+    for result in pipeline.results():
+        counter += writeCounted(result, engine, output, statsOutput, rejected, timer)
+        progress.update(counter)
+    timer.merge(readTimer.stages)
+    progress.finish(counter)
+    reportRejected(rejected)
+    output.close()
+    if statsOutput:
+        statsOutput.close()
+    return counter
+
+def encode(args, timer):  #runs the encoding the way the arguments ask for and returns the number of lines read
+    if args.pipeline:
+        counter = encodeInPipeline(args, timer)
+        if counter is not False:
+            return counter
+    elif (args.workers > 1 or args.incremental) and args.regions:
+        print("Region queries run in a single process without stored counts.")
+    elif args.workers > 1 or args.incremental:
+        counter = encodeInChunks(args, timer)
+        if counter is not False:  #if we were asked for more than one process or to reuse stored counts and were able to, we are done
+            return counter
+    encoder = VCFEncoder(args.VCF, args.useUnidentifiableGroup, args.sampleGroups, args.splitMultiallelic, args.regions, args.batchSize, args.scalar, args.decompressionThreads, True, args.progressInterval, timer, args.recordFilter, args.groupStats)  #reads the header and gets ready to count
+    output = createOutput(args, timer)  #open our output files
+    output.writeHeader(encoder.groups)  #writes the column names (including group IDs) to the outputs
+    statsOutput = createStatsOutput(args, encoder.header, timer)
+    for result in encoder.batches():  #count each batch of data lines and write it out in its original order
+        output.writeRecords(result[0], result[1])
+        if statsOutput:
+            statsOutput.writeRecords(result[2])
+    output.close()
+    if statsOutput:
+        statsOutput.close()
+    return encoder.counter
 
 def main():
     args = CheckArgs()  #create an object holding our VALIDATED commandline arguments  (bogus arguments would have made this program quit)
-    vcf = open(args.VCF,'r')  #open the VCF for reading
-    delimiter = args.delimiter
-    locusListFileName = args.outputLoci 
-    frequencyMatrixFileName = args.outputMatrix  
-    locusList = open(locusListFileName,'w')   #this and the next line open our two output files
-    frequencyMatrix = open(frequencyMatrixFileName,'w')
-    line = vcf.readline()  #reads a line from the VCF
-    counter = 0 #initializes our counter variable to indicate progress
-    while line:  #iterates so long as we have an input line.  We must remember to update the line at the end of each iteration, otherwise we keep working over the same line and have an infinite loop
-        print("Processed " + str(counter) + " lines.", end="\r")  #display the updated counter to the user.  Does not allow the print to start a new line (so the next update will overwrite the current counter)
-        counter += 1  #increment the counter
-        if line[0] == '#':  #checks if the line starts with a #
-            if line[1] == '#':  #if it does and the second character is also #
-                line = vcf.readline()  #read in a new line
-                continue #and start the loop over
-            else:
-                header = Header(line)  #if the line starts with only a single #, it must be the headers, so we initialize our header object (this will be available for reference throughout the run of this program)
-                header.generateLists(args.useUnidentifiableGroup)  #tells the header to make its lists.  Just needs to know (in the arguments passed) if it has permission to use groups that it cannot identify
-                groupColumns = delimiter.join(header.outputGroupColumns)  #creates a delimited string of our groups for the locus file
-                locusList.write("contig" + delimiter + "position" + delimiter + "allele" + delimiter + groupColumns + "\n") #writes the column names (including group IDs) to the locus file
-                line = vcf.readline()  #reads next line
-                continue  #starts the loop again
-        else:  #if the line did not start with a #, it must be a data line
-            data = Data(line)  #initialize an object to handle the data line
-            if not data.integrityCheck(header.columnGroupIDs):  #if the line fails integrity check (wrong number of columns, probably due to a corruption of the file)
-                print("Warning: Incorrect number of columns found for locus " + data.locus + ".  Skipping this locus.")  #warn the user
-                line = vcf.readline()  #read the next line
-                continue  #and continue to the next iteration of the loop
-            if not data.isBiallelic():  #if the line is not for a biallelic locus
-                print("Warning: Multiple alternative alleles found for locus " + data.locus + ".  Skipping this locus.")  #warn the user
-                line = vcf.readline()  #read the next line
-                continue  #and continue to the next iteration of the loop
-            data.createOutputs(header.columnGroupIDs, header.groupHash, header.outputGroupColumns, delimiter)  #run the supervisor function for a data line that makes the outputs
-            frequencyMatrix.write(data.refCountsOutput + "\n")  #write the newly-created reference output to the matrix file
-            frequencyMatrix.write(data.altCountsOutput + "\n")  #do the same on the next line for the alt output
-            locusList.write(data.locusInfoRef + "\n")  #then write the locus data to the appropriate file in the same order on this and the next line
-            locusList.write(data.locusInfoAlt + "\n")
-            line = vcf.readline() #and read the next line of the input file before starting the loop again
-    print("Processed " + str(counter) + " lines.")
-    vcf.close() #close all the files we were working on
-    locusList.close() 
-    frequencyMatrix.close()
+    timer = StageTimer(encoderStages, bool(args.metricsOutput), args.traceMemory)
+    profiler = startProfiler(args.profile)
+    counter = encode(args, timer)
+    stopProfiler(profiler, args.profile)
+    if args.metricsOutput:
+        timer.write(args.metricsOutput, counter, {"program" : "BNVencoder", "input" : args.VCF, "outputFormat" : args.outputFormat, "workers" : args.workers, "batchSize" : args.batchSize, "scalar" : args.scalar, "pipeline" : args.pipeline})
+        print("Wrote run metrics to " + args.metricsOutput + ".")
     quit("Done!")
-    
-main()
+
+if __name__ == '__main__':  #only run when called as a program, which also keeps worker processes from starting their own run
+    main()
             
             
\ No newline at end of file
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import os  #import the OS calling library
+import sys  #import the library for finding our own Python interpreter
+import time  #import the library for timing each run
+import json  #import the library for writing the machine-readable results
+import shutil  #import the library for copying and cleaning up files
+import filecmp  #import the library for comparing outputs to the golden files
+import tempfile  #import the library for making a scratch directory
+import subprocess  #import the library for running the encoder as its own program
+
+benchmarkDirectory = os.path.dirname(os.path.abspath(__file__))
+
+class CheckArgs(object):  #class that checks arguments and ultimately returns a validated set of arguments to the main program
+
+    def __init__(self):
+        import argparse
+        parser = argparse.ArgumentParser()
+        parser.add_argument ("-e", "--encoder", help = "Encoder program to benchmark.", default = os.path.join(benchmarkDirectory, "BNVencoder0.3.py"))
+        parser.add_argument ("-n", "--records", help = "Comma-separated numbers of records for the synthetic VCFs.", default = "10000,100000")
+        parser.add_argument ("-s", "--samples", help = "Comma-separated numbers of samples for the synthetic VCFs.", default = "100")
+        parser.add_argument ("-g", "--groups", help = "Comma-separated numbers of groups for the synthetic VCFs.", default = "10")
+        parser.add_argument ("-m", "--missingRate", help = "Fraction of genotype calls that are missing.", type = float, default = 0.05)
+        parser.add_argument ("-a", "--multiallelicFraction", help = "Fraction of records with two ALT alleles.", type = float, default = 0.02)
+        parser.add_argument ("-r", "--seed", help = "Seed for the synthetic VCF generator.", type = int, default = 1)
+        parser.add_argument ("-c", "--config", help = "Encoder options to time a full run with, joined to the flag with = (for example --config=\"-w 4\").  Can be given more than once.  A run with the default options is always included.", action = "append", default = [])
+        parser.add_argument ("-o", "--output", help = "JSON file to write the results to.", default = "bnvbenchmark.json")
+        parser.add_argument ("-d", "--workDirectory", help = "Directory for the synthetic VCFs and encoder outputs (a temporary directory by default).")
+        parser.add_argument ("-k", "--keep", help = "Keep the synthetic VCFs and outputs instead of deleting them.", action = "store_true")
+        args = parser.parse_args()
+        self.encoder = os.path.abspath(args.encoder)
+        self.missingRate = args.missingRate
+        self.multiallelicFraction = args.multiallelicFraction
+        self.seed = args.seed
+        self.configs = [""] + [config for config in args.config if config.strip()]
+        self.output = args.output
+        self.workDirectory = args.workDirectory
+        self.keep = args.keep
+        if not os.path.isfile(self.encoder):
+            quit('Unable to find encoder: ' + self.encoder)
+        try:
+            self.records = [int(value) for value in args.records.split(",")]
+            self.samples = [int(value) for value in args.samples.split(",")]
+            self.groups = [int(value) for value in args.groups.split(",")]
+        except ValueError:
+            quit('Records, samples and groups must be comma-separated whole numbers.')
+        if min(self.records) < 1 or min(self.samples) < 1 or min(self.groups) < 1:
+            quit('Records, samples and groups must all be at least 1.')
+
+def maxrssBytes(maxrss):  #turns a ru_maxrss reading into bytes.  macOS reports bytes, Linux reports kilobytes, just as peakMemory in the encoder allows for
+    if sys.platform == "darwin":
+        return maxrss
+    return maxrss * 1024
+
+def runEncoder(encoderFile, vcfFileName, options, metricsFileName = None):  #runs the encoder on a VCF as its own program and returns the wall clock time, the error it stopped with (None if it finished), peak resident memory (largest process, in bytes) and the per-stage metrics the encoder wrote (None unless we asked for them)
+    command = [sys.executable, encoderFile, "-f", vcfFileName, "-9", "-p", "86400"] + options.split()  #a long progress interval keeps the progress printing out of the timing
+    if metricsFileName:
+        command += ["-M", metricsFileName]  #the encoder times its own stages as it runs, so what we report is the code that actually ships
+    errors = tempfile.TemporaryFile(mode = 'w+')  #a file rather than a pipe, so a long traceback cannot fill the pipe while we wait
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout = subprocess.DEVNULL, stderr = errors)
+    pid, status, usage = os.wait4(process.pid, 0)  #wait4 hands back the resource usage of just this run
+    seconds = time.perf_counter() - start
+    errors.seek(0)
+    message = errors.read().strip()
+    errors.close()
+    error = None
+    if not message.endswith("Done!") or "Traceback" in message:  #the encoder always exits through quit, so the exit status is 1 whether it finished or not.  A finished run ends by printing Done!
+        error = message.splitlines()[-1] if message else "Exited with status " + str(os.waitstatus_to_exitcode(status)) + "."
+    metrics = None
+    if metricsFileName and not error:
+        metricsFile = open(metricsFileName, 'r')
+        metrics = json.load(metricsFile)
+        metricsFile.close()
+    return (seconds, error, maxrssBytes(usage.ru_maxrss), metrics)
+
+def readTextCounts(vcfFileName):  #returns the groups, the [contig, position, ref, alt] of each locus and the rows of counts from a .counts and .loci pair
+    locusList = open(vcfFileName + ".loci", 'r')
+    groups = locusList.readline().rstrip("\n").split("\t")[3:]
+    lociLines = [line.rstrip("\n").split("\t") for line in locusList]
+    locusList.close()
+    loci = [[refLine[0], int(refLine[1]), refLine[2], altLine[2]] for refLine, altLine in zip(lociLines[0::2], lociLines[1::2])]  #ref and alt rows alternate
+    frequencyMatrix = open(vcfFileName + ".counts", 'r')
+    rows = [[int(value) for value in line.rstrip("\n").rstrip("\t").split("\t")] for line in frequencyMatrix]  #each row ends in a trailing delimiter
+    frequencyMatrix.close()
+    return (groups, loci, rows)
+
+def readBinaryCounts(vcfFileName):  #the same as readTextCounts, from a .counts.npy matrix and its .counts.json sidecar
+    import numpy
+    sidecarFile = open(vcfFileName + ".counts.json", 'r')
+    sidecar = json.load(sidecarFile)
+    sidecarFile.close()
+    return (sidecar["groups"], sidecar["loci"], numpy.load(vcfFileName + ".counts.npy").tolist())
+
+def outputsMatch(vcfFileName, goldenVCF):  #compares whatever counts the encoder wrote for the VCF to the golden text outputs.  Text outputs have to match byte for byte, and .npy outputs have to hold the same groups, loci and counts
+    if os.path.isfile(vcfFileName + ".counts.npy"):
+        return os.path.isfile(vcfFileName + ".counts.json") and readBinaryCounts(vcfFileName) == readTextCounts(goldenVCF)
+    for extension in [".counts", ".loci"]:
+        if not os.path.isfile(vcfFileName + extension) or not filecmp.cmp(vcfFileName + extension, goldenVCF + extension, shallow = False):
+            return False
+    return True
+
+def goldenCheck(encoderFile, configs, workDirectory):  #runs every configuration on karinasample.vcf and compares the outputs to the checked in .counts and .loci files
+    goldenVCF = os.path.join(benchmarkDirectory, "karinasample.vcf")
+    results = []
+    for config in configs:
+        directory = tempfile.mkdtemp(dir = workDirectory)
+        vcfFileName = os.path.join(directory, "karinasample.vcf")
+        shutil.copy(goldenVCF, vcfFileName)
+        seconds, error, peakRSS, metrics = runEncoder(encoderFile, vcfFileName, "-u " + config)  #karinasample.vcf has sample names without a group prefix
+        passed = error is None and outputsMatch(vcfFileName, goldenVCF)
+        results.append({"config" : config, "passed" : passed, "error" : error})
+        shutil.rmtree(directory)
+    return results
+
+def benchmarkDataset(args, records, samples, groups, workDirectory):  #makes one synthetic VCF and times a full run with each configuration, along with the encoder's own timings of each stage of the run
+    import syntheticVCF
+    vcfFileName = os.path.join(workDirectory, "synthetic_" + str(records) + "x" + str(samples) + "_" + str(groups) + ".vcf")
+    syntheticVCF.writeSyntheticVCF(vcfFileName, records, samples, groups, args.missingRate, args.multiallelicFraction, args.seed)
+    result = {"records" : records, "samples" : samples, "groups" : groups, "missingRate" : args.missingRate, "multiallelicFraction" : args.multiallelicFraction, "seed" : args.seed, "fileSize" : os.path.getsize(vcfFileName)}
+    result["runs"] = []
+    for config in args.configs:
+        seconds, error, peakRSS, metrics = runEncoder(args.encoder, vcfFileName, config, vcfFileName + ".metrics.json")
+        if error:  #a run that crashed or was turned down did not count anything, so it gets no throughput
+            print("Run with options \"" + config + "\" failed: " + error)
+            result["runs"].append({"config" : config, "failed" : True, "error" : error})
+            continue
+        result["runs"].append({"config" : config, "failed" : False, "seconds" : seconds, "recordsPerSecond" : records / seconds, "peakRSS" : peakRSS, "stages" : metrics["stages"]})
+    return result
+
+def main():
+    args = CheckArgs()
+    sys.path.insert(0, benchmarkDirectory)  #so we can import the synthetic VCF generator that lives next to this file
+    workDirectory = args.workDirectory or tempfile.mkdtemp(prefix = "bnvbenchmark")
+    if not os.path.isdir(workDirectory):
+        os.makedirs(workDirectory)
+    try:
+        import numpy
+        numpyVersion = numpy.__version__
+    except ImportError:
+        numpyVersion = None
+    results = {"encoder" : args.encoder, "python" : sys.version.split()[0], "numpy" : numpyVersion, "golden" : goldenCheck(args.encoder, args.configs, workDirectory), "datasets" : []}
+    for records in args.records:
+        for samples in args.samples:
+            for groups in args.groups:
+                if groups > samples:
+                    continue
+                print("Benchmarking " + str(records) + " records, " + str(samples) + " samples and " + str(groups) + " groups.")
+                results["datasets"].append(benchmarkDataset(args, records, samples, groups, workDirectory))
+    output = open(args.output, 'w')
+    json.dump(results, output, indent = 2)
+    output.write("\n")
+    output.close()
+    if not args.keep:
+        shutil.rmtree(workDirectory, ignore_errors = True)
+    if not all([check["passed"] for check in results["golden"]]):
+        quit("Golden check failed.  Results written to " + args.output + ".")
+    if any([run["failed"] for dataset in results["datasets"] for run in dataset["runs"]]):
+        quit("Some runs failed.  Results written to " + args.output + ".")
+    quit("Done!  Results written to " + args.output + ".")
+
+if __name__ == '__main__':
+    main()
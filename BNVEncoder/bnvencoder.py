@@ -0,0 +1,21 @@
+'''
+Importable name for BNVencoder0.3.py (a file name with dots in it cannot be imported directly).  Loads the program as the module bnvencoder without
+running it, so other Python code can count VCFs in its own process instead of starting the program for each file:
+
+    import bnvencoder
+    groups, loci, counts = bnvencoder.encodeArrays("samples.vcf", useUnidentifiableGroup = True)
+    for contig, position, refAllele, altAllele, groupCounts in bnvencoder.encodeRecords("samples.vcf"):
+        ...
+
+NumPy is only loaded once counting starts (and is not needed with scalar = True).
+'''
+
+import os  #import the OS calling library
+import sys  #import the library holding the loaded modules
+import importlib.util  #import the library for loading a module from its file
+
+programFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "BNVencoder0.3.py")
+spec = importlib.util.spec_from_file_location(__name__, programFile)
+program = importlib.util.module_from_spec(spec)
+sys.modules[__name__] = program  #the program takes the place of this module, so its functions can be found under this name (by worker processes, for instance)
+spec.loader.exec_module(program)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import random  #import the library for making our random (but repeatable) genotypes
+
+class CheckArgs(object):  #class that checks arguments and ultimately returns a validated set of arguments to the main program
+
+    def __init__(self):
+        import argparse
+        parser = argparse.ArgumentParser()
+        parser.add_argument ("-o", "--output", help = "Name of the VCF file to write.", required = True)
+        parser.add_argument ("-n", "--records", help = "Number of data lines to write.", type = int, default = 100000)
+        parser.add_argument ("-s", "--samples", help = "Number of sample columns.", type = int, default = 100)
+        parser.add_argument ("-g", "--groups", help = "Number of groups the samples are spread over.", type = int, default = 10)
+        parser.add_argument ("-m", "--missingRate", help = "Fraction of genotype calls that are missing (./.).", type = float, default = 0.05)
+        parser.add_argument ("-a", "--multiallelicFraction", help = "Fraction of records with two ALT alleles.", type = float, default = 0.02)
+        parser.add_argument ("-r", "--seed", help = "Seed for the random number generator.  The same seed and settings always give the same file.", type = int, default = 1)
+        args = parser.parse_args()
+        self.output = args.output
+        self.records = args.records
+        self.samples = args.samples
+        self.groups = args.groups
+        self.missingRate = args.missingRate
+        self.multiallelicFraction = args.multiallelicFraction
+        self.seed = args.seed
+        if self.records < 0:
+            quit('Number of records cannot be negative.')
+        if self.samples < 1:
+            quit('Number of samples must be at least 1.')
+        if self.groups < 1 or self.groups > self.samples:
+            quit('Number of groups must be between 1 and the number of samples.')
+        if not 0 <= self.missingRate <= 1:
+            quit('Missing call rate must be between 0 and 1.')
+        if not 0 <= self.multiallelicFraction <= 1:
+            quit('Multiallelic fraction must be between 0 and 1.')
+
+def groupName(index):  #turns a group number into a name made only of letters (A, B, ... Z, AA, AB, ...) so BNVencoder can read it back off the front of the sample names
+    name = ""
+    index += 1
+    while index:
+        index, letter = divmod(index - 1, 26)
+        name = chr(ord("A") + letter) + name
+    return name
+
+def sampleNames(samples, groups):  #deals the samples out over the groups in turn.  The sample number on the end keeps every name unique
+    return [groupName(sample % groups) + str(sample + 1) for sample in range(samples)]
+
+def genotypeTable(altCount, altFrequency, missingRate):  #returns the possible sample entries (genotype plus depth and quality) with the weight of each, assuming Hardy-Weinberg proportions
+    alleleFrequencies = [1 - altFrequency] + [altFrequency / altCount] * altCount  #the ALT frequency is shared evenly between the ALT alleles
+    calls = []
+    weights = []
+    for first in range(altCount + 1):
+        for second in range(first, altCount + 1):
+            weight = alleleFrequencies[first] * alleleFrequencies[second]
+            if first != second:
+                weight *= 2
+            calls.append(str(first) + "/" + str(second))
+            weights.append(weight * (1 - missingRate))
+    calls.append("./.")
+    weights.append(missingRate)
+    entries = []
+    entryWeights = []
+    for call, weight in zip(calls, weights):
+        for depth, quality in depthsAndQualities:
+            if call == "./.":
+                entries.append(call + ":0:.")
+            else:
+                entries.append(call + ":" + str(depth) + ":" + str(quality))
+            entryWeights.append(weight)
+    return (entries, entryWeights)
+
+depthsAndQualities = [(4, 12), (9, 27), (15, 45), (22, 66), (31, 93), (40, 99)]  #a handful of depth and genotype quality pairs to make the FORMAT fields look like real data
+bases = "ACGT"
+
+def writeSyntheticVCF(fileName, records, samples, groups, missingRate = 0.05, multiallelicFraction = 0.02, seed = 1):  #writes a VCF of made up biallelic and triallelic SNPs.  Returns the list of sample names
+    generator = random.Random(seed)
+    names = sampleNames(samples, groups)
+    vcf = open(fileName, 'w')
+    vcf.write("##fileformat=VCFv4.1\n")
+    vcf.write('##FILTER=<ID=LowQual,Description="Low quality">\n')
+    vcf.write('##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Approximate read depth">\n')
+    vcf.write('##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Genotype Quality">\n')
+    vcf.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+    vcf.write('##INFO=<ID=DP,Number=1,Type=Integer,Description="Approximate read depth">\n')
+    vcf.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t" + "\t".join(names) + "\n")
+    contigs = max(1, min(22, records // 50000 + 1))  #spread bigger files over more contigs, like a real genome
+    recordsPerContig = -(-records // contigs) if records else 0
+    lines = []
+    for record in range(records):
+        contig, recordOnContig = divmod(record, recordsPerContig)
+        if recordOnContig == 0:
+            position = 0
+        position += generator.randint(1, 400)
+        altCount = 2 if generator.random() < multiallelicFraction else 1
+        alleles = generator.sample(bases, altCount + 1)
+        entries, weights = genotypeTable(altCount, generator.uniform(0.01, 0.5), missingRate)
+        calls = generator.choices(entries, weights, k = samples)
+        quality = generator.uniform(30, 30000)
+        filterField = "PASS" if quality > 100 else "LowQual"
+        lines.append(str(contig + 1) + "\t" + str(position) + "\t.\t" + alleles[0] + "\t" + ",".join(alleles[1:]) + "\t" + ("%.1f" % quality) + "\t" + filterField + "\tDP=" + str(samples * 20) + "\tGT:DP:GQ\t" + "\t".join(calls) + "\n")
+        if len(lines) >= 1000:
+            vcf.write("".join(lines))
+            lines = []
+    vcf.write("".join(lines))
+    vcf.close()
+    return names
+
+def main():
+    args = CheckArgs()
+    writeSyntheticVCF(args.output, args.records, args.samples, args.groups, args.missingRate, args.multiallelicFraction, args.seed)
+    quit("Done!")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+'''
+Checks for BNVencoder0.3.py.  Run from this directory with:
+
+    python -m unittest testBNVencoder
+
+Most checks count a small VCF both with the vectorized NumPy engine and one line at a time (scalar = True), since the two must always agree.
+The incremental checks run the program itself on a larger VCF and compare each rerun against a run on a fresh copy of the same file.
+'''
+
+import os  #import the OS calling library
+import sys  #import the library for finding our own Python interpreter
+import shutil  #import the library for removing the scratch directory
+import tempfile  #import the library for making the scratch directory
+import unittest  #import the testing library
+import subprocess  #import the library for running the encoder as its own program
+
+import bnvencoder  #the encoder, loaded by its importable name
+import syntheticVCF  #the generator for the larger VCFs the incremental checks need
+
+programFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "BNVencoder0.3.py")
+
+header = "##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tA1\tA2\tB1\tB2\n"
+
+class EncoderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def writeVCF(self, records):  #writes the header and the records (one list of columns each) to a scratch VCF and returns its name
+        vcfFileName = os.path.join(self.directory, "test.vcf")
+        vcf = open(vcfFileName, 'w')
+        vcf.write(header)
+        for record in records:
+            vcf.write("\t".join(record) + "\n")
+        vcf.close()
+        return vcfFileName
+
+    def encode(self, vcfFileName, **options):  #returns the loci and counts (as nested lists) for the VCF
+        groups, loci, counts = bnvencoder.encodeArrays(vcfFileName, **options)
+        if hasattr(counts, "tolist"):
+            counts = counts.tolist()
+        return (loci, counts)
+
+    def assertModesAgree(self, vcfFileName, **options):  #counts the VCF with and without NumPy and checks they match
+        vectorized = self.encode(vcfFileName, **options)
+        scalar = self.encode(vcfFileName, scalar = True, **options)
+        self.assertEqual(vectorized, scalar)
+        return vectorized
+
+    def testHaploidCalls(self):  #haploid GT values are shorter than the four character prefix the vectorized engine reads
+        vcfFileName = self.writeVCF([
+            ["1", "100", ".", "A", "G", "50", "PASS", ".", "GT:DP:GQ", "0:5:9", "1:5:9", "0:.:.", "1:12:30"],
+            ["1", "200", ".", "C", "T", "50", "PASS", ".", "GT:DP:GQ", ".:.:.", "1:7:20", "0:.:.", "0:5:9"],
+            ])
+        loci, counts = self.assertModesAgree(vcfFileName)
+        self.assertEqual(counts[0], [[1, 1], [1, 1]])
+
+    def testMixedPloidy(self):  #haploid, diploid and triploid calls side by side, as on a sex chromosome
+        vcfFileName = self.writeVCF([
+            ["X", "100", ".", "A", "G", "50", "PASS", ".", "GT:DP", "0:5", "0/1:8", "1:3", "0/1/1:9"],
+            ["X", "200", ".", "C", "T,G", "50", "PASS", ".", "GT:DP", "2:5", "1|2:8", "./.:0", "0:.:."],
+            ["X", "300", ".", "G", "A", "50", "PASS", ".", "GT:DP", "1:5", "0/0:8", "1:3", "."],
+            ])
+        self.assertModesAgree(vcfFileName)
+        self.assertModesAgree(vcfFileName, splitMultiallelic = True)
+
+    def testGenotypeFiltersWithoutGTFirst(self):  #with GT not the first FORMAT field, no line takes the prefix fast path, and the DP and GQ checks must still apply
+        vcfFileName = self.writeVCF([
+            ["1", "100", ".", "A", "G", "50", "PASS", ".", "DP:GT:GQ", "5:0/1:9", "20:1/1:30", "15:0/0:40", "3:0/1:50"],
+            ["1", "200", ".", "C", "T", "50", "PASS", ".", "DP:GT:GQ", "25:0/1:35", "8:1/1:30", "15:0/1:12", "30:1/1:50"],
+            ])
+        unfiltered = self.assertModesAgree(vcfFileName)
+        loci, counts = self.assertModesAgree(vcfFileName, recordFilter = bnvencoder.RecordFilter(minDP = 10, minGQ = 20))
+        self.assertNotEqual(counts, unfiltered[1])
+        self.assertEqual(counts[0], [[0, 2], [2, 0]])
+
+    def testGenotypeFiltersOnShortColumns(self):  #sample columns shorter than four characters do not take the prefix fast path either
+        vcfFileName = self.writeVCF([
+            ["1", "100", ".", "A", "G", "50", "PASS", ".", "GT:DP", "0/1:5", "1:3", "0:15", "1/1:20"],
+            ["1", "200", ".", "C", "T", "50", "PASS", ".", "GT:DP", "0:5", "1:20", "0:15", "1:3"],
+            ])
+        loci, counts = self.assertModesAgree(vcfFileName, recordFilter = bnvencoder.RecordFilter(minDP = 10))
+        self.assertEqual(counts[0], [[0, 0], [1, 2]])
+
+    def testLocusIndexRebuiltWithinTheSameSecond(self):  #a VCF rewritten at the same size and within the same second must not keep its old .bnvidx
+        records = [[contig, str(position), ".", "A", "G", "50", "PASS", ".", "GT", "0/1", "1/1", "0/0", "0/1"] for contig in ["1", "2"] for position in range(100, 110)]
+        vcfFileName = self.writeVCF(records)
+        oldStatus = os.stat(vcfFileName)
+        self.encode(vcfFileName, regions = [("2", 1, 1000)])
+        self.assertTrue(os.path.isfile(vcfFileName + ".bnvidx"))
+        self.writeVCF([[{"1" : "2", "2" : "1"}[record[0]]] + record[1:] for record in records])  #the same size, with the contigs swapped
+        os.utime(vcfFileName, ns = (oldStatus.st_atime_ns, oldStatus.st_mtime_ns + 1000))
+        loci, counts = self.encode(vcfFileName, regions = [("2", 1, 1000)])
+        self.assertEqual(len(loci), 10)
+        self.assertEqual(set([locus[0] for locus in loci]), set(["2"]))
+
+    def runProgram(self, vcfFileName, *options):  #runs the encoder on a VCF as its own program and returns what it printed along with the .counts and .loci it wrote
+        command = [sys.executable, programFile, "-f", vcfFileName, "-9", "-p", "86400"] + list(options)
+        printed = subprocess.run(command, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, universal_newlines = True).stdout
+        self.assertTrue(printed.rstrip().endswith("Done!"), printed)
+        outputs = []
+        for extension in [".counts", ".loci"]:
+            outputFile = open(vcfFileName + extension, 'rb')
+            outputs.append(outputFile.read())
+            outputFile.close()
+        return (printed, outputs)
+
+    def freshRun(self, vcfFileName, *options):  #the outputs of a run on a copy of the VCF that has never been encoded before
+        freshDirectory = os.path.join(self.directory, "fresh")
+        shutil.rmtree(freshDirectory, ignore_errors = True)
+        os.mkdir(freshDirectory)
+        freshFileName = os.path.join(freshDirectory, os.path.basename(vcfFileName))
+        shutil.copy(vcfFileName, freshFileName)
+        return self.runProgram(freshFileName, *options)[1]
+
+    def chunksReused(self, printed):  #returns the (reused, total) chunk counts the incremental run reported
+        for line in printed.splitlines():
+            if line.startswith("Used stored counts for "):
+                words = line.split()
+                return (int(words[4]), int(words[6]))
+        self.fail("No incremental report in: " + printed)
+
+    def writeLargeVCF(self):  #a VCF of a few megabytes, so that it splits into several one megabyte chunks
+        vcfFileName = os.path.join(self.directory, "large.vcf")
+        syntheticVCF.writeSyntheticVCF(vcfFileName, 8000, 60, 4, seed = 3)
+        return vcfFileName
+
+    def testIncrementalAppend(self):  #a rerun after records are added on the end reuses the chunks before them and matches a fresh run
+        vcfFileName = self.writeLargeVCF()
+        printed, outputs = self.runProgram(vcfFileName, "-I", "-c", "1")
+        reused, total = self.chunksReused(printed)
+        self.assertEqual(reused, 0)
+        self.assertGreater(total, 2)
+        self.assertEqual(outputs, self.freshRun(vcfFileName, "-c", "1"))
+        printed, outputs = self.runProgram(vcfFileName, "-I", "-c", "1")
+        self.assertEqual(self.chunksReused(printed), (total, total))  #nothing changed, so nothing is counted again
+        vcf = open(vcfFileName, 'r')
+        dataLines = [line for line in vcf if not line.startswith("#")]
+        vcf.close()
+        vcf = open(vcfFileName, 'a')
+        vcf.write("".join(dataLines[:3000]))
+        vcf.close()
+        printed, outputs = self.runProgram(vcfFileName, "-I", "-c", "1")
+        reused, grownTotal = self.chunksReused(printed)
+        self.assertGreater(grownTotal, total)
+        self.assertGreater(reused, 0)
+        self.assertLess(reused, grownTotal)
+        self.assertEqual(outputs, self.freshRun(vcfFileName, "-c", "1"))
+
+    def testIncrementalStaleFingerprint(self):  #after an edit in the middle of the file, the stored file fingerprint no longer matches, so every chunk is checked again and only the edited one is counted again
+        vcfFileName = self.writeLargeVCF()
+        printed, outputs = self.runProgram(vcfFileName, "-I", "-c", "1")
+        reused, total = self.chunksReused(printed)
+        vcf = open(vcfFileName, 'r+b')
+        data = vcf.read()
+        edit = data.index(b"\t0/0:", len(data) // 2)
+        vcf.seek(edit)
+        vcf.write(b"\t1/1:")  #the same size, so only the modification time gives the change away
+        vcf.close()
+        printed, outputs = self.runProgram(vcfFileName, "-I", "-c", "1")
+        self.assertEqual(self.chunksReused(printed), (total - 1, total))
+        self.assertEqual(outputs, self.freshRun(vcfFileName, "-c", "1"))
+        printed, outputs = self.runProgram(vcfFileName, "-I", "-c", "1", "-m")  #different options change every count, so none of the stored chunks fit
+        self.assertEqual(self.chunksReused(printed), (0, total))
+        self.assertEqual(outputs, self.freshRun(vcfFileName, "-c", "1", "-m"))
+
+if __name__ == '__main__':
+    unittest.main()
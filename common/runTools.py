@@ -0,0 +1,183 @@
+'''
+Run helpers shared by BNVencoder0.3.py and fpkmatrixDEG.0.2.py: the per-stage timer behind --metricsOutput and --traceMemory, the peak memory
+reading it uses, the cProfile hooks behind --profile and the block pipeline behind --pipeline.  Both programs load this file by its path (see loadCommonModule in each), so it
+does not need to be installed.
+'''
+
+import sys  #import the library for telling which platform we are on
+import time  #import the library for timing the stages of a run
+
+def peakMemory(children = False):  #returns the most resident memory in bytes our process (or the largest of its finished child processes) has used so far, or None where the resource library is not available
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":  #macOS reports bytes, Linux reports kilobytes
+        return peak
+    return peak * 1024
+
+class StageTimer(object):  #adds up the wall clock time, CPU time, records handled and peak memory for each stage of a run.  Stages are timed a batch or block at a time, so keeping track costs next to nothing, and a disabled one does nothing at all
+
+    def __init__(self, stages, enabled = True, traceMemory = False):
+        self.enabled = enabled
+        self.traceMemory = enabled and traceMemory
+        self.stages = {}
+        for stage in stages:
+            self.stages[stage] = self.newStage()
+        if self.traceMemory:
+            import tracemalloc
+            self.tracemalloc = tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+        self.runStart = self.start()
+
+    def newStage(self):
+        stats = {"wallSeconds" : 0.0, "cpuSeconds" : 0.0, "records" : 0, "calls" : 0, "peakRSS" : 0}
+        if self.traceMemory:
+            stats["peakTracedMemory"] = 0
+        return stats
+
+    def start(self):  #returns the clock readings a stage is measured from
+        if not self.enabled:
+            return None
+        if self.traceMemory:
+            self.tracemalloc.reset_peak()
+        return (time.perf_counter(), time.process_time())
+
+    def stop(self, stage, started, records = 0):  #adds the time since started onto the stage, and returns fresh clock readings so the next stage can be measured from here
+        if not self.enabled:
+            return None
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        stats = self.stages.get(stage) or self.stages.setdefault(stage, self.newStage())
+        stats["wallSeconds"] += wall - started[0]
+        stats["cpuSeconds"] += cpu - started[1]  #CPU time is for the whole process, so it includes any decompression or writer threads working at the same time
+        stats["records"] += records
+        stats["calls"] += 1
+        stats["peakRSS"] = max(stats["peakRSS"], peakMemory() or 0)
+        if self.traceMemory:
+            stats["peakTracedMemory"] = max(stats["peakTracedMemory"], self.tracemalloc.get_traced_memory()[1])
+        return self.start()
+
+    def merge(self, stages):  #adds on stages measured somewhere else (in a worker process, for instance)
+        for stage, other in stages.items():
+            stats = self.stages.setdefault(stage, dict.fromkeys(other, 0))
+            for key, value in other.items():
+                if key.startswith("peak"):
+                    stats[key] = max(stats.get(key, 0), value)
+                else:
+                    stats[key] = stats.get(key, 0) + value
+        return True
+
+    def summary(self, records, details = None):  #returns everything measured as a dictionary, with records being the lines read over the whole run
+        wallSeconds = time.perf_counter() - self.runStart[0]
+        result = dict(details or {})
+        result.update({"python" : sys.version.split()[0], "records" : records, "wallSeconds" : wallSeconds, "cpuSeconds" : time.process_time() - self.runStart[1], "recordsPerSecond" : records / wallSeconds if wallSeconds else None, "peakRSS" : peakMemory(), "peakChildRSS" : peakMemory(True)})
+        if self.traceMemory:
+            result["peakTracedMemory"] = max([self.tracemalloc.get_traced_memory()[1]] + [stats.get("peakTracedMemory", 0) for stats in self.stages.values()])
+        result["stages"] = {}
+        for stage, stats in self.stages.items():
+            stats = dict(stats)
+            stats["recordsPerSecond"] = stats["records"] / stats["wallSeconds"] if stats["wallSeconds"] else None
+            result["stages"][stage] = stats
+        return result
+
+    def write(self, metricsFileName, records, details = None):  #writes the summary to a JSON file
+        import json
+        output = open(metricsFileName, 'w')
+        json.dump(self.summary(records, details), output, indent = 2)
+        output.write("\n")
+        output.close()
+        return True
+
+def startProfiler(profileFileName):  #starts cProfile if we were asked to profile the run
+    if not profileFileName:
+        return None
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def stopProfiler(profiler, profileFileName):
+    if not profiler:
+        return False
+    profiler.disable()
+    profiler.dump_stats(profileFileName)
+    return True
+
+class BlockPipeline(object):  #takes blocks from a generator in a background reader thread, works them in a pool of processes (or in this thread, with one worker) and hands the results back in their original order.  The reader can only get a few blocks ahead before its queue is full, and only a few blocks are handed out to the workers at once, so memory stays flat however long the input is
+
+    def __init__(self, blocks, work, workers = 1, depth = 4, initializer = None, initargs = ()):
+        import threading
+        import queue
+        self.queue = queue.Queue(maxsize = depth)
+        self.full = queue.Full
+        self.work = work
+        self.inFlight = 1  #blocks handed out and not yet collected
+        self.pool = None
+        if workers > 1:
+            import multiprocessing
+            self.pool = multiprocessing.Pool(workers, initializer = initializer, initargs = initargs)
+            self.inFlight = workers + depth  #every worker busy, with a queue's worth waiting behind them
+        elif initializer:
+            initializer(*initargs)
+        self.error = None
+        self.stopped = False
+        self.thread = threading.Thread(target = self.readLoop, args = (blocks,), daemon = True)
+        self.thread.start()
+
+    def put(self, item):  #waits for room in the queue, giving up if the pipeline has been stopped
+        while not self.stopped:
+            try:
+                self.queue.put(item, timeout = 0.1)
+                return True
+            except self.full:
+                continue
+        return False
+
+    def readLoop(self, blocks):  #runs in the reader thread
+        try:
+            for block in blocks:
+                if not self.put(block):
+                    break
+        except Exception as error:  #hold on to the error so that the main thread can raise it
+            self.error = error
+        blocks.close()
+        self.put(None)  #marks the end of the blocks
+
+    def results(self):  #yields the result for each block, in the order the blocks were read
+        import collections
+        pending = collections.deque()
+        finished = False
+        try:
+            while True:
+                while not finished and len(pending) < self.inFlight:
+                    block = self.queue.get()
+                    if block is None:
+                        finished = True
+                    elif self.pool:
+                        pending.append(self.pool.apply_async(self.work, (block,)))
+                    else:
+                        pending.append(block)
+                if not pending:
+                    break
+                if self.pool:
+                    yield pending.popleft().get()
+                else:
+                    yield self.work(pending.popleft())
+            if self.error:
+                raise self.error
+        finally:
+            self.close(finished and not pending)
+
+    def close(self, finished = True):
+        self.stopped = True
+        if self.pool:
+            if finished:
+                self.pool.close()
+            else:  #stopped partway through, so the blocks still being worked are not needed
+                self.pool.terminate()
+            self.pool.join()
+        self.thread.join()
+        return True
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+'''
+Scaling benchmark for fpkmatrixDEG.  Makes cuffdiff read_group_tracking style files of increasing size with a gene of interest list that grows along with them,
+times createFpkmDict on each one and fits the growth of the run time against the number of lines.  A linear program should come out with an exponent near 1.
+'''
+
+import os  #import the OS calling library
+import math  #import the library for the logarithms in the fit
+import json  #import the library for writing the machine-readable results
+import time  #import the library for timing each run
+import random  #import the library for making our random (but repeatable) FPKM values
+import shutil  #import the library for cleaning up our files
+import tempfile  #import the library for making a scratch directory
+import contextlib  #import the library for hiding the progress printing while we time
+
+benchmarkDirectory = os.path.dirname(os.path.abspath(__file__))
+
+class CheckArgs(object):  #class that checks arguments and ultimately returns a validated set of arguments to the main program
+
+    def __init__(self):
+        import argparse
+        parser = argparse.ArgumentParser()
+        parser.add_argument ("-p", "--program", help = "fpkmatrixDEG program to benchmark.", default = os.path.join(benchmarkDirectory, "fpkmatrixDEG.0.2.py"))
+        parser.add_argument ("-n", "--genes", help = "Comma-separated numbers of genes for the benchmark files.", default = "2500,5000,10000,20000,40000")
+        parser.add_argument ("-c", "--conditions", help = "Number of conditions for each gene.", type = int, default = 3)
+        parser.add_argument ("-r", "--replicates", help = "Number of replicates for each condition.", type = int, default = 3)
+        parser.add_argument ("-i", "--interestFraction", help = "Fraction of the genes that go in the gene of interest list.", type = float, default = 0.5)
+        parser.add_argument ("-s", "--seed", help = "Seed for the random FPKM values.", type = int, default = 1)
+        parser.add_argument ("-m", "--maxExponent", help = "Largest fitted exponent for run time against lines that still counts as linear.", type = float, default = 1.25)
+        parser.add_argument ("-o", "--output", help = "JSON file to write the results to.", default = "fpkmbenchmark.json")
+        args = parser.parse_args()
+        self.program = os.path.abspath(args.program)
+        self.conditions = args.conditions
+        self.replicates = args.replicates
+        self.interestFraction = args.interestFraction
+        self.seed = args.seed
+        self.maxExponent = args.maxExponent
+        self.output = args.output
+        if not os.path.isfile(self.program):
+            quit('Unable to find program: ' + self.program)
+        try:
+            self.genes = sorted([int(value) for value in args.genes.split(",")])
+        except ValueError:
+            quit('Gene counts must be comma-separated whole numbers.')
+        if len(self.genes) < 2 or self.genes[0] < 1:
+            quit('At least two gene counts of 1 or more are needed to fit the scaling.')
+        if self.conditions < 1 or self.replicates < 1:
+            quit('Conditions and replicates must be at least 1.')
+        if not 0 < self.interestFraction <= 1:
+            quit('The gene of interest fraction must be more than 0 and no more than 1.')
+
+def loadProgram(programFile):  #imports the program from its file (its name has dots in it, so a plain import will not work)
+    import importlib.util
+    spec = importlib.util.spec_from_file_location("fpkmatrixdeg", programFile)
+    program = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(program)
+    return program
+
+def writeTrackingFile(fileName, genes, conditions, replicates, seed):  #writes a read_group_tracking style file with every replicate of every condition for each gene, grouped by gene the way cuffdiff writes them
+    generator = random.Random(seed)
+    output = open(fileName, 'w')
+    output.write("tracking_id\tcondition\treplicate\traw_frags\tinternal_scaled_frags\texternal_scaled_frags\tFPKM\teffective_length\tstatus\n")
+    lines = []
+    for gene in range(genes):
+        for condition in range(conditions):
+            for replicate in range(replicates):
+                fpkm = generator.uniform(0, 500)
+                lines.append("GENE" + str(gene) + "\tq" + str(condition + 1) + "\t" + str(replicate) + "\t" + str(int(fpkm * 20)) + "\t" + str(fpkm * 20) + "\t" + str(fpkm * 20) + "\t" + str(fpkm) + "\t-\tOK\n")
+        if len(lines) >= 10000:
+            output.write("".join(lines))
+            lines = []
+    output.write("".join(lines))
+    output.close()
+    return genes * conditions * replicates
+
+def writeGeneList(fileName, genes, interestFraction):  #writes an evenly spaced selection of the genes, so the list grows with the file
+    step = 1 / interestFraction
+    output = open(fileName, 'w')
+    selected = sorted(set([int(index * step) for index in range(int(genes * interestFraction))]))
+    output.write("".join(["GENE" + str(gene) + "\n" for gene in selected]))
+    output.close()
+    return len(selected)
+
+def fitExponent(lines, seconds):  #least squares slope of log(seconds) against log(lines)
+    x = [math.log(value) for value in lines]
+    y = [math.log(value) for value in seconds]
+    xMean = sum(x) / len(x)
+    yMean = sum(y) / len(y)
+    return sum([(xValue - xMean) * (yValue - yMean) for xValue, yValue in zip(x, y)]) / sum([(xValue - xMean) ** 2 for xValue in x])
+
+def main():
+    args = CheckArgs()
+    program = loadProgram(args.program)
+    workDirectory = tempfile.mkdtemp(prefix = "fpkmbenchmark")
+    results = {"program" : args.program, "conditions" : args.conditions, "replicates" : args.replicates, "interestFraction" : args.interestFraction, "runs" : []}
+    devnull = open(os.devnull, 'w')
+    for genes in args.genes:
+        trackingFile = os.path.join(workDirectory, "genes" + str(genes) + ".read_group_tracking")
+        geneListFile = trackingFile + ".genes"
+        lines = writeTrackingFile(trackingFile, genes, args.conditions, args.replicates, args.seed)
+        interestGenes = writeGeneList(geneListFile, genes, args.interestFraction)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(devnull):  #the per-line progress printing is not what we are measuring
+            geneList = program.getGenesOfInterest(geneListFile)
+            program.createFpkmDict(trackingFile, geneList)
+        seconds = time.perf_counter() - start
+        results["runs"].append({"genes" : genes, "lines" : lines, "genesOfInterest" : interestGenes, "seconds" : seconds, "secondsPerMillionLines" : seconds / lines * 1000000})
+        print(str(lines) + " lines, " + str(interestGenes) + " genes of interest: " + "%.3f" % seconds + " seconds")
+    devnull.close()
+    shutil.rmtree(workDirectory)
+    results["exponent"] = fitExponent([run["lines"] for run in results["runs"]], [run["seconds"] for run in results["runs"]])
+    results["linear"] = results["exponent"] <= args.maxExponent
+    output = open(args.output, 'w')
+    json.dump(results, output, indent = 2)
+    output.write("\n")
+    output.close()
+    print("Run time grows with lines to the power of " + "%.2f" % results["exponent"] + ".")
+    if not results["linear"]:
+        quit("Run time is growing faster than linear.  Results written to " + args.output + ".")
+    quit("Done!  Results written to " + args.output + ".")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+'''
+Importable name for fpkmatrixDEG.0.2.py (a file name with dots in it cannot be imported directly).  Loads the program as the module fpkmatrix without
+running it, so other Python code can build FPKM matrices in its own process instead of starting the program for each file:
+
+    import fpkmatrix
+    for gene, conditionValues in fpkmatrix.matrixRecords("genes.read_group_tracking", geneList = ["GENE1", "GENE2"]):
+        ...
+    fpkmStore = fpkmatrix.loadFpkmStore("genes.read_group_tracking", metrics = ["fpkm", "raw_frags"])
+    genes, columns, values = fpkmatrix.denseMatrix(fpkmStore, metric = 1)
+'''
+
+import os  #import the OS calling library
+import sys  #import the library holding the loaded modules
+import importlib.util  #import the library for loading a module from its file
+
+programFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fpkmatrixDEG.0.2.py")
+spec = importlib.util.spec_from_file_location(__name__, programFile)
+program = importlib.util.module_from_spec(spec)
+sys.modules[__name__] = program  #the program takes the place of this module, so its functions can be found under this name (by worker processes, for instance)
+spec.loader.exec_module(program)
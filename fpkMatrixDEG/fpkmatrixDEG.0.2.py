@@ -5,6 +5,18 @@ Python3 program for extracting fpkm data from cuffdiff outputs and writing it to
 and each condition clustered.  Output will preserve the exact order of the input.  Written by Michael Weinstein, UCLA Cohn Lab and Collaboratory, 2015
 '''
 
+import array  #import the library for compact arrays of numbers
+import operator  #import the library with fast helpers for pulling columns out of split lines
+import itertools  #import the library for picking out the genes of interest
+import os  #import the OS calling library
+import mmap  #import the library for memory mapping the parsed cache
+import json  #import the library for the parsed cache metadata
+import shutil  #import the library for clearing out old cache entries
+import hashlib  #import the library for fingerprinting input files
+import math  #import the library for the derived statistics
+import sys  #import the library for telling which platform we are on
+import importlib.util  #import the library for loading the helper modules shared between the programs
+
 def yesanswer(question):  #asks the question passed in and returns True if the answer is yes, False if the answer is no, and keeps the user in a loop until one of those is given.  Also useful for walking students through basic logical python functions
     answer = False  #initializes the answer variable to false.  Not absolutely necessary, since it should be undefined at this point and test to false, but explicit is always better than implicit
     while not answer:  #enters the loop and stays in it until answer is equal to True
@@ -26,21 +38,121 @@ class checkArgs(object):
         parser.add_argument ("-c", "--cuffDiffOutput", help = "CuffDiff Output File")
         parser.add_argument ("-g", "--geneList", help = "File containing a list of the genes of interest (1 per line).")
         parser.add_argument ("-9", "--clobber", help = "Ignore potential file overwrites (use with caution).", action = "store_true")
+        parser.add_argument ("-s", "--streaming", help = "Write each gene out as soon as its lines have been read, holding only one gene in memory.  Needs the lines for each gene to be together (as cuffdiff writes them); otherwise falls back to reading the whole file into memory.", action = "store_true")
+        parser.add_argument ("-b", "--batch", help = "Several CuffDiff output files (or quoted glob patterns) to process at once in a pool of processes.  Used in place of -c.", nargs = "+")
+        parser.add_argument ("-m", "--mergedOutput", help = "In batch mode, write one merged matrix and key with this name (with .matrix and .key added) instead of a matrix and key for each file.")
+        parser.add_argument ("-k", "--cache", help = "Keep a parsed copy of each CuffDiff file in a cache, so later runs on the same file (with any gene list) can skip reading the text.  Not used with --streaming.", action = "store_true")
+        parser.add_argument ("-K", "--cacheDirectory", help = "Directory for the parsed cache.  Defaults to a .fpkmatrix_cache directory next to each input.")
+        parser.add_argument ("-z", "--cacheSize", help = "Size cap for the parsed cache in megabytes.  The least recently used entries are removed to stay under it.", type = int, default = 4096)
+        parser.add_argument ("-x", "--geneIndex", help = "With a gene list, read only the lines for those genes by way of a gene index kept next to the CuffDiff file (as .fpkidx).  The index is built the first time and again whenever the file changes.", action = "store_true")
+        parser.add_argument ("-t", "--stats", help = "Also write a .stats file with the mean, standard deviation and coefficient of variation of each condition's replicates and log2 fold changes between conditions, for each gene in the same order as the matrix.", action = "store_true")
+        parser.add_argument ("-P", "--pseudocount", help = "Pseudocount added to both means before taking log2 fold changes.", type = float, default = 1.0)
+        parser.add_argument ("-C", "--conditionPairs", help = "Pairs of conditions to take log2 fold changes between, as first:second (giving log2 of second over first).  Defaults to every pair of conditions.", nargs = "+")
+        parser.add_argument ("-f", "--outputFormat", help = "Format for the matrix.  text writes the .matrix and .key files.  npy writes a dense .matrix.npy array and memmap writes the same numbers as a raw .matrix.dat file, each with a row for every gene, a column for every condition and replicate (NaN where a gene has no value) and a .matrix.json sidecar with the gene names and column labels.", choices = ["text", "npy", "memmap"], default = "text")
+        parser.add_argument ("-T", "--valueType", help = "Number type for the npy and memmap formats.", choices = ["float32", "float64"], default = "float64")
+        parser.add_argument ("-v", "--values", help = "Comma-separated values to make matrices of, out of " + ", ".join(sorted(metricColumns)) + ".  They are all read in one pass, each gets its own matrix (named with the value, unless it is just fpkm) and they share one key.", default = "fpkm")
+        parser.add_argument ("-M", "--metricsOutput", help = "JSON file to write the wall clock time, CPU time, records per second and peak memory of each stage of the run (read, parse, filter, aggregate, render, write) to.  The streaming path reads, parses, filters and collects each gene line by line, so that shows up as one stream stage.")
+        parser.add_argument ("-X", "--traceMemory", help = "Also track the peak Python memory of each stage with tracemalloc (slows the run down; requires --metricsOutput).", action = "store_true")
+        parser.add_argument ("-Q", "--profile", help = "Run under cProfile and save the statistics to this file (read them with python -m pstats).  Only covers the main process in batch mode.")
+        parser.add_argument ("-p", "--processes", help = "Number of processes to use in batch mode, or for parsing in pipeline mode.", type = int, default = os.cpu_count() or 1)
+        parser.add_argument ("-L", "--pipeline", help = "Read, parse and write in a pipeline: a reader thread hands blocks of lines through bounded queues to the parsing processes (see --processes), their blocks are added to the matrix in order, and the outputs are written from background threads, so reading, parsing and writing overlap while memory stays flat.  For a single file read in full (not with --batch or --streaming).", action = "store_true")
+        parser.add_argument ("-l", "--blockSize", help = "Size in kilobytes of each block the pipeline's reader hands on (carried on to the end of the last line).", type = int, default = 256)
+        parser.add_argument ("-D", "--queueDepth", help = "Number of blocks that can wait in each of the pipeline's queues before the stage in front of it has to wait.", type = int, default = 4)
         args = parser.parse_args()  #puts the arguments into the args object
         self.geneList = args.geneList
+        self.streaming = args.streaming
         self.cuffDiffOutput = args.cuffDiffOutput
-        self.outputMatrix = self.cuffDiffOutput + ".matrix"
-        self.outputKey = self.cuffDiffOutput + ".key"
+        self.processes = args.processes
+        self.mergedOutput = args.mergedOutput
+        self.cache = args.cache
+        self.geneIndex = args.geneIndex
+        self.stats = args.stats
+        self.pseudocount = args.pseudocount
+        self.conditionPairs = None
+        self.outputFormat = args.outputFormat
+        self.valueType = args.valueType
+        self.metricsOutput = args.metricsOutput
+        self.traceMemory = args.traceMemory
+        self.profile = args.profile
+        self.pipeline = None
+        if args.pipeline:
+            if args.blockSize < 1:
+                quit('Block size must be at least 1 kilobyte.')
+            if args.queueDepth < 1:
+                quit('Queue depth must be at least 1.')
+            if args.batch:
+                quit('The pipeline is for a single file.  Batch mode already spreads the files over processes.')
+            if args.streaming:
+                quit('The pipeline reads the whole file into memory, so cannot be used with --streaming.')
+            if self.processes < 1:
+                quit('Number of processes must be at least 1.')
+            self.pipeline = PipelineSettings(self.processes, args.blockSize * 1024, args.queueDepth)
+        self.values = list(dict.fromkeys([value.strip() for value in args.values.split(",") if value.strip()]))  #in the order given, without repeats
+        if not self.values:
+            quit('No values given to make matrices of.')
+        for value in self.values:
+            if value not in metricColumns:
+                quit('Unknown value: ' + value + '.  Choose from ' + ", ".join(sorted(metricColumns)) + '.')
+        self.cacheDirectory = args.cacheDirectory
+        self.cacheSize = args.cacheSize * 1024 * 1024
+        if self.cacheSize < 0:
+            quit('Cache size cannot be negative.')
+        if self.pseudocount < 0:
+            quit('Pseudocount cannot be negative.')
+        if self.traceMemory and not self.metricsOutput:
+            quit('Memory tracing needs a metrics output file (--metricsOutput).')
+        if args.conditionPairs:
+            if not self.stats:
+                quit('Condition pairs are only used with --stats.')
+            self.conditionPairs = []
+            for pair in args.conditionPairs:
+                first, separator, second = pair.rpartition(":")
+                if not first or not second:
+                    quit('Condition pairs must be given as first:second, not ' + pair)
+                self.conditionPairs.append((first, second))
         if not args.geneList:
             print("No gene of interest list set.")
             self.geneList = False
-        if not self.cuffDiffOutput:
-            quit('No CuffDiff file specified.')
-        if not os.path.isfile(self.cuffDiffOutput):
-            quit('Unable to find CuffDiffOutput file: ' + self.cuffDiffOutput)
+        if args.batch:
+            import glob  #imports the library for expanding file name patterns
+            self.batch = []
+            for pattern in args.batch:
+                matches = sorted(glob.glob(pattern))
+                if not matches:
+                    quit('Unable to find CuffDiffOutput file: ' + pattern)
+                for match in matches:
+                    if match not in self.batch:  #overlapping patterns should not give us the same file twice
+                        self.batch.append(match)
+            if self.cuffDiffOutput:
+                quit('Use either -c or --batch, not both.')
+            if self.processes < 1:
+                quit('Number of processes must be at least 1.')
+            if self.mergedOutput:
+                if self.stats:
+                    quit('Stats are written for each file, so cannot be used with a merged output.')
+                if self.outputFormat != "text":
+                    quit('A merged output can only be written as text.')
+                inputs = [self.mergedOutput]
+            else:
+                inputs = self.batch
+        else:
+            self.batch = False
+            if self.mergedOutput:
+                quit('A merged output can only be used with --batch.')
+            if not self.cuffDiffOutput:
+                quit('No CuffDiff file specified.')
+            if not os.path.isfile(self.cuffDiffOutput):
+                quit('Unable to find CuffDiffOutput file: ' + self.cuffDiffOutput)
+            inputs = [self.cuffDiffOutput]
+        outputs = []
+        for fileName in inputs:
+            for matrixOutputFileName, keyOutputFileName, statsOutputFileName in outputFileNames(fileName, self.outputFormat, self.values):
+                outputs += [matrixOutputFileName, keyOutputFileName]
+                if self.stats:
+                    outputs.append(statsOutputFileName)
         if self.geneList and not os.path.isfile(self.geneList):
             quit('Unable to find gene list file: ' + self.geneList)
-        if os.path.isfile(self.outputMatrix) or os.path.isfile(self.outputKey):
+        if [fileName for fileName in outputs if os.path.isfile(fileName)]:
             if args.clobber:
                 print('Outputs already exist.  Set to overwrite in command line arguments.')
             else:
@@ -52,22 +164,22 @@ def getGenesOfInterest(geneListFile):
         return False
     file = open(geneListFile, 'r')
     geneListLine = file.readline()
-    geneList = []
+    geneList = set()  #a set, so checking a gene against it takes the same time no matter how many genes are in the list
     while(geneListLine):
         geneListLine = geneListLine.strip()
-        geneList.append(geneListLine)
+        geneList.add(geneListLine)
         geneListLine = file.readline()
     file.close()
     return geneList
 
 class CuffDiffDeDataLine(object):
-    def __init__(self, line):  #initializes this instance of the object, takes in the line from the cuff diff file
+    def __init__(self, line, lineNumber = None):  #initializes this instance of the object, takes in the line from the cuff diff file (and its line number, if we know it, for error messages)
         self.line = line #initializes the line value to the raw input
         self.data = line.split("\t")  #initializes the data value to the split line
         if self.integrityCheck():  #checks to make sure we have enough values on the line
             self.generate()  #runs the subroutine to generate all the attributes
         else:
-            raise IndexError("Line: " + self.line + " has less than 9 values.") #stops the program and reports the error
+            raise IndexError(lineLengthError(self.line, lineNumber)) #stops the program and reports the error
             
     def integrityCheck(self):
         if len(self.data) >= 9:  #if there are 9 or more values on the line
@@ -86,85 +198,1033 @@ class CuffDiffDeDataLine(object):
         self.effective_length = self.data[7]
         self.status = self.data[8]
         
-def createFpkmDict(deFileName, geneList):
+def lineLengthError(line, lineNumber = None):  #message for a line that does not have all nine values
+    if lineNumber is None:
+        return "Line: " + line + " has less than 9 values."
+    return "Line " + str(lineNumber) + ": " + line.rstrip("\n") + " has less than 9 values."
+
+geneColumn = operator.itemgetter(0)  #fast helpers for pulling one column out of every split line in a block
+conditionColumn = operator.itemgetter(1)
+replicateColumn = operator.itemgetter(2)
+metricColumns = {"raw_frags" : 3, "internal_scaled_frags" : 4, "external_scaled_frags" : 5, "fpkm" : 6}  #the numeric values on each line we can make a matrix of, and the column each one is in
+metricGetters = dict([(metric, operator.itemgetter(column)) for metric, column in metricColumns.items()])
+
+fpkStages = ["read", "parse", "filter", "aggregate", "render", "write"]
+outputBlockSize = 4096  #genes rendered before their lines are written out together
+
+def loadCommonModule(moduleName):  #loads one of the helper modules kept in the common directory beside this program's directory.  Each is only loaded once per process, so when both programs are imported together they share it
+    if moduleName in sys.modules:
+        return sys.modules[moduleName]
+    moduleFile = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common", moduleName + ".py")
+    spec = importlib.util.spec_from_file_location(moduleName, moduleFile)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[moduleName] = module  #registered under its own name, so anything pickled from it can be found again (by worker processes, for instance)
+    spec.loader.exec_module(module)
+    return module
+
+runTools = loadCommonModule("runTools")  #the per-stage run metrics, profiling hooks and block pipeline, shared with BNVencoder
+peakMemory = runTools.peakMemory
+StageTimer = runTools.StageTimer
+startProfiler = runTools.startProfiler
+stopProfiler = runTools.stopProfiler
+BlockPipeline = runTools.BlockPipeline
+
+class PipelineSettings(object):  #how to run the pipeline: the number of processes parsing blocks, the size in characters of each block the reader hands on and the number of blocks each queue can hold
+    def __init__(self, workers = 1, blockSize = 262144, queueDepth = 4):
+        self.workers = workers
+        self.blockSize = blockSize
+        self.queueDepth = queueDepth
+
+class QueuedFile(object):  #hands what is written to it to a background thread that writes it to the file, so rendering the next block does not wait on the disk.  Only a few writes can be waiting at once, so a slow disk holds up rendering instead of filling memory
+    def __init__(self, file, depth = 4):
+        import threading
+        import queue
+        self.file = file
+        self.error = None
+        self.queue = queue.Queue(maxsize = depth)
+        self.thread = threading.Thread(target = self.writeLoop, daemon = True)
+        self.thread.start()
+
+    def writeLoop(self):  #runs in the background thread, writing out each piece in the order it was queued
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            try:
+                if not self.error:
+                    self.file.write(data)
+            except Exception as error:  #hold on to the error so that the main thread can raise it
+                self.error = error
+
+    def checkError(self):
+        if self.error:
+            raise self.error
+
+    def write(self, data):
+        self.checkError()
+        self.queue.put(data)
+        return True
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        self.checkError()
+
+def openOutput(fileName, mode = 'w', threaded = False):  #opens an output file, written from a background thread if asked
+    output = open(fileName, mode)
+    if threaded:
+        return QueuedFile(output)
+    return output
+
+def readTextBlocks(deFileName, blockSize, timer = None):  #yields (first line number, text) for blocks of about blockSize characters from a tracking file, each carried on to the end of its last line.  Runs in the pipeline's reader thread, so it gets a timer of its own
+    timer = timer or StageTimer(fpkStages, False)
+    started = timer.start()
+    deFile = open(deFileName, 'r')
+    lineNumber = 1
+    try:
+        block = deFile.read(blockSize)
+        while block:
+            if block[-1] != "\n":
+                block += deFile.readline()  #finish the last line
+            lines = block.count("\n") + (block[-1] != "\n")  #the last line of the file may not end with a newline
+            timer.stop("read", started, lines)
+            yield (lineNumber, block)
+            started = timer.start()
+            lineNumber += lines
+            block = deFile.read(blockSize)
+    finally:
+        deFile.close()
+
+def startParser(geneList, metrics = ("fpkm",), measure = False, traceMemory = False):  #runs once in each of the pipeline's parsing processes when the pool starts (or in our own process when there is only one)
+    workerState["geneList"] = geneList
+    workerState["metrics"] = metrics
+    workerState["measure"] = measure
+    workerState["traceMemory"] = traceMemory
+
+def parseBlock(block):  #runs in a parsing process.  Takes a (first line number, text) block from the reader and returns (lines read, genes, conditions, replicates), the values for each metric and then the stage timings or None
+    lineNumber, text = block
+    timer = StageTimer(fpkStages, workerState["measure"], workerState["traceMemory"])
+    lines = text.split("\n")
+    if not lines[-1]:  #the block ended with a newline
+        lines.pop()
+    return (len(lines),) + parseTrackingLines(lines, lineNumber, workerState["geneList"], workerState["metrics"], timer) + (timer.stages if timer.enabled else None,)
+
+def pipelineTrackingBlocks(deFileName, geneList, pipeline, metrics = ("fpkm",), timer = None):  #reads a tracking file in a background thread and parses the blocks in the pipeline's processes, yielding the same blocks as readTrackingBlocks in the same order
+    timer = timer or StageTimer(fpkStages, False)
+    readTimer = StageTimer(fpkStages, timer.enabled)  #the reader thread keeps its own, since stages are added up without any locking
+    blocks = BlockPipeline(readTextBlocks(deFileName, pipeline.blockSize, readTimer), parseBlock, pipeline.workers, pipeline.queueDepth, startParser, (geneList, metrics, timer.enabled, timer.traceMemory))
+    for block in blocks.results():
+        if block[-1]:
+            timer.merge(block[-1])
+        yield block[:-1]
+    timer.merge(readTimer.stages)
+
+def parseTrackingLines(lines, firstLineNumber, geneList, metrics = ("fpkm",), timer = None):  #splits a block of lines from a tracking file and returns the gene, condition and replicate columns, followed by a column for each metric asked for, for the data lines that are for genes of interest.  Every data line is checked for all nine values first, just like CuffDiffDeDataLine does
+    timer = timer or StageTimer(fpkStages, False)
+    started = timer.start()
+    rows = [line.split("\t") for line in lines if "tracking_id" not in line]  #lines with "tracking_id" in them are headers
+    if rows and min(map(len, rows)) < 9:  #at least one line is short, so go back and find the first one to report
+        for lineNumber, line in enumerate(lines, firstLineNumber):
+            if "tracking_id" not in line and len(line.split("\t")) < 9:
+                raise IndexError(lineLengthError(line, lineNumber))
+    started = timer.stop("parse", started, len(rows))
+    if geneList:
+        rows = [row for row in rows if row[0] in geneList]
+    started = timer.stop("filter", started, len(rows))
+    columns = (list(map(geneColumn, rows)), list(map(conditionColumn, rows)), array.array('i', map(int, map(replicateColumn, rows)))) + tuple([array.array('d', map(float, map(metricGetters[metric], rows))) for metric in metrics])
+    timer.stop("parse", started)  #turning the columns we kept into numbers
+    return columns
+
+def readTrackingBlocks(deFileName, geneList, blockSize = 262144, metrics = ("fpkm",), timer = None):  #reads a tracking file in large blocks instead of line by line.  Yields (lines read, genes, conditions, replicates) and then the values for each metric, for each block
+    timer = timer or StageTimer(fpkStages, False)
+    started = timer.start()
     deFile = open(deFileName, 'r')
+    leftover = ""  #the start of a line that carries on into the next block
+    lineNumber = 1
+    block = deFile.read(blockSize)
+    while block:
+        lines = (leftover + block).split("\n")
+        leftover = lines.pop()
+        timer.stop("read", started, len(lines))
+        yield (len(lines),) + parseTrackingLines(lines, lineNumber, geneList, metrics, timer)
+        started = timer.start()
+        lineNumber += len(lines)
+        block = deFile.read(blockSize)
+    deFile.close()
+    timer.stop("read", started, 1 if leftover else 0)
+    if leftover:  #the last line did not end with a newline
+        yield (1,) + parseTrackingLines([leftover], lineNumber, geneList, metrics, timer)
+
+class FpkmStore(object):  #compact store for the FPKM values (or any of the other metrics on the line).  Gene, condition and replicate names are interned to integer IDs and the values for each metric are kept in one flat array of doubles laid out gene x condition x replicate, instead of three levels of dictionaries
+    def __init__(self, metrics = ("fpkm",)):
+        self.geneIDs = {}  #gene name to gene ID
+        self.geneNames = []  #gene ID to gene name
+        self.conditionIDs = {}
+        self.conditionNames = []
+        self.replicateSlots = {}  #replicate number to the slot it uses in each gene and condition
+        self.replicateNumbers = []
+        self.geneCapacity = 0  #number of genes we have room for in the arrays
+        self.conditionCapacity = 0
+        self.replicateCapacity = 0
+        self.metrics = list(metrics)
+        self.metricValues = [array.array('d') for metric in self.metrics]  #the values for each metric, all with the same layout
+        self.present = bytearray()  #1 for each spot in the values array that has been filled
+        self.replicateCounts = array.array('i')  #number of replicates stored for each gene and condition
+        self.orderGenes = array.array('i')  #gene and condition IDs in the order they first showed up in the file
+        self.orderConditions = array.array('i')
+
+    def intern(self, name, ids, names):  #returns the ID for a name, giving it the next free one if we have not seen it before
+        nameID = ids.get(name)
+        if nameID is None:
+            nameID = len(names)
+            ids[name] = nameID
+            names.append(name)
+        return nameID
+
+    def addRows(self, genes, conditions, replicates, *metricColumns):  #stores a block of values, given as columns (one for each metric after the replicates).  A replicate seen twice for the same gene and condition keeps the last value, just like the dictionaries did
+        geneIDs = self.geneIDs
+        conditionIDs = self.conditionIDs
+        replicateSlots = self.replicateSlots
+        moreMetrics = len(metricColumns) > 1
+        indices = array.array('q')  #where each row's values go, for filling in the metrics after the first one at the end
+        firstRow = 0  #first row of the block that the indices are for
+        for gene, condition, replicate, value in zip(genes, conditions, replicates, metricColumns[0]):
+            geneID = geneIDs.get(gene)
+            if geneID is None:
+                geneID = self.intern(gene, geneIDs, self.geneNames)
+            conditionID = conditionIDs.get(condition)
+            if conditionID is None:
+                conditionID = self.intern(condition, conditionIDs, self.conditionNames)
+            slot = replicateSlots.get(replicate)
+            if slot is None:
+                slot = self.intern(replicate, replicateSlots, self.replicateNumbers)
+            if conditionID >= self.conditionCapacity or slot >= self.replicateCapacity:  #a new condition or replicate number means every gene needs room for it.  These almost always show up in the first few lines, while the arrays are still small
+                if moreMetrics:
+                    self.fillValues(indices, metricColumns, firstRow)  #the indices so far are for the old layout
+                    firstRow += len(indices)
+                    indices = array.array('q')
+                self.relayout(len(self.conditionNames), len(self.replicateNumbers))
+            if geneID >= self.geneCapacity:
+                self.addGeneRoom(max(1024, self.geneCapacity))  #doubling the room each time keeps the cost of growing spread thin over all the lines
+            cell = geneID * self.conditionCapacity + conditionID
+            index = cell * self.replicateCapacity + slot
+            if not self.present[index]:
+                if not self.replicateCounts[cell]:  #first value for this gene and condition, so it goes in the order
+                    self.orderGenes.append(geneID)
+                    self.orderConditions.append(conditionID)
+                self.present[index] = 1
+                self.replicateCounts[cell] += 1
+            self.metricValues[0][index] = value
+            if moreMetrics:
+                indices.append(index)
+        if moreMetrics:
+            self.fillValues(indices, metricColumns, firstRow)
+        return True
+
+    def fillValues(self, indices, metricColumns, firstRow):  #puts the values of the metrics after the first for a run of rows, starting at firstRow, where addRows worked out they go
+        for values, column in zip(self.metricValues[1:], metricColumns[1:]):
+            for index, value in zip(indices, itertools.islice(column, firstRow, None)):
+                values[index] = value
+        return True
+
+    def addGeneRoom(self, genes):  #makes room in the arrays for more genes
+        cells = genes * self.conditionCapacity
+        for values in self.metricValues:
+            values.extend(array.array('d', [0.0]) * (cells * self.replicateCapacity))
+        self.present.extend(bytes(cells * self.replicateCapacity))
+        self.replicateCounts.extend(array.array('i', [0]) * cells)
+        self.geneCapacity += genes
+        return True
+
+    def relayout(self, conditionCapacity, replicateCapacity):  #copies everything into arrays with room for more conditions or replicates per gene
+        metricValues = [array.array('d', [0.0]) * (self.geneCapacity * conditionCapacity * replicateCapacity) for metric in self.metrics]
+        present = bytearray(self.geneCapacity * conditionCapacity * replicateCapacity)
+        replicateCounts = array.array('i', [0]) * (self.geneCapacity * conditionCapacity)
+        oldReplicates = self.replicateCapacity
+        for cell in range(self.geneCapacity * self.conditionCapacity):
+            if not self.replicateCounts[cell]:
+                continue
+            geneID, conditionID = divmod(cell, self.conditionCapacity)
+            newCell = geneID * conditionCapacity + conditionID
+            replicateCounts[newCell] = self.replicateCounts[cell]
+            for values, oldValues in zip(metricValues, self.metricValues):
+                values[newCell * replicateCapacity : newCell * replicateCapacity + oldReplicates] = oldValues[cell * oldReplicates : (cell + 1) * oldReplicates]
+            present[newCell * replicateCapacity : newCell * replicateCapacity + oldReplicates] = self.present[cell * oldReplicates : (cell + 1) * oldReplicates]
+        self.metricValues = metricValues
+        self.present = present
+        self.replicateCounts = replicateCounts
+        self.conditionCapacity = conditionCapacity
+        self.replicateCapacity = replicateCapacity
+        return True
+
+    def selectGenes(self, geneList):  #cuts the order down to the genes of interest.  The values for other genes stay where they are, but nothing will reach them
+        wanted = bytes([gene in geneList for gene in self.geneNames])
+        keep = list(map(wanted.__getitem__, self.orderGenes))
+        self.orderGenes = array.array('i', itertools.compress(self.orderGenes, keep))
+        self.orderConditions = array.array('i', itertools.compress(self.orderConditions, keep))
+        self.geneIDs = dict([(gene, geneID) for gene, geneID in self.geneIDs.items() if wanted[geneID]])
+        return True
+
+    def __getstate__(self):  #arrays mapped from the cache cannot be pickled (to send a store back from a batch worker), so they go as copies
+        state = self.__dict__.copy()
+        for name, typecode in cacheArrays:
+            if isinstance(state[name], memoryview):
+                state[name] = array.array(typecode, state[name])
+        state["metricValues"] = [array.array('d', values) if isinstance(values, memoryview) else values for values in state["metricValues"]]
+        return state
+
+    def replicateOrder(self):  #the replicate slots sorted by replicate number
+        return sorted(range(len(self.replicateNumbers)), key = self.replicateNumbers.__getitem__)
+
+    def replicateValues(self, geneID, conditionID, slotOrder, metric = 0):  #returns the values of a metric (by its place in the store's metrics) stored for a gene and condition, in the order of the slots given
+        start = (geneID * self.conditionCapacity + conditionID) * self.replicateCapacity
+        values = self.metricValues[metric]
+        return [values[start + slot] for slot in slotOrder if self.present[start + slot]]
+
+cacheArrays = [("present", 'B'), ("replicateCounts", 'i'), ("orderGenes", 'i'), ("orderConditions", 'i')]  #FpkmStore arrays kept in each cache entry and the type of number they hold, besides the values for each metric (kept as values.metric)
+
+class ParsedCache(object):  #on-disk cache of parsed tracking files.  Each file gets an entry directory holding the arrays of its FpkmStore (for every gene) as raw files that can be memory mapped, plus a JSON file with the names and a fingerprint of the file they came from.  Entries are thrown out, least recently used first, once the cache grows past its size cap
+    
+    def __init__(self, directory, sizeCap):
+        self.directory = directory
+        self.sizeCap = sizeCap
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def entryDirectory(self, deFileName):  #each input file path gets its own entry
+        return os.path.join(self.directory, hashlib.blake2b(os.path.abspath(deFileName).encode(), digest_size = 16).hexdigest())
+
+    def fingerprint(self, deFileName):
+        fileStatus = os.stat(deFileName)
+        return {"path" : os.path.abspath(deFileName), "size" : fileStatus.st_size, "mtime" : fileStatus.st_mtime_ns}
+
+    def contentHash(self, deFileName):
+        hasher = hashlib.blake2b(digest_size = 16)
+        deFile = open(deFileName, 'rb')
+        block = deFile.read(8388608)
+        while block:
+            hasher.update(block)
+            block = deFile.read(8388608)
+        deFile.close()
+        return hasher.hexdigest()
+
+    def lookup(self, deFileName, metrics = ("fpkm",)):  #returns an FpkmStore mapped from the cache if we have a parse of this file with all the metrics asked for, or None
+        entry = self.entryDirectory(deFileName)
+        metadataFile = os.path.join(entry, "metadata.json")
+        try:
+            with open(metadataFile) as metadataInput:
+                metadata = json.load(metadataInput)
+        except (OSError, ValueError):
+            return None
+        if [metric for metric in metrics if metric not in metadata.get("metrics", [])]:
+            return None
+        fingerprint = self.fingerprint(deFileName)
+        if metadata["fingerprint"] != fingerprint:
+            if metadata["fingerprint"]["size"] != fingerprint["size"] or metadata["contentHash"] != self.contentHash(deFileName):  #the file was touched or copied, but if the contents are the same the cache is still good
+                return None
+            metadata["fingerprint"] = fingerprint
+            writeJson(metadataFile, metadata)
+        os.utime(metadataFile)  #marks the entry as just used, for the least recently used eviction
+        fpkmStore = FpkmStore(metrics)
+        for name, typecode in cacheArrays:
+            setattr(fpkmStore, name, self.mapArray(os.path.join(entry, name), typecode))
+        fpkmStore.metricValues = [self.mapArray(os.path.join(entry, "values." + metric), 'd') for metric in metrics]
+        fpkmStore.geneNames = metadata["geneNames"]
+        fpkmStore.geneIDs = dict([(gene, geneID) for geneID, gene in enumerate(fpkmStore.geneNames)])
+        fpkmStore.conditionNames = metadata["conditionNames"]
+        fpkmStore.conditionIDs = dict([(condition, conditionID) for conditionID, condition in enumerate(fpkmStore.conditionNames)])
+        fpkmStore.replicateNumbers = metadata["replicateNumbers"]
+        fpkmStore.replicateSlots = dict([(replicate, slot) for slot, replicate in enumerate(fpkmStore.replicateNumbers)])
+        fpkmStore.geneCapacity = len(fpkmStore.geneNames)
+        fpkmStore.conditionCapacity = metadata["conditionCapacity"]
+        fpkmStore.replicateCapacity = metadata["replicateCapacity"]
+        fpkmStore.lineCount = metadata["lineCount"]
+        self.evict()
+        return fpkmStore
+
+    def mapArray(self, arrayFileName, typecode):  #memory maps one of the saved arrays
+        arrayFile = open(arrayFileName, 'rb')
+        if os.fstat(arrayFile.fileno()).st_size:
+            data = memoryview(mmap.mmap(arrayFile.fileno(), 0, access = mmap.ACCESS_READ)).cast(typecode)
+        else:  #an empty file cannot be memory mapped
+            data = array.array(typecode)
+        arrayFile.close()
+        return data
+
+    def save(self, deFileName, fingerprint, fpkmStore):  #writes a new entry for a parsed file.  Everything goes into a temporary directory that only replaces the old entry once it is complete
+        entry = self.entryDirectory(deFileName)
+        temporaryEntry = entry + ".tmp" + str(os.getpid())
+        os.makedirs(temporaryEntry)
+        genes = len(fpkmStore.geneNames)  #the arrays have spare room for more genes on the end, which we leave out
+        lengths = {"present" : genes * fpkmStore.conditionCapacity * fpkmStore.replicateCapacity, "replicateCounts" : genes * fpkmStore.conditionCapacity}
+        arrays = [(name, getattr(fpkmStore, name)) for name, typecode in cacheArrays]
+        arrays += [("values." + metric, values[:lengths["present"]]) for metric, values in zip(fpkmStore.metrics, fpkmStore.metricValues)]
+        for name, data in arrays:
+            arrayFile = open(os.path.join(temporaryEntry, name), 'wb')
+            arrayFile.write(data[:lengths.get(name, len(data))])
+            arrayFile.close()
+        metadata = {"fingerprint" : fingerprint, "contentHash" : self.contentHash(deFileName), "metrics" : fpkmStore.metrics, "lineCount" : fpkmStore.lineCount, "geneNames" : fpkmStore.geneNames, "conditionNames" : fpkmStore.conditionNames, "replicateNumbers" : fpkmStore.replicateNumbers, "conditionCapacity" : fpkmStore.conditionCapacity, "replicateCapacity" : fpkmStore.replicateCapacity}
+        writeJson(os.path.join(temporaryEntry, "metadata.json"), metadata)
+        shutil.rmtree(entry, ignore_errors = True)
+        os.replace(temporaryEntry, entry)
+        self.evict()
+        return True
+
+    def entrySize(self, entry):
+        return sum([os.path.getsize(os.path.join(entry, item)) for item in os.listdir(entry)])
+
+    def evict(self):  #removes the least recently used entries until the cache is back under its size cap
+        entries = []
+        for item in os.listdir(self.directory):
+            entry = os.path.join(self.directory, item)
+            metadataFile = os.path.join(entry, "metadata.json")
+            if os.path.isfile(metadataFile):
+                entries.append((os.path.getmtime(metadataFile), self.entrySize(entry), entry))
+        entries.sort()
+        totalSize = sum([entry[1] for entry in entries])
+        for lastUsed, size, entry in entries:
+            if totalSize <= self.sizeCap:
+                break
+            shutil.rmtree(entry, ignore_errors = True)  #a store we already mapped from this entry keeps working, since the mapping holds on to the data
+            totalSize -= size
+        return True
+
+def writeJson(fileName, data):  #writes under another name first so a reader never sees half a file
+    output = open(fileName + ".tmp", 'w')
+    json.dump(data, output)
+    output.close()
+    os.replace(fileName + ".tmp", fileName)
+    return True
+
+def parseTrackingFile(deFileName, geneList, metrics = ("fpkm",), timer = None, pipeline = None):  #reads the tracking file into an FpkmStore.  With PipelineSettings, the file is read in a background thread and parsed in the pipeline's processes while we add each block to the store
+    timer = timer or StageTimer(fpkStages, False)
     counter = 0
-    line = deFile.readline()  #initialize line to the first line of the deFile
-    interestDict = {} #intiialize an empty dictionary for our data
-    orderList = [] #initializing an empty list for the order
-    while line: #as long as there is some value in the line (so not end of file)
+    fpkmStore = FpkmStore(metrics) #intiialize an empty store for our data.  It also keeps track of the order the genes and conditions show up in
+    if pipeline:
+        blocks = pipelineTrackingBlocks(deFileName, geneList, pipeline, metrics, timer)
+    else:
+        blocks = readTrackingBlocks(deFileName, geneList, metrics = metrics, timer = timer)
+    for block in blocks:  #each block comes back already split into the columns we need, with header lines and genes that are not of interest taken out
+        started = timer.start()
+        fpkmStore.addRows(*block[1:])
+        timer.stop("aggregate", started, len(block[1]))
+        counter += block[0]
         print("Processed " + str(counter) + " lines.", end = "\r")
-        if "tracking_id" in line:  #check if the literal string "tracking_id" is in the line
-            line = deFile.readline() #if so, we have a header line, we read the next line
-            counter += 1
-            continue  #and go back to the start of the loop
-        currentLine =  CuffDiffDeDataLine(line) #initialize the object for the line.  If we have this object left over from a previous line, we reinitalize it and get rid of the old data
-        if geneList and (currentLine.tracking_id not in geneList):    #if there is a geneList and the gene for this line is not one of the genes of interest
-            line = deFile.readline()  #read the next line
-            counter += 1
-            continue #and start the loop over again for it
-        else:  #if the gene is in our list of interest
-            if [currentLine.tracking_id,currentLine.condition] not in orderList:
-                orderList.append([currentLine.tracking_id,currentLine.condition])
-            try:  #try to directly drop the fpkm value directly into the appropriate dictionary.  If that fails due to not having a key for it, keep moving up a level and defining the key
-                interestDict[currentLine.tracking_id][currentLine.condition][int(currentLine.replicate)] = float(currentLine.fpkm)
-            except KeyError:
-                try:
-                    interestDict[currentLine.tracking_id][currentLine.condition] = {}
-                    interestDict[currentLine.tracking_id][currentLine.condition][int(currentLine.replicate)] = float(currentLine.fpkm)
-                except KeyError:
-                    interestDict[currentLine.tracking_id] = {}
-                    interestDict[currentLine.tracking_id][currentLine.condition] = {}
-                    interestDict[currentLine.tracking_id][currentLine.condition][int(currentLine.replicate)] = float(currentLine.fpkm)
-            counter += 1
-            line = deFile.readline()  #read the next line to avoid an infinite loop
     print("Processed " + str(counter) + " lines.")
-    deFile.close()
-    return (interestDict, orderList)
+    fpkmStore.lineCount = counter
+    return fpkmStore
+
+class GeneIndex(object):  #sidecar SQLite index of where each gene's lines are in a tracking file, so a short gene list can be read by seeking to just those lines instead of going through the whole file.  Built the first time it is asked for and again whenever the file changes
+    
+    def __init__(self, deFileName):
+        import sqlite3
+        self.sqlite3 = sqlite3
+        self.deFileName = deFileName
+        self.indexFileName = deFileName + ".fpkidx"
+        fileStatus = os.stat(deFileName)
+        self.fingerprint = (fileStatus.st_size, fileStatus.st_mtime_ns)  #taken before building, so a file that changes while we index it will not match next time
+        if not self.isCurrent():
+            self.build()
+        self.database = sqlite3.connect(self.indexFileName)
+
+    def isCurrent(self):  #checks that there is an index and that it was made from the file as it is now
+        if not os.path.isfile(self.indexFileName):
+            return False
+        try:
+            database = self.sqlite3.connect(self.indexFileName)
+            fingerprint = database.execute("SELECT size, mtime FROM fingerprint").fetchone()
+            database.close()
+        except self.sqlite3.Error:
+            return False
+        return fingerprint == self.fingerprint
 
-def matrixOutput(matrixOutputFileName, keyOutputFileName, fpkmDict, fpkmOrder):
+    def build(self):  #goes through the file once, recording a (start, end, first line number) range for each run of lines with the same gene.  Lines are checked for all nine values along the way, just like a full parse would
+        print("Building the gene index for " + self.deFileName + ".")
+        temporaryFileName = self.indexFileName + ".tmp" + str(os.getpid())
+        database = self.sqlite3.connect(temporaryFileName)
+        try:
+            database.execute("CREATE TABLE ranges (gene TEXT, start INTEGER, end INTEGER, line INTEGER)")
+            database.execute("CREATE TABLE fingerprint (size INTEGER, mtime INTEGER)")
+            deFile = open(self.deFileName, 'rb')
+            ranges = []
+            gene = None
+            offset = 0
+            start = 0
+            startLine = 0
+            for lineNumber, line in enumerate(deFile, 1):
+                if b"tracking_id" in line:  #header lines are not part of any gene
+                    if gene is not None:
+                        ranges.append((gene.decode(), start, offset, startLine))
+                    gene = None
+                else:
+                    if line.count(b"\t") < 8:
+                        raise IndexError(lineLengthError(line.decode(), lineNumber))
+                    lineGene = line[:line.index(b"\t")]
+                    if lineGene != gene:
+                        if gene is not None:
+                            ranges.append((gene.decode(), start, offset, startLine))
+                        gene = lineGene
+                        start = offset
+                        startLine = lineNumber
+                offset += len(line)
+                if len(ranges) >= 100000:
+                    database.executemany("INSERT INTO ranges VALUES (?, ?, ?, ?)", ranges)
+                    ranges = []
+            deFile.close()
+            if gene is not None:
+                ranges.append((gene.decode(), start, offset, startLine))
+            database.executemany("INSERT INTO ranges VALUES (?, ?, ?, ?)", ranges)
+            database.execute("CREATE INDEX rangesByGene ON ranges (gene)")
+            database.execute("INSERT INTO fingerprint VALUES (?, ?)", self.fingerprint)
+            database.commit()
+            database.close()
+        except:  #do not leave a half built index behind
+            database.close()
+            os.remove(temporaryFileName)
+            raise
+        os.replace(temporaryFileName, self.indexFileName)
+        return True
+
+    def ranges(self, genes):  #returns the (start, end, first line number) ranges for a collection of genes, in the order they are in the file
+        genes = list(genes)
+        found = []
+        for first in range(0, len(genes), 500):  #SQLite only takes so many values in one query
+            chunk = genes[first:first + 500]
+            found += self.database.execute("SELECT start, end, line FROM ranges WHERE gene IN (" + ", ".join(["?"] * len(chunk)) + ")", chunk).fetchall()
+        found.sort()
+        return found
+
+    def close(self):
+        self.database.close()
+        return True
+
+def readIndexedGenes(deFileName, geneList, metrics = ("fpkm",), timer = None):  #reads just the lines for a list of genes into an FpkmStore by way of the gene index
+    timer = timer or StageTimer(fpkStages, False)
+    started = timer.start()
+    geneIndex = GeneIndex(deFileName)
     counter = 0
-    matrixOutput = open(matrixOutputFileName, 'w')  #open the file we plan to write the matrix to
-    keyOutput = open(keyOutputFileName, 'w') #open the file we will write the key output to
+    fpkmStore = FpkmStore(metrics)
+    deFile = open(deFileName, 'rb')
+    for start, end, lineNumber in geneIndex.ranges(geneList):
+        deFile.seek(start)
+        lines = deFile.read(end - start).decode().replace("\r\n", "\n").replace("\r", "\n").split("\n")  #the same newline handling we get from reading in text mode
+        if not lines[-1]:
+            lines.pop()
+        timer.stop("read", started, len(lines))
+        columns = parseTrackingLines(lines, lineNumber, geneList, metrics, timer)
+        started = timer.start()
+        fpkmStore.addRows(*columns)
+        started = timer.stop("aggregate", started, len(columns[0]))
+        counter += len(lines)
+    deFile.close()
+    geneIndex.close()
+    timer.stop("read", started)
+    print("Read " + str(counter) + " lines for the genes of interest.")
+    fpkmStore.lineCount = counter
+    return fpkmStore
+
+def createFpkmDict(deFileName, geneList, cache = None, useIndex = False, metrics = ("fpkm",), timer = None, pipeline = None):  #reads the tracking file into an FpkmStore with the values for each metric.  With a gene list and useIndex, reads only those genes' lines by way of the gene index.  With a ParsedCache, uses the cached parse if there is one, and otherwise parses every gene and caches that before picking out the genes of interest.  With PipelineSettings, any parsing is done in the pipeline
+    timer = timer or StageTimer(fpkStages, False)
+    if useIndex and geneList:
+        return readIndexedGenes(deFileName, geneList, metrics, timer)
+    if not cache:
+        return parseTrackingFile(deFileName, geneList, metrics, timer, pipeline)
+    started = timer.start()
+    fpkmStore = cache.lookup(deFileName, metrics)
+    if fpkmStore:
+        timer.stop("read", started, fpkmStore.lineCount)  #mapping the cached arrays stands in for reading the lines
+        print("Using the cached parse of " + deFileName + ".")
+        print("Processed " + str(fpkmStore.lineCount) + " lines.")
+    else:
+        fingerprint = cache.fingerprint(deFileName)  #taken before reading, so a file that changes while we parse it will not match next time
+        timer.stop("read", started)
+        try:
+            fpkmStore = parseTrackingFile(deFileName, False, metrics, timer, pipeline)
+        except ValueError as error:  #a value we could not read, maybe on a gene we were not going to use.  Give up on caching and parse the usual way, which only reads the genes of interest
+            print("Unable to cache " + deFileName + ": " + str(error))
+            return parseTrackingFile(deFileName, geneList, metrics, timer, pipeline)
+        started = timer.start()
+        cache.save(deFileName, fingerprint, fpkmStore)
+        timer.stop("write", started)  #writing the new cache entry
+    if geneList:
+        started = timer.start()
+        fpkmStore.selectGenes(geneList)
+        timer.stop("filter", started, len(fpkmStore.orderGenes))
+    return fpkmStore
+
+def geneOutputLines(gene, conditionValues):  #makes the matrix and key lines for a gene from a list of (condition, FPKM values ordered by replicate) pairs
+    outputList = []  #initialize an empty list for collecting data to put in each line of the matrix output
+    conditionCount = []  #initialize an empty list for collecting data to put in each line of the key output (indicating what each matrix line contains)
+    for condition, values in conditionValues:  #iterate over the conditinos for the gene we are looking at
+        for value in values:
+            outputList.append(str(value)) #append the string of the numerical FPKM value to our list of outputs for the matrix.  This will be ordered by condition, then by replicate
+        conditionCount.append(condition + "(" + str(len(values)) + ")")  #append a string to our condition counts list (for our key output) that will look like condition(N) where N is the number of replicates in the matrix
+    matrixOutputLine = gene + "\t" + "\t".join(outputList) + "\n"  #create the output line to the matrix file by joining the list of values with delimiters
+    keyOutputLine = gene + "\t" + "\t".join(conditionCount) + "\n"  #do the same for our key output
+    return (matrixOutputLine, keyOutputLine)
+
+class DerivedStatistics(object):  #works out the mean, standard deviation and coefficient of variation of each condition's replicates, and log2 fold changes between pairs of conditions, from the values we already have in memory for the matrix.  Saves reading the matrix back in to get them
+    def __init__(self, pseudocount = 1.0, conditionPairs = None):  #condition pairs are (first, second) tuples, with the fold change being second over first.  With no pairs, every pair of conditions is used in the order they showed up
+        self.pseudocount = pseudocount
+        self.conditionPairs = conditionPairs
+
+    def start(self, statsOutputFileName, conditions):  #opens the stats file and writes its header.  Takes the conditions in the order they showed up in the file
+        self.conditions = conditions
+        self.pairs = self.conditionPairs or list(itertools.combinations(conditions, 2))
+        for pair in self.pairs:
+            for condition in pair:
+                if condition not in conditions:
+                    print("Condition " + condition + " (from the pair " + ":".join(pair) + ") is not in the file.  Its fold changes will be NA.")
+        self.statsOutput = open(statsOutputFileName, 'w')
+        header = ["tracking_id"]
+        for condition in conditions:
+            header += [condition + "_mean", condition + "_sd", condition + "_cv"]
+        header += ["log2FC(" + second + "/" + first + ")" for first, second in self.pairs]
+        self.statsOutput.write("\t".join(header) + "\n")
+        return True
+
+    def conditionSummary(self, values):  #returns the mean, sample standard deviation and coefficient of variation for a list of replicate values.  Anything that cannot be worked out comes back as None
+        if not values:
+            return (None, None, None)
+        mean = sum(values) / len(values)
+        if len(values) < 2:  #one replicate has no spread to measure
+            return (mean, None, None)
+        sd = math.sqrt(sum([(value - mean) ** 2 for value in values]) / (len(values) - 1))
+        if not mean:
+            return (mean, sd, None)
+        return (mean, sd, sd / mean)
+
+    def log2FoldChange(self, firstMean, secondMean):
+        if firstMean is None or secondMean is None:
+            return None
+        try:
+            return math.log2((secondMean + self.pseudocount) / (firstMean + self.pseudocount))
+        except (ZeroDivisionError, ValueError):  #a zero mean with no pseudocount
+            return None
+
+    def addGene(self, gene, conditionValues):  #writes the stats line for a gene from the same (condition, FPKM values) pairs that go into its matrix line
+        means = {}
+        fields = [gene]
+        summaries = dict([(condition, self.conditionSummary(values)) for condition, values in conditionValues])
+        for condition in self.conditions:
+            summary = summaries.get(condition, (None, None, None))
+            means[condition] = summary[0]
+            fields += [statText(value) for value in summary]
+        fields += [statText(self.log2FoldChange(means.get(first), means.get(second))) for first, second in self.pairs]
+        self.statsOutput.write("\t".join(fields) + "\n")
+        return True
+
+    def close(self):
+        self.statsOutput.close()
+        return True
+
+def statText(value):  #NA for anything we could not work out
+    if value is None:
+        return "NA"
+    return str(value)
+
+def geneRecords(fpkmStore, metric = 0):  #yields (gene, [(condition, values ordered by replicate), ...]) for each line of the matrix of one of the store's metrics (by its place in the store's metrics), in the order of the original file
+    orderGenes = fpkmStore.orderGenes  #the gene and condition IDs in the order of the original file
+    orderConditions = fpkmStore.orderConditions
+    replicateOrder = fpkmStore.replicateOrder()  #ensure that the replicates (should be integers) come out sorted in numerical order
     i = 0  #initialize our counter
-    while i < len(fpkmOrder):  #go over the fpkmOrder list (each line being a list of gene, condition in the order of the original file)
-        print("Wrote " + str(counter) + " lines.", end="\r")
-        counter += 1
-        gene = fpkmOrder[i][0]  #use the orderList to get our current gene name
-        conditions = []  #initialize an empty list for the different conditions for the gene
-        conditions.append(fpkmOrder[i][1])  #add the condition for the current line of the order list to our list of conditions for the current gene
+    while i < len(orderGenes):  #go over the order (each entry being a gene, condition pair in the order of the original file)
+        gene = orderGenes[i]  #use the order to get our current gene
+        conditions = [orderConditions[i]]  #initialize the list of conditions for the gene with the condition for the current entry
         lookAhead = i + 1  #move the index ahead by one
-        try:  #setting this try/except block in case we run off the end of the list (which will happen when we reach the last gene)
-            while fpkmOrder[lookAhead][0] == gene:  #as long as the next line has the same gene as the gene we are working on at the moment
-                conditions.append(fpkmOrder[lookAhead][1])  #add the condition to the list of conditions for the current gene
-                lookAhead += 1  #and then move the index up one more, then repeat the loop
-        except IndexError: #if we hit an index error (because we ran off the end of the list and finished up)
-            i = len(fpkmOrder) + 1  #set the index to one more than the length of the list, ensuring we exit this loop
-        i = lookAhead #after getting all the genes for the condition, our lookAhead value will be pointing at the first line for the next gene.  Set our index to that for the next iteration of the loop
-        outputList = []  #initialize an empty list for collecting data to put in each line of the matrix output
-        conditionCount = []  #initialize an empty list for collecting data to put in each line of the key output (indicating what each matrix line contains)
-        for condition in conditions:  #iterate over the conditinos for the gene we are looking at
-            replicates = list(fpkmDict[gene][condition].keys())  #get a list of keys
-            replicates.sort()  #ensure that the list of replicates (should be integers) is sorted in numerical order.  This is probably not absolutely necessary, but makes it explicit that it will be ordered
-            for replicate in replicates:  #iterate over our list of replicates (which we just ensured is in order)
-                outputList.append(str(fpkmDict[gene][condition][replicate])) #append the string of the numerical FPKM value to our list of outputs for the matrix.  This will be ordered by condition, then by replicate
-            conditionCount.append(condition + "(" + str(len(replicates)) + ")")  #append a string to our condition counts list (for our key output) that will look like condition(N) where N is the number of replicates in the matrix
-        matrixOutputLine = gene + "\t" + "\t".join(outputList) + "\n"  #create the output line to the matrix file by joining the list of values with delimiters
-        keyOutputLine = gene + "\t" + "\t".join(conditionCount) + "\n"  #do the same for our key output
-        matrixOutput.write(matrixOutputLine) #write the appropriate output line to the matrix file
-        keyOutput.write(keyOutputLine) #do the same for the key
+        while lookAhead < len(orderGenes) and orderGenes[lookAhead] == gene:  #as long as the next entry has the same gene as the gene we are working on at the moment
+            conditions.append(orderConditions[lookAhead])  #add the condition to the list of conditions for the current gene
+            lookAhead += 1  #and then move the index up one more, then repeat the loop
+        i = lookAhead #after getting all the conditions for the gene, our lookAhead value will be pointing at the first entry for the next gene.  Set our index to that for the next iteration of the loop
+        yield (fpkmStore.geneNames[gene], [(fpkmStore.conditionNames[condition], fpkmStore.replicateValues(gene, condition, replicateOrder, metric)) for condition in conditions])  #the values come back ordered by replicate
+
+def matrixOutput(matrixOutputFileName, keyOutputFileName, fpkmStore, statsOutputFileName = None, statistics = None, metric = 0, timer = None, threaded = False):  #writes the matrix for one of the store's metrics (by its place in the store's metrics).  With no key file name, the key is left alone (it is the same for every metric).  With DerivedStatistics and a file name for them, also writes the stats for each gene as it goes.  With threaded set, the matrix and key are written from background threads
+    timer = timer or StageTimer(fpkStages, False)
+    counter = 0
+    matrixOutput = openOutput(matrixOutputFileName, 'w', threaded)  #open the file we plan to write the matrix to
+    keyOutput = None
+    if keyOutputFileName:
+        keyOutput = openOutput(keyOutputFileName, 'w', threaded) #open the file we will write the key output to
+    if statistics:
+        statistics.start(statsOutputFileName, [fpkmStore.conditionNames[condition] for condition in dict.fromkeys(fpkmStore.orderConditions)])  #only the conditions that made it into the order, in the order they showed up
+    records = geneRecords(fpkmStore, metric)
+    while True:
+        started = timer.start()
+        matrixLines = []
+        keyLines = []
+        for gene, conditionValues in itertools.islice(records, outputBlockSize):  #render a block of genes, then write their lines out together
+            print("Wrote " + str(counter) + " lines.", end="\r")
+            counter += 1
+            matrixOutputLine, keyOutputLine = geneOutputLines(gene, conditionValues)
+            matrixLines.append(matrixOutputLine)
+            keyLines.append(keyOutputLine)
+            if statistics:
+                statistics.addGene(gene, conditionValues)
+        if not matrixLines:
+            break
+        started = timer.stop("render", started, len(matrixLines))
+        matrixOutput.write("".join(matrixLines)) #write the lines to the matrix file
+        if keyOutput:
+            keyOutput.write("".join(keyLines)) #do the same for the key
+        timer.stop("write", started, len(matrixLines))
     print("Wrote " + str(counter) + " lines.")    
+    started = timer.start()
+    if statistics:
+        statistics.close()
     matrixOutput.close() 
-    keyOutput.close()
+    if keyOutput:
+        keyOutput.close()
+    timer.stop("write", started)
     return True      
     
+def outputFileNames(deFileName, outputFormat = "text", metrics = ("fpkm",)):  #returns the (matrix, key, stats) file names for each metric from an input.  The key is the JSON sidecar for the binary formats.  Text matrices all share one key.  The metric only goes in the names when it is not just FPKM
+    fileNames = []
+    for metric in metrics:
+        prefix = deFileName
+        if list(metrics) != ["fpkm"]:
+            prefix += "." + metric
+        if outputFormat == "text":
+            fileNames.append((prefix + ".matrix", deFileName + ".key", prefix + ".stats"))
+        else:
+            fileNames.append((prefix + ".matrix" + denseExtensions[outputFormat], prefix + ".matrix.json", prefix + ".stats"))
+    return fileNames
+
+denseExtensions = {"npy" : ".npy", "memmap" : ".dat"}
+denseTypes = {"float32" : ('f', "<f4"), "float64" : ('d', "<f8")}  #array typecode and NumPy dtype string for each value type
+
+def npyHeader(dtype, shape):  #the header of a version 1.0 .npy file, padded so the data starts on a 64 byte boundary
+    header = "{'descr': '" + dtype + "', 'fortran_order': False, 'shape': (" + ", ".join([str(size) for size in shape]) + ("," if len(shape) == 1 else "") + "), }"
+    header += " " * (63 - (10 + len(header)) % 64) + "\n"
+    return b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little") + header.encode("latin1")
+
+def denseLayout(fpkmStore):  #works out the rows and columns of the dense matrix.  Returns the gene IDs in the order they first showed up (with their condition IDs in order) and the (condition ID, replicate slot) for each column
+    orderGenes = fpkmStore.orderGenes
+    orderConditions = fpkmStore.orderConditions
+    conditionCapacity = fpkmStore.conditionCapacity
+    replicateCapacity = fpkmStore.replicateCapacity
+    present = fpkmStore.present
+    conditionsByGene = {}
+    usedSlots = bytearray(len(fpkmStore.replicateNumbers))
+    for geneID, conditionID in zip(orderGenes, orderConditions):
+        try:
+            conditionsByGene[geneID].append(conditionID)
+        except KeyError:
+            conditionsByGene[geneID] = [conditionID]
+        start = (geneID * conditionCapacity + conditionID) * replicateCapacity
+        for slot in range(len(usedSlots)):
+            if present[start + slot]:
+                usedSlots[slot] = 1
+    slotOrder = [slot for slot in fpkmStore.replicateOrder() if usedSlots[slot]]  #only the replicate numbers our genes have, so a cached parse of the whole file gives the same columns
+    columns = [(conditionID, slot) for conditionID in dict.fromkeys(orderConditions) for slot in slotOrder]
+    return (conditionsByGene, columns)
+
+def denseRows(fpkmStore, conditionsByGene, columns, metric = 0, typecode = 'd', littleEndian = False):  #yields (gene ID, array of the row's values) for each row of the dense matrix, with NaN where a gene has no value
+    replicateCapacity = fpkmStore.replicateCapacity
+    geneSize = fpkmStore.conditionCapacity * replicateCapacity
+    present = fpkmStore.present
+    values = fpkmStore.metricValues[metric]
+    offsets = [conditionID * replicateCapacity + slot for conditionID, slot in columns]  #where each column sits in a gene's part of the values array
+    nan = float("nan")
+    for geneID in conditionsByGene:
+        start = geneID * geneSize
+        row = array.array(typecode, [values[start + offset] if present[start + offset] else nan for offset in offsets])
+        if littleEndian and sys.byteorder == "big":  #the sidecar promises little endian numbers
+            row.byteswap()
+        yield (geneID, row)
+
+def denseMatrixOutput(matrixOutputFileName, sidecarOutputFileName, fpkmStore, outputFormat = "npy", valueType = "float64", statsOutputFileName = None, statistics = None, metric = 0, timer = None, threaded = False):  #writes the values of one of the store's metrics as one dense row of numbers for each gene (in the order they first showed up), with a column for each condition and replicate number and NaN where a gene has no value.  The gene names and column labels go in a JSON sidecar, so the numbers can be loaded (or memory mapped) straight into an array.  With threaded set, the numbers are written from a background thread
+    timer = timer or StageTimer(fpkStages, False)
+    started = timer.start()
+    typecode, dtype = denseTypes[valueType]
+    conditionsByGene, columns = denseLayout(fpkmStore)
+    if statistics:
+        statistics.start(statsOutputFileName, [fpkmStore.conditionNames[conditionID] for conditionID in dict.fromkeys(fpkmStore.orderConditions)])
+        replicateOrder = fpkmStore.replicateOrder()
+    matrixOutput = openOutput(matrixOutputFileName, 'wb', threaded)
+    if outputFormat == "npy":
+        matrixOutput.write(npyHeader(dtype, (len(conditionsByGene), len(columns))))
+    counter = 0
+    rows = denseRows(fpkmStore, conditionsByGene, columns, metric, typecode, True)
+    while True:
+        block = []
+        for geneID, row in itertools.islice(rows, outputBlockSize):
+            print("Wrote " + str(counter) + " lines.", end="\r")
+            counter += 1
+            block.append(row)
+            if statistics:
+                statistics.addGene(fpkmStore.geneNames[geneID], [(fpkmStore.conditionNames[conditionID], fpkmStore.replicateValues(geneID, conditionID, replicateOrder, metric)) for conditionID in conditionsByGene[geneID]])
+        if not block:
+            break
+        started = timer.stop("render", started, len(block))
+        matrixOutput.write(b"".join([row.tobytes() for row in block]))
+        started = timer.stop("write", started, len(block))
+    print("Wrote " + str(counter) + " lines.")
+    matrixOutput.close()
+    if statistics:
+        statistics.close()
+    sidecar = {"format" : outputFormat, "data" : os.path.basename(matrixOutputFileName), "metric" : fpkmStore.metrics[metric], "dtype" : dtype, "shape" : [len(conditionsByGene), len(columns)], "order" : "C", "offset" : 0}
+    if outputFormat == "npy":
+        sidecar["offset"] = len(npyHeader(dtype, sidecar["shape"]))  #where the numbers start in the data file
+    sidecar["genes"] = [fpkmStore.geneNames[geneID] for geneID in conditionsByGene]
+    sidecar["columns"] = [[fpkmStore.conditionNames[conditionID], fpkmStore.replicateNumbers[slot]] for conditionID, slot in columns]
+    writeJson(sidecarOutputFileName, sidecar)
+    timer.stop("write", started)
+    return True
+
+def quietly():  #context for library calls that keeps the progress printing off the screen.  The null device is closed again when the context ends
+    import contextlib
+    stack = contextlib.ExitStack()
+    devnull = stack.enter_context(open(os.devnull, 'w'))
+    stack.enter_context(contextlib.redirect_stdout(devnull))
+    return stack
+
+def loadFpkmStore(deFileName, geneList = None, metrics = ("fpkm",), cache = None, useIndex = False):  #reads a tracking file into an FpkmStore without printing progress, for using the program from other Python code.  The gene list can be any collection of gene names (or None for every gene)
+    geneList = set(geneList) if geneList else False
+    with quietly():
+        return createFpkmDict(deFileName, geneList, cache, useIndex, tuple(metrics))
+
+def matrixRecords(deFileName, geneList = None, metric = "fpkm", cache = None, useIndex = False):  #yields the (gene, [(condition, values ordered by replicate), ...]) records that make up the lines of the matrix and key for a tracking file, without writing anything
+    fpkmStore = loadFpkmStore(deFileName, geneList, [metric], cache, useIndex)
+    return geneRecords(fpkmStore)
+
+def denseMatrix(fpkmStore, metric = 0, valueType = "float64"):  #returns (genes, columns, values) for the dense matrix of one of the store's metrics: the gene for each row, the [condition, replicate] for each column and the values as one flat array, row by row (numpy.frombuffer(values).reshape(len(genes), len(columns)) gives the matrix without copying)
+    conditionsByGene, columns = denseLayout(fpkmStore)
+    values = array.array(denseTypes[valueType][0])
+    for geneID, row in denseRows(fpkmStore, conditionsByGene, columns, metric, values.typecode):
+        values.extend(row)
+    return ([fpkmStore.geneNames[geneID] for geneID in conditionsByGene], [[fpkmStore.conditionNames[conditionID], fpkmStore.replicateNumbers[slot]] for conditionID, slot in columns], values)
+
+def streamingMatrixOutput(deFileName, geneList, matrixOutputFileNames, keyOutputFileName, metrics = ("fpkm",), timer = None):  #reads the cuffdiff file and writes each gene out (to a matrix for each metric) as soon as we reach the next one, so only one gene is ever held in memory.  Returns False if a gene shows up again after another gene has started, since the output would no longer match the in-memory path
+    deFile = open(deFileName, 'r')
+    matrixOutputs = [open(matrixOutputFileName, 'w') for matrixOutputFileName in matrixOutputFileNames]
+    keyOutput = open(keyOutputFileName, 'w')
+    finishedGenes = set()  #genes we have already written, so we can tell if the file is not grouped by gene
+    gene = None  #the gene we are collecting
+    conditions = {}  #condition to {replicate : values for each metric} for the current gene.  Dictionaries keep the order the conditions showed up in
+    counter = 0
+    written = 0
+    timer = timer or StageTimer(fpkStages, False)
+    started = timer.start()
+    streamed = 0  #lines read up to the last time we stopped the clock
+    line = deFile.readline()
+    while line:
+        print("Processed " + str(counter) + " lines.", end = "\r")
+        counter += 1
+        if "tracking_id" in line:  #header line
+            line = deFile.readline()
+            continue
+        currentLine = CuffDiffDeDataLine(line, counter)
+        if geneList and (currentLine.tracking_id not in geneList):  #not one of the genes of interest
+            line = deFile.readline()
+            continue
+        if currentLine.tracking_id != gene:  #we have reached the end of the last gene
+            if gene is not None:
+                timer.stop("stream", started, counter - streamed)  #reading, parsing and collecting the gene's lines all happen together here
+                streamed = counter
+                writeStreamedGene(matrixOutputs, keyOutput, gene, conditions, timer)
+                started = timer.start()
+                finishedGenes.add(gene)
+                written += 1
+            if currentLine.tracking_id in finishedGenes:
+                print("Processed " + str(counter) + " lines.")
+                print("Lines for " + currentLine.tracking_id + " are not all together in the file.")
+                deFile.close()
+                for matrixOutput in matrixOutputs:
+                    matrixOutput.close()
+                keyOutput.close()
+                return False
+            gene = currentLine.tracking_id
+            conditions = {}
+        values = [float(getattr(currentLine, metric)) for metric in metrics]  #the metrics are named after the line's attributes
+        try:
+            conditions[currentLine.condition][int(currentLine.replicate)] = values
+        except KeyError:
+            conditions[currentLine.condition] = {int(currentLine.replicate) : values}
+        line = deFile.readline()
+    timer.stop("stream", started, counter - streamed)
+    if gene is not None:
+        writeStreamedGene(matrixOutputs, keyOutput, gene, conditions, timer)
+        written += 1
+    print("Processed " + str(counter) + " lines.")
+    print("Wrote " + str(written) + " lines.")
+    deFile.close()
+    for matrixOutput in matrixOutputs:
+        matrixOutput.close()
+    keyOutput.close()
+    return True
+
+def writeStreamedGene(matrixOutputs, keyOutput, gene, conditions, timer = None):  #writes out one gene collected by the streaming path to the matrix for each metric, with its replicates in numerical order
+    timer = timer or StageTimer(fpkStages, False)
+    started = timer.start()
+    matrixLines = []
+    for metric in range(len(matrixOutputs)):
+        conditionValues = []
+        for condition, replicates in conditions.items():
+            conditionValues.append((condition, [replicates[replicate][metric] for replicate in sorted(replicates)]))
+        matrixOutputLine, keyOutputLine = geneOutputLines(gene, conditionValues)
+        matrixLines.append(matrixOutputLine)
+    started = timer.stop("render", started, 1)
+    for matrixOutput, matrixOutputLine in zip(matrixOutputs, matrixLines):
+        matrixOutput.write(matrixOutputLine)
+    keyOutput.write(keyOutputLine)  #the key line is the same for every metric
+    timer.stop("write", started, 1)
+    return True
+
+def openCache(deFileName, cacheDirectory, cacheSize):  #returns the ParsedCache to use for an input
+    if not cacheDirectory:
+        cacheDirectory = os.path.join(os.path.dirname(os.path.abspath(deFileName)), ".fpkmatrix_cache")
+    return ParsedCache(cacheDirectory, cacheSize)
+
+def writeMatrix(deFileName, geneList, streaming = False, cache = None, useIndex = False, statistics = None, outputFormat = "text", valueType = "float64", metrics = ("fpkm",), timer = None, pipeline = None):  #makes the matrix for each metric, the key (and the stats, if asked for) for one cuffdiff file, reading it only once.  The outputs are named after the input by outputFileNames.  With PipelineSettings, the file is parsed in the pipeline and the outputs are written from background threads
+    fileNames = outputFileNames(deFileName, outputFormat, metrics)
+    if streaming and statistics:
+        print("The stats need every condition before the first line can be written, so reading the whole file into memory.")
+    elif streaming and outputFormat != "text":
+        print("The binary matrix needs every condition and replicate before the first row can be written, so reading the whole file into memory.")
+    elif streaming and not (useIndex and geneList):  #reading through the index only holds the genes of interest anyway
+        if streamingMatrixOutput(deFileName, geneList, [matrixOutputFileName for matrixOutputFileName, keyOutputFileName, statsOutputFileName in fileNames], fileNames[0][1], metrics, timer):
+            return True
+        print("Falling back to reading the whole file into memory.")
+    fpkmStore = createFpkmDict(deFileName, geneList, cache, useIndex, metrics, timer, pipeline)
+    for metric, (matrixOutputFileName, keyOutputFileName, statsOutputFileName) in enumerate(fileNames):
+        if outputFormat == "text":
+            if metric:  #the key was written with the first matrix
+                keyOutputFileName = None
+            matrixOutput(matrixOutputFileName, keyOutputFileName, fpkmStore, statsOutputFileName, statistics, metric, timer, bool(pipeline))
+        else:
+            denseMatrixOutput(matrixOutputFileName, keyOutputFileName, fpkmStore, outputFormat, valueType, statsOutputFileName, statistics, metric, timer, bool(pipeline))
+    return True
+
+def mergedMatrixOutput(matrixOutputFileName, keyOutputFileName, runs, metric = 0, timer = None):  #writes one matrix for a list of (run name, FpkmStore) pairs.  Each gene gets one line, with the values for each run (in the order given) and then each condition (in the order of that run's file) and replicate.  The key names each group of values as run:condition(N)
+    timer = timer or StageTimer(fpkStages, False)
+    started = timer.start()
+    matrixOutput = open(matrixOutputFileName, 'w')
+    keyOutput = None
+    if keyOutputFileName:  #no key file name for the second metric on, since the key is the same
+        keyOutput = open(keyOutputFileName, 'w')
+    geneOrder = {}  #every gene in the order it first shows up across the runs
+    runConditions = []  #for each run, the condition IDs of each gene ID in the order they showed up
+    replicateOrders = []
+    for runName, fpkmStore in runs:
+        conditionsByGene = {}
+        for geneID, conditionID in zip(fpkmStore.orderGenes, fpkmStore.orderConditions):
+            try:
+                conditionsByGene[geneID].append(conditionID)
+            except KeyError:
+                conditionsByGene[geneID] = [conditionID]
+        runConditions.append(conditionsByGene)
+        replicateOrders.append(fpkmStore.replicateOrder())
+        for geneID in fpkmStore.orderGenes:  #the order (rather than every gene name) only has the genes of interest
+            geneOrder[fpkmStore.geneNames[geneID]] = True
+    started = timer.stop("aggregate", started, len(geneOrder))  #lining the runs up gene by gene
+    counter = 0
+    genes = iter(geneOrder)
+    while True:
+        matrixLines = []
+        keyLines = []
+        for gene in itertools.islice(genes, outputBlockSize):
+            print("Wrote " + str(counter) + " lines.", end="\r")
+            counter += 1
+            conditionValues = []
+            for (runName, fpkmStore), conditionsByGene, replicateOrder in zip(runs, runConditions, replicateOrders):
+                geneID = fpkmStore.geneIDs.get(gene)
+                if geneID is None:  #this run did not have the gene, so it adds nothing to the line
+                    continue
+                for conditionID in conditionsByGene[geneID]:
+                    conditionValues.append((runName + ":" + fpkmStore.conditionNames[conditionID], fpkmStore.replicateValues(geneID, conditionID, replicateOrder, metric)))
+            matrixOutputLine, keyOutputLine = geneOutputLines(gene, conditionValues)
+            matrixLines.append(matrixOutputLine)
+            keyLines.append(keyOutputLine)
+        if not matrixLines:
+            break
+        started = timer.stop("render", started, len(matrixLines))
+        matrixOutput.write("".join(matrixLines))
+        if keyOutput:
+            keyOutput.write("".join(keyLines))
+        started = timer.stop("write", started, len(matrixLines))
+    print("Wrote " + str(counter) + " lines.")
+    matrixOutput.close()
+    if keyOutput:
+        keyOutput.close()
+    timer.stop("write", started)
+    return True
+
+workerState = {}  #holds the gene list for each batch worker or parsing process so it only needs to be sent over once
+
+def startWorker(geneList, streaming, useCache = False, cacheDirectory = None, cacheSize = 0, useIndex = False, statistics = None, outputFormat = "text", valueType = "float64", metrics = ("fpkm",), measure = False, traceMemory = False):  #runs once in each worker process when the pool starts
+    workerState["measure"] = measure
+    workerState["traceMemory"] = traceMemory
+    workerState["metrics"] = metrics
+    workerState["outputFormat"] = outputFormat
+    workerState["valueType"] = valueType
+    workerState["statistics"] = statistics
+    workerState["useIndex"] = useIndex
+    workerState["geneList"] = geneList
+    workerState["streaming"] = streaming
+    workerState["useCache"] = useCache
+    workerState["cacheDirectory"] = cacheDirectory
+    workerState["cacheSize"] = cacheSize
+
+def processBatchFile(task):  #runs in a worker process.  Takes a (file name, merged) pair and either writes the file's own matrix and key, or hands back its FpkmStore for the merged matrix.  Returns the file name, the result and the stage timings for the file (None unless we are measuring)
+    import contextlib
+    fileName, merged = task
+    timer = StageTimer(fpkStages, workerState["measure"], workerState["traceMemory"])  #a fresh one for each file, so the parent can just add them up
+    cache = None
+    if workerState["useCache"]:
+        cache = openCache(fileName, workerState["cacheDirectory"], workerState["cacheSize"])
+    devnull = open(os.devnull, 'w')
+    with contextlib.redirect_stdout(devnull):  #progress from several processes at once would just be a jumble
+        if merged:
+            result = createFpkmDict(fileName, workerState["geneList"], cache, workerState["useIndex"], workerState["metrics"], timer)
+        else:
+            result = writeMatrix(fileName, workerState["geneList"], workerState["streaming"], cache, workerState["useIndex"], workerState["statistics"], workerState["outputFormat"], workerState["valueType"], workerState["metrics"], timer)
+    devnull.close()
+    if not timer.enabled:
+        return (fileName, result, None)
+    return (fileName, result, timer.stages)
+
+def batchOutput(args, geneList, statistics = None, timer = None):  #processes every file in the batch in a pool of processes
+    import multiprocessing
+    timer = timer or StageTimer(fpkStages, False)
+    merged = bool(args.mergedOutput)
+    pool = multiprocessing.Pool(min(args.processes, len(args.batch)), initializer = startWorker, initargs = (geneList, args.streaming, args.cache, args.cacheDirectory, args.cacheSize, args.geneIndex, statistics, args.outputFormat, args.valueType, args.values, timer.enabled, timer.traceMemory))
+    runs = []
+    for fileName, result, fileStages in pool.imap(processBatchFile, [(fileName, merged) for fileName in args.batch]):  #imap hands the files back in the order they were given
+        print("Finished " + fileName + " (" + str(len(runs) + 1) + " of " + str(len(args.batch)) + ").")
+        if fileStages:
+            timer.merge(fileStages)
+        runs.append((fileName, result))
+    pool.close()
+    pool.join()
+    if merged:
+        for metric, (matrixOutputFileName, keyOutputFileName, statsOutputFileName) in enumerate(outputFileNames(args.mergedOutput, "text", args.values)):
+            if metric:
+                keyOutputFileName = None
+            mergedMatrixOutput(matrixOutputFileName, keyOutputFileName, runs, metric, timer)
+    return True
+
 def main():
     args = checkArgs()
+    timer = StageTimer(fpkStages, bool(args.metricsOutput), args.traceMemory)
+    profiler = startProfiler(args.profile)
     geneList = getGenesOfInterest(args.geneList)
-    fpkmData = createFpkmDict(args.cuffDiffOutput, geneList)
-    fpkmDict = fpkmData[0]
-    fpkmOrder = fpkmData[1]
-    matrixOutput(args.outputMatrix, args.outputKey, fpkmDict, fpkmOrder)
+    statistics = None
+    if args.stats:
+        statistics = DerivedStatistics(args.pseudocount, args.conditionPairs)
+    if args.batch:
+        batchOutput(args, geneList, statistics, timer)
+    else:
+        cache = None
+        if args.cache:
+            cache = openCache(args.cuffDiffOutput, args.cacheDirectory, args.cacheSize)
+        writeMatrix(args.cuffDiffOutput, geneList, args.streaming, cache, args.geneIndex, statistics, args.outputFormat, args.valueType, args.values, timer, args.pipeline)
+    stopProfiler(profiler, args.profile)
+    if args.metricsOutput:
+        lines = sum([timer.stages[stage]["records"] for stage in ["read", "stream"] if stage in timer.stages])  #lines read, whichever way they were read
+        timer.write(args.metricsOutput, lines, {"program" : "fpkmatrixDEG", "inputs" : args.batch or [args.cuffDiffOutput], "outputFormat" : args.outputFormat, "values" : args.values, "streaming" : args.streaming, "cache" : args.cache, "geneIndex" : args.geneIndex, "pipeline" : bool(args.pipeline)})
+        print("Wrote run metrics to " + args.metricsOutput + ".")
     print('Done!')
     
-main()
\ No newline at end of file
+if __name__ == '__main__':  #only run when called as a program, so the functions can be imported (by the benchmark, for instance)
+    main()
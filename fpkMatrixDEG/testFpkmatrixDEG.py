@@ -0,0 +1,113 @@
+'''
+Checks for fpkmatrixDEG.0.2.py.  Run from this directory with:
+
+    python -m unittest testFpkmatrixDEG
+
+The parsed cache and the gene index are both kept next to the tracking file between runs, so each check reads a file, changes it, and makes
+sure the next read matches a plain parse of the file as it is now.
+'''
+
+import os  #import the OS calling library
+import shutil  #import the library for removing the scratch directory
+import tempfile  #import the library for making the scratch directory
+import unittest  #import the testing library
+
+import fpkmatrix  #the program, loaded by its importable name
+
+header = "tracking_id\tcondition\treplicate\traw_frags\tinternal_scaled_frags\texternal_scaled_frags\tFPKM\teffective_length\tstatus\n"
+
+def trackingLines(genes, conditions = 3, replicates = 3, offset = 0):  #made up lines for each gene in turn, with every value the same width so a value can be edited in place
+    lines = []
+    for gene in genes:
+        for condition in range(conditions):
+            for replicate in range(replicates):
+                value = (int(gene[1:]) * 7 + condition * 3 + replicate + offset) % 90 + 10
+                lines.append(gene + "\tc" + str(condition) + "\t" + str(replicate) + "\t" + str(value) + "\t" + str(value) + "\t" + str(value) + "\t" + str(value) + ".500\t-\tOK\n")
+    return lines
+
+class TrackingFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.deFileName = os.path.join(self.directory, "genes.read_group_tracking")
+        self.writeTrackingFile(trackingLines(["G" + str(gene) for gene in range(10, 60)]))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def writeTrackingFile(self, lines, mode = 'w'):
+        deFile = open(self.deFileName, mode)
+        if mode == 'w':
+            deFile.write(header)
+        deFile.write("".join(lines))
+        deFile.close()
+        return True
+
+    def editInPlace(self, old, new):  #swaps one piece of the file for another of the same size, so only the modification time tells the versions apart.  Keeps the modification time within the same second, the way a quick rewrite would
+        status = os.stat(self.deFileName)
+        deFile = open(self.deFileName, 'r+b')
+        data = deFile.read()
+        self.assertEqual(len(old), len(new))
+        self.assertIn(old, data)
+        deFile.seek(0)
+        deFile.write(data.replace(old, new))
+        deFile.close()
+        os.utime(self.deFileName, ns = (status.st_atime_ns, status.st_mtime_ns + 1000))
+        return True
+
+    def records(self, geneList = None, **options):  #the matrix records for the file as nested lists
+        return [(gene, [(condition, list(values)) for condition, values in conditionValues]) for gene, conditionValues in fpkmatrix.matrixRecords(self.deFileName, geneList, **options)]
+
+    def openCache(self):
+        return fpkmatrix.ParsedCache(os.path.join(self.directory, "cache"), 1 << 30)
+
+    def testCacheAfterAppend(self):  #a cached parse is used while the file is unchanged, and a file with lines added on the end is parsed again
+        cache = self.openCache()
+        self.assertIsNone(cache.lookup(self.deFileName))
+        self.assertEqual(self.records(cache = cache), self.records())
+        self.assertIsNotNone(cache.lookup(self.deFileName))
+        self.assertEqual(self.records(cache = cache), self.records())
+        self.writeTrackingFile(trackingLines(["G" + str(gene) for gene in range(60, 70)]), 'a')
+        self.assertIsNone(cache.lookup(self.deFileName))
+        grown = self.records(cache = cache)
+        self.assertEqual(grown, self.records())
+        self.assertEqual(len(grown), 60)
+        self.assertEqual(self.records(["G12", "G65"], cache = cache), self.records(["G12", "G65"]))
+
+    def testCacheStaleFingerprint(self):  #a file touched without changing keeps its cached parse, but one edited at the same size is parsed again
+        cache = self.openCache()
+        self.records(cache = cache)
+        os.utime(self.deFileName, ns = (os.stat(self.deFileName).st_atime_ns, os.stat(self.deFileName).st_mtime_ns + 1000))
+        self.assertIsNotNone(cache.lookup(self.deFileName))  #the contents still match, so the new fingerprint is taken on
+        before = self.records()
+        self.editInPlace(b"G20\tc1\t2\t65\t65\t65\t65.500", b"G20\tc1\t2\t65\t65\t65\t15.500")
+        self.assertIsNone(cache.lookup(self.deFileName))
+        edited = self.records(cache = cache)
+        self.assertNotEqual(edited, before)
+        self.assertEqual(edited, self.records())
+        self.assertIsNotNone(cache.lookup(self.deFileName))
+
+    def testIndexAfterAppend(self):  #lines added on the end, including more for a gene already in the file, make the index get built again
+        geneList = ["G12", "G33", "G65"]
+        self.assertEqual(self.records(geneList, useIndex = True), self.records(geneList))
+        self.assertTrue(os.path.isfile(self.deFileName + ".fpkidx"))
+        self.writeTrackingFile(trackingLines(["G65", "G33"], replicates = 4, offset = 5)[-4:] + trackingLines(["G65"]), 'a')
+        grown = self.records(geneList, useIndex = True)
+        self.assertEqual(grown, self.records(geneList))
+        self.assertEqual([gene for gene, conditionValues in grown], geneList)
+
+    def testIndexStaleFingerprint(self):  #a file rewritten at the same size within the same second must not keep its old index, whose offsets would now point at the wrong genes
+        geneList = ["G12", "G33"]
+        self.records(geneList, useIndex = True)
+        status = os.stat(self.deFileName)
+        self.writeTrackingFile(trackingLines(["G" + str(gene) for gene in range(59, 9, -1)]))  #the same genes in the opposite order
+        os.utime(self.deFileName, ns = (status.st_atime_ns, status.st_mtime_ns + 1000))
+        self.assertEqual(os.stat(self.deFileName).st_size, status.st_size)
+        rewritten = self.records(geneList, useIndex = True)
+        self.assertEqual(rewritten, self.records(geneList))
+        self.assertEqual([gene for gene, conditionValues in rewritten], ["G33", "G12"])
+        self.editInPlace(b"G33\tc1\t2\t", b"G44\tc1\t2\t")  #one line moves to another gene
+        self.assertEqual(self.records(["G33", "G44"], useIndex = True), self.records(["G33", "G44"]))
+
+if __name__ == '__main__':
+    unittest.main()